@@ -1,118 +1,1335 @@
 import torch
 import torchaudio
 import librosa
+import collections
+import concurrent.futures
+import difflib
+import hashlib
 import math
+import multiprocessing
 import numpy as np
+import os
+import queue
+import threading
 import time
 
-def align_audio_with_text(audio_file_path, text_tokens, non_silent_ranges=[], sr=None, speed=1):
+import audioproc
+import npycache
+import runtime
+from tokens import ERROR_TIME
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+def quantize_model(model):
+    '对模型的全连接层做int8动态量化，仅用于CPU推理'
+    return torch.ao.quantization.quantize_dynamic(model.cpu(), {torch.nn.Linear}, dtype=torch.qint8)
+
+def load_local_model(weights_path, device='cpu'):
+    '''
+    从本地权重文件构建MMS_FA模型，不访问网络。
+    权重以内存映射方式加载，多个进程共享同一份页缓存。
+    构建模型用到torchaudio的内部接口，当前torchaudio版本不提供时退回bundle.get_model()（需联网下载）。
+    '''
+    bundle = torchaudio.pipelines.MMS_FA
+    try:
+        from torchaudio.pipelines._wav2vec2.utils import _extend_model
+        model = torchaudio.models.wav2vec2_model(**bundle._params)
+        normalize_waveform = bundle._normalize_waveform
+    except (ImportError, AttributeError, TypeError) as e:
+        print(f'torchaudio {torchaudio.__version__} does not support loading local weights ({e!r}), '
+              'downloading the MMS_FA bundle instead')
+        return bundle.get_model().eval().to(device)
+    state_dict = torch.load(weights_path, mmap=True, weights_only=True, map_location='cpu')
+    model.load_state_dict(state_dict, assign=True)
+    model = _extend_model(model, normalize_waveform=normalize_waveform, apply_log_softmax=True, append_star=True)
+    return model.eval().to(device)
+
+def export_weights(weights_path):
+    '下载MMS_FA权重并保存为本地文件，供load_local_model离线加载'
+    model = torchaudio.pipelines.MMS_FA.get_model()
+    os.makedirs(os.path.dirname(os.path.abspath(weights_path)), exist_ok=True)
+    torch.save(model.model.state_dict(), weights_path)
+    print('Model weights exported to', weights_path)
+
+class _EagerFallback(torch.nn.Module):
+    '''
+    编译后的模型推理失败时自动退回eager模式。
+    eager为None时不常驻eager模型，首次失败时才调用rebuild重新构建，避免同时保留两份权重。
+    '''
+    def __init__(self, compiled, eager=None, rebuild=None):
+        super().__init__()
+        self.compiled = compiled
+        self.eager = eager
+        self.rebuild = rebuild
+        self.failed = False
+
+    def forward(self, waveforms, lengths=None):
+        if not self.failed:
+            try:
+                return self.compiled(waveforms, lengths)
+            except Exception as e:
+                if self.eager is None and self.rebuild is None:
+                    raise
+                print(f'Compiled model failed, falling back to eager mode: {e}')
+                self.failed = True
+                self.compiled = None
+        if self.eager is None:
+            self.eager = self.rebuild()
+        return self.eager(waveforms, lengths)
+
+def weights_fingerprint(weights_path=None):
+    '权重标识：本地权重文件取路径、大小与修改时间，否则为随torchaudio版本发布的官方权重'
+    if not weights_path:
+        return 'hub'
+    stat = os.stat(weights_path)
+    key = f'{os.path.abspath(weights_path)}|{stat.st_size}|{stat.st_mtime_ns}'
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:12]
+
+def _share_weights(compiled, eager):
+    '''
+    让从缓存加载的TorchScript模块直接引用eager网络的参数与缓冲区。
+    torch.jit.load会把权重完整复制一份，改为引用后复制品随即释放，
+    eager网络的内存映射权重得以保留。只替换名称、形状与类型都一致的张量
+    （脚本化时去掉weight_norm的卷积权重、量化模型的打包权重保持原样），返回替换的个数。
+    '''
+    tensors = dict(eager.named_parameters())
+    tensors.update(eager.named_buffers())
+    shared = 0
+    for name, current in [*compiled.named_parameters(), *compiled.named_buffers()]:
+        tensor = tensors.get(name)
+        if tensor is None or tensor.shape != current.shape or tensor.dtype != current.dtype:
+            continue
+        *path, leaf = name.split('.')
+        module = compiled
+        for part in path:
+            module = getattr(module, part)
+        setattr(module, leaf, tensor)
+        shared += 1
+    return shared
+
+def compile_model(model, backend='eager', tag='MMS_FA', rebuild=None):
+    '''
+    按backend编译模型内部的wav2vec2网络，支持任意音频长度：
+    script: TorchScript，编译产物保存在缓存目录，重启后直接加载；tag应包含权重标识，
+    权重更换后不会误用旧的编译产物。加载后参数改为引用eager网络的权重（见_share_weights），
+    先做一次试推理，失败时由rebuild（返回新的eager网络）重新构建；
+    compile: torch.compile(dynamic=True)，与eager网络共享权重，Inductor缓存保存在缓存目录。
+    编译或试推理失败时保持eager模式；缓存目录不可用时照常编译，只是不保存编译结果。
+    '''
+    if backend not in ('script', 'compile'):
+        return model
+    cache_dir = os.path.join(npycache.default_cache_dir(), 'compiled')
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+    except OSError as e:
+        print(f'Compile cache unavailable, compiling without cache: {e}')
+        cache_dir = None
+    eager = model.model
     start_time = time.time()
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    
     try:
-        bundle = torchaudio.pipelines.MMS_FA
-        if isinstance(audio_file_path, str):
-            waveform, sample_rate = torchaudio.load(audio_file_path)
+        if backend == 'script':
+            device = next(eager.parameters(), torch.empty(0)).device
+            path = cache_dir and os.path.join(cache_dir, f'{tag}-{device.type}-torch{torch.__version__}-torchaudio{torchaudio.__version__}.pt')
+            if path and os.path.exists(path):
+                compiled = torch.jit.load(path, map_location=device)
+                _share_weights(compiled, eager)
+            else:
+                compiled = torch.jit.script(eager)
+                if path:
+                    try:
+                        torch.jit.save(compiled, path + '.tmp')
+                        os.replace(path + '.tmp', path)
+                    except OSError as e:
+                        print(f'Failed to save compiled model: {e}')
+            with torch.inference_mode():
+                compiled(torch.zeros((1, FRAME_WINDOW * 4), device=device))
         else:
-            waveform = torch.tensor(audio_file_path).float()
-            waveform = waveform.unsqueeze(0)
-            sample_rate = sr
-        
-        # 处理非静音区域
-        if non_silent_ranges:
-            # 将时间(秒)转换为样本点
-            total_samples = waveform.shape[1]
-            sample_ranges = []
-            for start_sec, end_sec in non_silent_ranges:
-                start_sample = int(start_sec * sample_rate / speed)
-                end_sample = min(int(end_sec * sample_rate / speed), total_samples)
-                sample_ranges.append((start_sample, end_sample))
-            
-            # 提取并拼接非静音片段
-            segments = []
-            for start, end in sample_ranges:
-                segments.append(waveform[:, start:end])
-            waveform = torch.cat(segments, dim=1)
+            if cache_dir:
+                os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', os.path.join(cache_dir, 'inductor'))
+                os.environ.setdefault('TORCHINDUCTOR_FX_GRAPH_CACHE', '1')
+            compiled = torch.compile(eager, dynamic=True)
+    except Exception as e:
+        print(f'Model compilation failed, using eager mode: {e}')
+        return model
+    if backend == 'script':
+        model.model = _EagerFallback(compiled, rebuild=rebuild)
+    else:
+        model.model = _EagerFallback(compiled, eager)
+    del eager
+    print(f"Model compilation ({backend}) executed in", round(time.time() - start_time, 3), "seconds")
+    return model
+
+def _band_limits(num_frames, num_states, band):
+    '沿对角线的期望路径，每帧允许的CTC状态区间[lo, hi]'
+    if num_frames > 1:
+        centers = np.arange(num_frames, dtype=np.int64) * (num_states - 1) // (num_frames - 1)
+    else:
+        centers = np.zeros(num_frames, dtype=np.int64)
+    return np.maximum(centers - band, 0), np.minimum(centers + band, num_states - 1)
+
+def _viterbi_numpy(log_probs, labels, skip, lo, hi):
+    '''
+    带状CTC Viterbi，逐帧在带内向量化计算。
+    labels为各状态对应的类别，skip标记可由s-2跳转的状态。
+    返回每帧所在状态，无可行路径时返回None。
+    '''
+    num_frames, num_states = len(lo), len(labels)
+    width = int((hi - lo).max()) + 1
+    backptr = np.zeros((num_frames, width), dtype=np.int8)
+    # 前面补两个-inf，使s-1与s-2不越界
+    prev = np.full(num_states + 2, -np.inf, dtype=np.float32)
+    cur = np.full(num_states + 2, -np.inf, dtype=np.float32)
+    prev[2:min(hi[0], 1) + 3] = log_probs[0, labels[:min(hi[0], 1) + 1]]
+    for t in range(1, num_frames):
+        states = np.arange(lo[t], hi[t] + 1)
+        candidates = np.stack((
+            prev[states + 2],
+            prev[states + 1],
+            np.where(skip[states], prev[states], -np.inf),
+        ))
+        choice = candidates.argmax(axis=0)
+        if t >= 2: # cur中残留的是t-2帧的结果
+            cur[lo[t - 2] + 2:hi[t - 2] + 3] = -np.inf
+        cur[states + 2] = candidates[choice, np.arange(len(states))] + log_probs[t, labels[states]]
+        backptr[t, :len(states)] = choice
+        prev, cur = cur, prev
+    last = num_states - 1
+    if num_states > 1 and prev[last + 1] > prev[last + 2]:
+        last -= 1
+    if not np.isfinite(prev[last + 2]):
+        return None
+    path = np.empty(num_frames, dtype=np.int64)
+    for t in range(num_frames - 1, -1, -1):
+        path[t] = last
+        last -= int(backptr[t, last - lo[t]])
+    return path
+
+def _viterbi_loops(log_probs, labels, skip, lo, hi):
+    '与_viterbi_numpy相同的带状CTC Viterbi，逐状态循环，供numba编译'
+    num_frames, num_states = len(lo), len(labels)
+    width = 0
+    for t in range(num_frames):
+        width = max(width, hi[t] - lo[t] + 1)
+    backptr = np.zeros((num_frames, width), dtype=np.int8)
+    prev = np.full(num_states + 2, -np.inf, dtype=np.float32)
+    cur = np.full(num_states + 2, -np.inf, dtype=np.float32)
+    for s in range(min(hi[0], 1) + 1):
+        prev[s + 2] = log_probs[0, labels[s]]
+    for t in range(1, num_frames):
+        if t >= 2:
+            for s in range(lo[t - 2], hi[t - 2] + 1):
+                cur[s + 2] = -np.inf
+        for s in range(lo[t], hi[t] + 1):
+            best = prev[s + 2]
+            choice = 0
+            if prev[s + 1] > best:
+                best = prev[s + 1]
+                choice = 1
+            if skip[s] and prev[s] > best:
+                best = prev[s]
+                choice = 2
+            cur[s + 2] = best + log_probs[t, labels[s]]
+            backptr[t, s - lo[t]] = choice
+        prev, cur = cur, prev
+    last = num_states - 1
+    if num_states > 1 and prev[last + 1] > prev[last + 2]:
+        last -= 1
+    path = np.empty(num_frames, dtype=np.int64)
+    if not np.isfinite(prev[last + 2]):
+        path[:] = -1
+        return path
+    for t in range(num_frames - 1, -1, -1):
+        path[t] = last
+        last -= backptr[t, last - lo[t]]
+    return path
+
+if numba is not None:
+    _viterbi_jit = numba.njit(cache=True, nogil=True)(_viterbi_loops)
+else:
+    _viterbi_jit = None
+
+def banded_forced_align(log_probs, targets, blank=0, band=256):
+    '''
+    限定在对角线附近的CTC强制对齐。
+    log_probs为[T, C]的numpy对数概率，targets为展平的token id序列；
+    每帧只计算期望路径（均匀分布的对角线）前后band个状态，时间与内存为O(T·band)。
+    返回(每帧的类别, 每帧的对数概率)。帧数不足以容纳全部token、带内无可行路径，
+    或最优路径在某帧贴到带的边界（带外可能有更优的路径）时返回None。
+    结果是带内的最优路径，不保证是全局最优：全局最优路径可能离开带后又回到带内，
+    此时返回的路径不贴边界但得分更低。band不小于状态数时与完整网格对齐等价。
+    '''
+    targets = np.asarray(targets, dtype=np.int64)
+    num_frames, num_states = log_probs.shape[0], 2 * len(targets) + 1
+    repeats = int((targets[1:] == targets[:-1]).sum())
+    if num_frames == 0 or num_frames < len(targets) + repeats:
+        return None
+    labels = np.full(num_states, blank, dtype=np.int64)
+    labels[1::2] = targets
+    skip = np.zeros(num_states, dtype=np.bool_)
+    skip[3::2] = targets[1:] != targets[:-1]
+    lo, hi = _band_limits(num_frames, num_states, band)
+    log_probs = np.ascontiguousarray(log_probs, dtype=np.float32)
+    if _viterbi_jit is not None:
+        path = _viterbi_jit(log_probs, labels, skip, lo, hi)
+        path = None if num_frames and path[0] < 0 else path
+    else:
+        path = _viterbi_numpy(log_probs, labels, skip, lo, hi)
+    if path is None:
+        return None
+    if np.any((path == lo) & (lo > 0)) or np.any((path == hi) & (hi < num_states - 1)):
+        return None
+    aligned = labels[path]
+    return aligned, log_probs[np.arange(num_frames), aligned]
+
+class BandedAligner:
+    '''
+    带状CTC强制对齐器，接口与bundle.get_aligner()相同，返回逐token的TokenSpan列表。
+    band为期望路径两侧保留的状态数；带内无可行路径或路径贴到带的边界时带宽加倍重试，
+    带宽覆盖全部状态时退回完整网格对齐。结果是近似的，见banded_forced_align。
+    '''
+    def __init__(self, full_aligner, band=256, blank=0):
+        self.full_aligner = full_aligner
+        self.band = band
+        self.blank = blank
+
+    def __call__(self, emission, tokens):
+        flat = [i for ids in tokens for i in ids]
+        result = None
+        band = self.band
+        log_probs = None
+        while result is None and 2 * band + 1 < 2 * len(flat) + 1:
+            if log_probs is None:
+                log_probs = emission.detach().float().cpu().numpy()
+            result = banded_forced_align(log_probs, flat, self.blank, band)
+            band *= 2
+        if result is None:
+            return self.full_aligner(emission, tokens)
+        aligned, scores = result
+        spans = torchaudio.functional.merge_tokens(torch.from_numpy(aligned), torch.from_numpy(scores).exp(), blank=self.blank)
+        token_spans = []
+        for ids in tokens:
+            token_spans.append(spans[:len(ids)])
+            spans = spans[len(ids):]
+        return token_spans
+
+class ModelManager:
+    '''
+    进程内常驻的MMS_FA模型：只加载一次，空闲超时或内存超限后才释放。
+    quantized为真时使用int8动态量化的CPU模型，与fp32模型分别常驻。
+    '''
+    def __init__(self, idle_timeout=600, memory_limit_mb=0, backend='eager', weights_path=None, align_band=0):
+        self.bundle = torchaudio.pipelines.MMS_FA
+        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        self.tokenizer = self.bundle.get_tokenizer()
+        self.set_align_band(align_band)
+        self.idle_timeout = idle_timeout # 单位：秒，0表示永不因空闲释放
+        self.memory_limit_mb = memory_limit_mb # 单位：MB，0表示不检查内存水位
+        self.backend = backend # 执行模式：eager、script或compile
+        self.weights_path = weights_path # 本地权重文件，指定时离线加载
+        self._models = {}
+        self._lock = threading.RLock()
+        self._users = 0
+        self._last_used = time.time()
+        self._token_cache = {}
+        self._watchdog = None
+
+    def model_id(self, quantized=False):
+        '模型标识，用于缓存键'
+        return 'MMS_FA-int8' if quantized else 'MMS_FA'
+
+    def compile_tag(self, quantized=False):
+        '编译缓存的文件名前缀，包含权重标识'
+        return f'{self.model_id(quantized)}-{weights_fingerprint(self.weights_path)}'
+
+    def set_align_band(self, band=0):
+        '设置对齐器：band大于0时使用带状对齐器，否则使用完整网格对齐'
+        self.align_band = band
+        self.aligner = self.bundle.get_aligner()
+        if band > 0:
+            self.aligner = BandedAligner(self.aligner, band)
+
+    def set_device(self, device):
+        '切换fp32模型的推理设备，设备改变时释放已加载的模型'
+        device = torch.device(device)
+        with self._lock:
+            if device != self.device:
+                self.unload()
+                self.device = device
+
+    def device_for(self, quantized=False):
+        return torch.device('cpu') if quantized else self.device
+
+    def _load_eager(self, quantized=False):
+        '加载eager模式的模型'
+        if self.weights_path:
+            model = load_local_model(self.weights_path)
+        else:
+            model = self.bundle.get_model()
+        return quantize_model(model) if quantized else model.to(self.device)
+
+    def get_model(self, quantized=False):
+        '获取模型，未加载时加载'
+        with self._lock:
+            model = self._models.get(quantized)
+            if model is None:
+                start_time = time.time()
+                model = self._load_eager(quantized)
+                print("Model loading executed in", round(time.time() - start_time, 3), "seconds")
+                if self.backend != 'eager':
+                    model = compile_model(model, self.backend, self.compile_tag(quantized),
+                                          rebuild=lambda: self._load_eager(quantized).model)
+                    self._compile_warm_up(model, quantized)
+                self._models[quantized] = model
+                self._start_watchdog()
+            self._last_used = time.time()
+            return model
+
+    def _compile_warm_up(self, model, quantized=False):
+        '用一段短音频触发编译，避免首个请求承担编译耗时'
+        start_time = time.time()
+        with torch.inference_mode():
+            _forward(model, torch.zeros((1, self.bundle.sample_rate), device=self.device_for(quantized)))
+        print("Compiled model warm-up executed in", round(time.time() - start_time, 3), "seconds")
+
+    def acquire(self, quantized=False):
+        '获取模型并登记使用者，使用完毕后须调用release'
+        with self._lock:
+            self._users += 1
+            try:
+                return self.get_model(quantized)
+            except Exception:
+                self._users -= 1
+                raise
+
+    def release(self):
+        with self._lock:
+            self._users = max(self._users - 1, 0)
+            self._last_used = time.time()
+
+    def warm_up(self, background=False, quantized=False):
+        '预加载模型，background为真时在后台线程中加载'
+        if background:
+            thread = threading.Thread(target=self.get_model, args=(quantized,), daemon=True)
+            thread.start()
+            return thread
+        return self.get_model(quantized)
+
+    def tokenize(self, text_tokens):
+        '将pron字符串转换为token id，重复的字符串直接复用缓存'
+        result = []
+        for token in text_tokens:
+            ids = self._token_cache.get(token)
+            if ids is None:
+                ids = self.tokenizer([token])[0]
+                self._token_cache[token] = ids
+            result.append(ids)
+        return result
+
+    def unload(self):
+        '释放模型及显存'
+        with self._lock:
+            if not self._models:
+                return
+            self._models = {}
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+            print('Idle alignment model unloaded...')
+
+    def memory_usage_mb(self):
+        if self.device.type == 'cuda':
+            return torch.cuda.memory_reserved(self.device) / 2**20
+        if psutil is not None:
+            return psutil.Process().memory_info().rss / 2**20
+        return 0
+
+    def _should_unload(self):
+        if not self._models or self._users > 0:
+            return False
+        idle_time = time.time() - self._last_used
+        if self.idle_timeout > 0 and idle_time >= self.idle_timeout:
+            return True
+        return self.memory_limit_mb > 0 and self.memory_usage_mb() >= self.memory_limit_mb
+
+    def _start_watchdog(self):
+        if self._watchdog is not None and self._watchdog.is_alive():
+            return
+        if self.idle_timeout <= 0 and self.memory_limit_mb <= 0:
+            return
+        self._watchdog = threading.Thread(target=self._watch, daemon=True)
+        self._watchdog.start()
+
+    def _watch(self):
+        interval = min(self.idle_timeout, 30) if self.idle_timeout > 0 else 30
+        while True:
+            time.sleep(interval)
+            with self._lock:
+                if not self._models:
+                    return
+                if self._should_unload():
+                    self.unload()
+                    return
+
+_model_manager = None
+_model_manager_lock = threading.Lock()
+
+def get_model_manager():
+    '获取全进程共享的模型管理器，可通过环境变量配置释放策略'
+    global _model_manager
+    with _model_manager_lock:
+        if _model_manager is None:
+            _model_manager = ModelManager(
+                idle_timeout=float(os.environ.get('FA_KARA_MODEL_IDLE_TIMEOUT', 600)),
+                memory_limit_mb=float(os.environ.get('FA_KARA_MODEL_MEMORY_LIMIT', 0)),
+                backend=os.environ.get('FA_KARA_MODEL_BACKEND', 'eager'),
+                weights_path=os.environ.get('FA_KARA_MODEL_PATH') or None,
+                align_band=int(os.environ.get('FA_KARA_ALIGN_BAND', 0)),
+            )
+        return _model_manager
+
+FRAME_HOP = 320 # 模型每帧对应的样本数
+FRAME_WINDOW = 400 # 模型每帧的感受野样本数
+
+def _normalize_waveforms(waveforms, lengths=None):
+    '逐条对波形做层归一化，补零部分不参与统计并保持为零'
+    if lengths is None:
+        return torch.nn.functional.layer_norm(waveforms, waveforms.shape[-1:])
+    mask = torch.arange(waveforms.shape[-1], device=waveforms.device)[None, :] < lengths[:, None]
+    count = lengths[:, None].to(waveforms.dtype)
+    mean = (waveforms * mask).sum(-1, keepdim=True) / count
+    var = (((waveforms - mean) * mask) ** 2).sum(-1, keepdim=True) / count
+    return (waveforms - mean) / torch.sqrt(var + 1e-5) * mask
+
+def _forward(model, waveforms, lengths=None, normalize=True):
+    '''
+    推理并返回(对数概率, 有效帧数)。
+    不直接调用模型外层的封装，以便逐条归一化补零后的批量输入；normalize为假时跳过归一化。
+    '''
+    if not hasattr(model, 'normalize_waveform'):
+        return model(waveforms, lengths)
+    if normalize and model.normalize_waveform:
+        waveforms = _normalize_waveforms(waveforms, lengths)
+    emission, output_lengths = model.model(waveforms, lengths)
+    if model.apply_log_softmax:
+        emission = torch.nn.functional.log_softmax(emission, dim=-1)
+    if model.append_star:
+        star_dim = torch.zeros((emission.size(0), emission.size(1), 1), dtype=emission.dtype, device=emission.device)
+        emission = torch.cat((emission, star_dim), dim=-1)
+    return emission, output_lengths
+
+def compute_emission(model, waveform, chunk_seconds=0, overlap_seconds=2.0, sample_rate=16000):
+    '''
+    计算整段波形的对数概率帧。
+    chunk_seconds>0时按带重叠上下文的窗口分块推理，只保留每块中心部分的帧再拼接，
+    峰值内存由块长决定而与歌曲时长无关。
+    '''
+    total_samples = waveform.shape[-1]
+    chunk_frames = int(chunk_seconds * sample_rate) // FRAME_HOP
+    total_frames = (total_samples - FRAME_WINDOW) // FRAME_HOP + 1
+    if chunk_frames <= 0 or total_frames <= chunk_frames:
+        return _forward(model, waveform)[0]
+
+    # 先对整段波形归一化，保证各块与整段推理的输入一致
+    if getattr(model, 'normalize_waveform', False):
+        waveform = torch.nn.functional.layer_norm(waveform, waveform.shape)
+    context_frames = int(overlap_seconds * sample_rate) // FRAME_HOP
+    emissions = []
+    for core_start in range(0, total_frames, chunk_frames):
+        core_end = min(core_start + chunk_frames, total_frames)
+        ctx_start = max(core_start - context_frames, 0)
+        ctx_end = min(core_end + context_frames, total_frames)
+        chunk = waveform[:, ctx_start * FRAME_HOP:(ctx_end - 1) * FRAME_HOP + FRAME_WINDOW]
+        emission, _ = _forward(model, chunk, normalize=False)
+        emissions.append(emission[:, core_start - ctx_start:core_end - ctx_start])
+    return torch.cat(emissions, dim=1)
+
+def plan_padded_batches(lengths, max_samples):
+    '''
+    按长度排序后依次分组，每组补零后的总样本数（组内条数×最长者）不超过max_samples，
+    长度相近的请求分在同一组；单条超过上限时单独成组。返回各组的下标列表。
+    '''
+    batches = []
+    for i in sorted(range(len(lengths)), key=lambda i: lengths[i]):
+        if batches and (len(batches[-1]) + 1) * lengths[i] <= max_samples:
+            batches[-1].append(i)
+        else:
+            batches.append([i])
+    return batches
+
+class EmissionBatcher:
+    '''
+    动态批处理：收集短时间窗口内到达的多个推理请求，补零后合并为一次批量前向计算，
+    再按各自的有效帧数切分结果交还给调用者。
+    每次前向补零后的总时长不超过max_batch_seconds，超出时按长度分为多批，短请求不必等待长请求的计算量。
+    '''
+    def __init__(self, manager, max_batch_size=4, max_wait=0.05, num_threads=0, max_batch_seconds=240):
+        self.manager = manager
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait # 单位：秒，首个请求到达后最多等待的时间
+        self.max_batch_seconds = max_batch_seconds
+        self.num_threads = num_threads # 批量推理的torch算子内线程数，0表示沿用全局设置
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def submit(self, waveform, quantized=False):
+        '提交形状为(1, 样本数)的波形，阻塞至批量推理完成，返回形状为(1, 帧数, 类别数)的对数概率'
+        future = concurrent.futures.Future()
+        self._queue.put((waveform, quantized, future))
+        return future.result()
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        if self.num_threads > 0:
+            # 所有请求的推理都在此线程中进行，不受每个任务的线程预算限制
+            runtime.set_torch_threads(self.num_threads)
+        while True:
+            batch = self._collect()
+            # 不同模型的请求分组推理
+            for quantized in (False, True):
+                group = [(waveform, future) for waveform, q, future in batch if q == quantized]
+                max_samples = int(self.max_batch_seconds * self.manager.bundle.sample_rate)
+                for indices in plan_padded_batches([waveform.shape[-1] for waveform, _ in group], max_samples):
+                    self._run_group([group[i] for i in indices], quantized)
+
+    def _run_group(self, group, quantized=False):
+        try:
+            emissions = self._infer([waveform for waveform, _ in group], quantized)
+        except Exception as e:
+            for _, future in group:
+                future.set_exception(e)
+            return
+        for (_, future), emission in zip(group, emissions):
+            future.set_result(emission)
+
+    def _infer(self, waveforms, quantized=False):
+        device = self.manager.device_for(quantized)
+        lengths = torch.tensor([waveform.shape[-1] for waveform in waveforms], device=device)
+        padded = torch.zeros((len(waveforms), int(lengths.max())), device=device)
+        for i, waveform in enumerate(waveforms):
+            padded[i, :waveform.shape[-1]] = waveform[0].to(device)
+        model = self.manager.acquire(quantized)
+        try:
+            with torch.inference_mode():
+                emission, output_lengths = _forward(model, padded, lengths if len(waveforms) > 1 else None)
+        finally:
+            self.manager.release()
+        if output_lengths is None:
+            return [emission]
+        return [emission[i:i + 1, :int(output_lengths[i])] for i in range(len(waveforms))]
+
+_batcher = None
+
+def enable_batching(max_batch_size=4, max_wait=0.05, num_threads=0, max_batch_seconds=240):
+    '''
+    开启全进程共享的动态批处理，之后不分块的推理请求都会经由批处理调度。
+    num_threads为批量推理所用的torch算子内线程数，通常为全部可用CPU；
+    max_batch_seconds为每次前向补零后的总时长上限（秒），限制峰值内存。
+    '''
+    global _batcher
+    if max_batch_size > 1 and _batcher is None:
+        _batcher = EmissionBatcher(get_model_manager(), max_batch_size, max_wait, num_threads, max_batch_seconds)
+    return _batcher
+
+# 对齐结果：token列表，原始音频中的起止时间（秒，失败处为nan），失败掩码，对齐置信度（各字符平均概率）
+AlignmentArrays = collections.namedtuple('AlignmentArrays', ['tokens', 'starts', 'ends', 'failed', 'scores'], defaults=(None,))
+
+def empty_alignment():
+    return AlignmentArrays([], np.zeros(0), np.zeros(0), np.zeros(0, dtype=bool), np.zeros(0))
+
+def map_to_original_times(adjusted_times, non_silent_ranges):
+    '''
+    将拼接后音频中的时间批量映射回原始音频时间。
+    以各非静音片段的累计时长为索引，用searchsorted定位所在片段，超出范围的取最后时间。
+    '''
+    adjusted_times = np.asarray(adjusted_times, dtype=np.float64)
+    if not non_silent_ranges:
+        return adjusted_times.copy()
+    ranges = np.asarray(non_silent_ranges, dtype=np.float64)
+    cumulative_ends = np.cumsum(ranges[:, 1] - ranges[:, 0])
+    cumulative_starts = np.concatenate(([0.0], cumulative_ends[:-1]))
+    index = np.searchsorted(cumulative_ends, adjusted_times, side='right')
+    in_range = index < len(ranges)
+    index = np.minimum(index, len(ranges) - 1)
+    return np.where(in_range, ranges[index, 0] + (adjusted_times - cumulative_starts[index]), ranges[-1, 1])
+
+def format_time(time_sec):
+    '秒数格式化为[mm:ss:cc]'
+    minutes, remainder = divmod(time_sec, 60)
+    seconds, centiseconds = divmod(remainder, 1)
+    return f"[{int(minutes):02d}:{int(seconds):02d}:{math.floor(centiseconds * 100):02d}]"
+
+def format_times(times, failed=None):
+    '批量格式化为[mm:ss:cc]，失败的token记为[error]'
+    if failed is None:
+        failed = np.isnan(times)
+    return ['[error]' if fail else format_time(float(t)) for t, fail in zip(times, failed)]
+
+def to_centiseconds(times, failed=None):
+    '批量转换为厘秒整数，取整方式与format_time相同，失败的token记为tokens.ERROR_TIME'
+    times = np.asarray(times, dtype=np.float64)
+    if failed is None:
+        failed = np.isnan(times)
+    failed = np.asarray(failed, dtype=bool)
+    minutes, remainder = np.divmod(np.where(failed, 0, times), 60)
+    seconds, centiseconds = np.divmod(remainder, 1)
+    result = minutes.astype(np.int64) * 6000 + seconds.astype(np.int64) * 100 + np.floor(centiseconds * 100).astype(np.int64)
+    return np.where(failed, ERROR_TIME, result).astype(np.int32)
+
+def alignment_to_dicts(alignment):
+    '将数组形式的对齐结果转换为逐token的字典列表'
+    results = []
+    start_strs = format_times(alignment.starts, alignment.failed)
+    end_strs = format_times(alignment.ends, alignment.failed)
+    for i, token in enumerate(alignment.tokens):
+        if alignment.failed[i]:
+            results.append({'token': token, 'start': '[error]', 'end': '[error]'})
+            continue
+        results.append({
+            'token': token,
+            'start': start_strs[i],
+            'end': end_strs[i],
+            'original_start': float(alignment.starts[i]),
+            'original_end': float(alignment.ends[i])
+        })
+    return results
+
+def _load_waveform(audio_file_path, sr):
+    if isinstance(audio_file_path, str):
+        return torchaudio.load(audio_file_path)
+    # 与numpy共享内存，不复制
+    waveform = torch.from_numpy(np.ascontiguousarray(audio_file_path, dtype=np.float32))
+    if waveform.dim() == 1:
+        waveform = waveform.unsqueeze(0)
+    return waveform, sr
+
+def _prepare_waveform(audio_file_path, non_silent_ranges, sr, speed, target_rate):
+    '读取音频，拼接非静音片段，转为单声道并重采样'
+    waveform, sample_rate = _load_waveform(audio_file_path, sr)
+    
+    # 处理非静音区域
+    if non_silent_ranges:
+        # 将时间(秒)转换为样本点
+        sample_ranges = segment_sample_ranges(non_silent_ranges, waveform.shape[1], sample_rate, speed)
         
-        # 单声道处理
+        # 提取并拼接非静音片段
+        segments = []
+        for start, end in sample_ranges:
+            segments.append(waveform[:, start:end])
+        waveform = torch.cat(segments, dim=1)
+    
+    # 单声道处理
+    if waveform.shape[0] > 1:
         waveform = waveform.mean(0, keepdim=True)
-        
-        # 重采样
+    
+    # 重采样，已是目标采样率时跳过
+    if sample_rate != target_rate:
         waveform = torchaudio.functional.resample(
-            waveform, sample_rate, bundle.sample_rate
+            waveform, sample_rate, target_rate
+        )
+    return waveform
+
+class FrameTimeline:
+    '''
+    对数概率帧与原始音频时间的对应关系。
+    拼接模式按非静音片段的累计时长映射；分段模式直接查每帧在原始音频中的起始时间。
+    '''
+    def __init__(self, frame_duration, num_frames, non_silent_ranges=None, frame_starts=None):
+        self.frame_duration = frame_duration
+        self.num_frames = num_frames
+        self.non_silent_ranges = non_silent_ranges or []
+        if frame_starts is None:
+            frame_starts = map_to_original_times(np.arange(num_frames) * frame_duration, self.non_silent_ranges)
+            self.spliced = True
+        else:
+            self.spliced = False
+        self.frame_starts = np.asarray(frame_starts, dtype=np.float64)
+
+    def to_times(self, frames, end=False):
+        '帧序号转换为原始音频时间；end为真时frames为不含的结束帧'
+        frames = np.asarray(frames)
+        if self.spliced:
+            return map_to_original_times(frames * self.frame_duration, self.non_silent_ranges)
+        if len(self.frame_starts) == 0:
+            return np.zeros(frames.shape)
+        if end:
+            return self.frame_starts[np.clip(frames - 1, 0, len(self.frame_starts) - 1)] + self.frame_duration
+        return self.frame_starts[np.clip(frames, 0, len(self.frame_starts) - 1)]
+
+def segment_sample_ranges(non_silent_ranges, total_samples, sample_rate, speed=1):
+    '非静音区间（秒）转换为样本区间'
+    sample_ranges = []
+    for start_sec, end_sec in non_silent_ranges:
+        start_sample = int(start_sec * sample_rate / speed)
+        end_sample = min(int(end_sec * sample_rate / speed), total_samples)
+        sample_ranges.append((start_sample, end_sample))
+    return sample_ranges
+
+def compute_segment_emissions(model, waveform, sample_ranges, max_batch_seconds=240, sample_rate=16000):
+    '''
+    不拼接音频，将各片段补零组成批量做前向计算，再按各自有效帧数截取后依次拼接。
+    按长度排序分组，每批补零后的总时长不超过max_batch_seconds，超长片段单独分块推理。
+    返回(对数概率, 各片段帧数)。
+    '''
+    device = waveform.device
+    max_batch_samples = int(max_batch_seconds * sample_rate)
+    lengths = [max(end - start, 0) for start, end in sample_ranges]
+    results = [None] * len(sample_ranges)
+    order = sorted(range(len(sample_ranges)), key=lambda i: lengths[i])
+    batch = []
+
+    def run_batch(batch):
+        if not batch:
+            return
+        batch_lengths = torch.tensor([lengths[i] for i in batch], device=device)
+        padded = torch.zeros((len(batch), int(batch_lengths.max())), device=device)
+        for row, i in enumerate(batch):
+            start, end = sample_ranges[i]
+            padded[row, :lengths[i]] = waveform[0, start:end]
+        emission, output_lengths = _forward(model, padded, batch_lengths if len(batch) > 1 else None)
+        for row, i in enumerate(batch):
+            frames = int(output_lengths[row]) if output_lengths is not None else emission.shape[1]
+            results[i] = emission[row, :frames]
+
+    for i in order:
+        if lengths[i] < FRAME_WINDOW: # 不足一帧
+            continue
+        if lengths[i] > max_batch_samples:
+            start, end = sample_ranges[i]
+            results[i] = compute_emission(model, waveform[:, start:end], max_batch_seconds, sample_rate=sample_rate)[0]
+            continue
+        if batch and (len(batch) + 1) * lengths[i] > max_batch_samples:
+            run_batch(batch)
+            batch = []
+        batch.append(i)
+    run_batch(batch)
+
+    num_classes = next((r.shape[-1] for r in results if r is not None), 0)
+    results = [r if r is not None else torch.zeros((0, num_classes), device=device) for r in results]
+    frame_counts = [r.shape[0] for r in results]
+    return torch.cat(results, dim=0).unsqueeze(0), frame_counts
+
+def _infer_segment_emissions(manager, audio_file_path, non_silent_ranges, sr, speed, chunk_seconds=0, quantized=False):
+    '分段批量推理，返回(对数概率, 每帧在原始音频中的起始时间)'
+    waveform, sample_rate = _load_waveform(audio_file_path, sr)
+    if waveform.shape[0] > 1:
+        waveform = waveform.mean(0, keepdim=True)
+    if sample_rate != manager.bundle.sample_rate:
+        waveform = torchaudio.functional.resample(waveform, sample_rate, manager.bundle.sample_rate)
+    sample_ranges = segment_sample_ranges(non_silent_ranges, waveform.shape[1], manager.bundle.sample_rate, speed)
+    model = manager.acquire(quantized)
+    try:
+        with torch.inference_mode():
+            emission, frame_counts = compute_segment_emissions(
+                model, waveform.to(manager.device_for(quantized)), sample_ranges,
+                chunk_seconds if chunk_seconds > 0 else 240, manager.bundle.sample_rate)
+    finally:
+        manager.release()
+    frame_duration = FRAME_HOP / manager.bundle.sample_rate * speed
+    frame_starts = np.concatenate([start_sec + np.arange(count) * frame_duration
+                                   for (start_sec, _), count in zip(non_silent_ranges, frame_counts)] or [np.zeros(0)])
+    return emission, frame_starts
+
+def _infer_emission(manager, waveform, chunk_seconds=0, quantized=False):
+    '使用常驻模型计算对数概率，开启批处理时与其他请求合并推理'
+    if _batcher is not None and chunk_seconds <= 0:
+        return _batcher.submit(waveform, quantized)
+    model = manager.acquire(quantized)
+    try:
+        with torch.inference_mode():
+            return compute_emission(model, waveform.to(manager.device_for(quantized)), chunk_seconds, sample_rate=manager.bundle.sample_rate)
+    finally:
+        manager.release()
+
+_emission_cache = None
+
+def get_emission_cache():
+    '''
+    获取对数概率的磁盘缓存，以float16的.npy文件保存。
+    环境变量FA_KARA_EMISSION_CACHE=0时关闭，FA_KARA_CACHE_QUOTA_MB设置容量上限。
+    '''
+    global _emission_cache
+    if os.environ.get('FA_KARA_EMISSION_CACHE', '1') == '0':
+        return None
+    if _emission_cache is None:
+        _emission_cache = npycache.NpyCache(
+            os.path.join(npycache.default_cache_dir(), 'emissions'),
+            quota_mb=float(os.environ.get('FA_KARA_CACHE_QUOTA_MB', 2048)),
+            dtype=np.float16,
         )
+    return _emission_cache if _emission_cache.available else None # 缓存目录不可用时不使用缓存
+
+def _load_cached_emission(cache, cache_key, segment_batch, device):
+    '读取缓存的对数概率，分段模式同时读取每帧的起始时间；未命中时返回(None, None)'
+    cached = cache.get(cache_key)
+    frame_starts = None
+    if segment_batch and cached is not None:
+        frame_starts = cache.get(cache_key + '-frames')
+        cached = cached if frame_starts is not None else None
+    if cached is None:
+        return None, None
+    print('Emission loaded from cache...')
+    return torch.from_numpy(np.asarray(cached, dtype=np.float32)).unsqueeze(0).to(device), frame_starts
+
+def emission_cache_key(audio_hash, sr, speed, non_silent_ranges, chunk_seconds, model_id, segment_batch=False):
+    '缓存键覆盖音频内容、倍速、非静音区间、分块设置、推理方式与模型'
+    ranges = tuple((float(start), float(end)) for start, end in non_silent_ranges)
+    mode = 'segments' if segment_batch else 'splice'
+    return npycache.make_key('emission', audio_hash, sr, float(speed), ranges, float(chunk_seconds), model_id, mode)
+
+def spans_to_frames(token_spans):
+    '由各token的TokenSpan列表得到起始帧、结束帧（不含）、失败掩码与置信度'
+    failed = np.array([not spans for spans in token_spans], dtype=bool)
+    start_frames = np.array([spans[0].start if spans else 0 for spans in token_spans], dtype=np.int64)
+    end_frames = np.array([spans[-1].end if spans else 0 for spans in token_spans], dtype=np.int64)
+    scores = np.array([np.mean([span.score for span in spans]) if spans else 0.0 for spans in token_spans], dtype=np.float64)
+    return start_frames, end_frames, failed, scores
+
+def pool_emission(emission, factor):
+    '将[T, C]对数概率每factor帧合并为一帧（概率取平均），用于粗对齐'
+    num_frames, num_classes = emission.shape
+    pad = -num_frames % factor
+    if pad:
+        emission = torch.cat((emission, emission.new_full((pad, num_classes), float('-inf'))))
+    return torch.logsumexp(emission.reshape(-1, factor, num_classes), dim=1) - math.log(factor)
+
+def group_token_lines(token_lines):
+    '按行号将token序号分组，返回各行的token序号列表（按行顺序）'
+    groups = collections.OrderedDict()
+    for index, line in enumerate(token_lines):
+        groups.setdefault(line, []).append(index)
+    return list(groups.values())
+
+def window_limits(windows, num_frames):
+    '''
+    各行结果的(最早帧, 最晚帧)：相邻两行以前一行窗口末尾与后一行窗口开头的中点为界，
+    窗口重叠时界线落在重叠区中间，不重叠时落在间隙中；界线单调不减，保证各行先后不交错。
+    '''
+    firsts = np.array([first for first, _ in windows], dtype=np.int64)
+    lasts = np.array([last for _, last in windows], dtype=np.int64)
+    bounds = np.maximum.accumulate((lasts[:-1] + firsts[1:]) // 2)
+    return list(zip(np.concatenate(([0], bounds)).tolist(), np.concatenate((bounds, [num_frames])).tolist()))
+
+def align_in_windows(aligner, emission, tokens, groups, windows, workers=4, fallback=None, on_result=None, limits=None):
+    '''
+    各行token只在各自的帧窗口内对齐，各行互不依赖，用线程池并行。
+    emission为[T, C]对数概率，tokens为各token的id列表，groups为各行的token序号，windows为各行的(起始帧, 结束帧)。
+    窗口内无法对齐的行保留fallback中的结果（缺省记为失败）。
+    limits为各行结果的(最早帧, 最晚帧)，指定时各行的起止帧限制在其中，窗口相互重叠时保证相邻行不交错。
+    on_result(token序号, 起始帧, 结束帧, 失败掩码)在每行完成时调用，顺序不定。
+    返回(起始帧, 结束帧, 失败掩码, 置信度)。
+    '''
+    if fallback is None:
+        start_frames = np.zeros(len(tokens), dtype=np.int64)
+        end_frames = np.zeros(len(tokens), dtype=np.int64)
+        failed = np.ones(len(tokens), dtype=bool)
+        scores = np.zeros(len(tokens), dtype=np.float64)
+    else:
+        start_frames, end_frames, failed, scores = (np.array(array) for array in fallback)
+
+    def align_line(group, window):
+        first, last = window
+        try:
+            with torch.inference_mode():
+                token_spans = aligner(emission[first:last], [tokens[i] for i in group])
+        except (RuntimeError, ValueError): # 窗口帧数不足以容纳该行token
+            return None
+        line_starts, line_ends, line_failed, line_scores = spans_to_frames(token_spans)
+        return line_starts + first, line_ends + first, line_failed, line_scores
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        futures = {executor.submit(align_line, group, window): line for line, (group, window) in enumerate(zip(groups, windows))}
+        for future in concurrent.futures.as_completed(futures):
+            line = futures[future]
+            group = groups[line]
+            result = future.result()
+            if result is not None:
+                start_frames[group], end_frames[group], failed[group], scores[group] = result
+            if limits is not None:
+                start_frames[group] = np.clip(start_frames[group], *limits[line])
+                end_frames[group] = np.clip(end_frames[group], *limits[line])
+            if on_result is not None:
+                on_result(group, start_frames[group], end_frames[group], failed[group])
+    return start_frames, end_frames, failed, scores
+
+def align_hierarchical(aligner, emission, tokens, token_lines, coarse_factor=4, margin_frames=50, workers=4, on_result=None):
+    '''
+    两遍对齐。第一遍在降采样coarse_factor倍的对数概率上对齐全部token，得到每行的大致位置；
+    第二遍在各行的窗口内逐行精细对齐，各行并行；首行之前与末行之后各留margin_frames帧余量。
+    窗口内对齐失败的行使用第一遍的结果。返回(起始帧, 结束帧, 失败掩码, 置信度)。
+    '''
+    num_frames = emission.shape[0]
+    flat = [i for ids in tokens for i in ids]
+    needed = len(flat) + sum(1 for a, b in zip(flat, flat[1:]) if a == b)
+    # 粗帧数至少保留所需帧数的两倍，否则合并后的相邻token互相挤占；无法降采样时直接整体对齐
+    factor = max(1, min(coarse_factor, num_frames // max(2 * needed, 1)))
+    with torch.inference_mode():
+        if factor == 1:
+            result = spans_to_frames(aligner(emission, tokens))
+            if on_result is not None:
+                on_result(list(range(len(tokens))), *result[:3])
+            return result
+        coarse = spans_to_frames(aligner(pool_emission(emission, factor), tokens))
+    coarse_starts = np.minimum(coarse[0] * factor, num_frames)
+    coarse_ends = np.minimum(coarse[1] * factor, num_frames)
+    
+    # 相邻两行以粗对齐间隙的中点为界，各行窗口再向外放宽几个粗帧以容纳粗对齐的误差
+    groups = group_token_lines(token_lines)
+    line_starts = np.array([coarse_starts[group].min() for group in groups])
+    line_ends = np.array([coarse_ends[group].max() for group in groups])
+    bounds = (line_ends[:-1] + line_starts[1:]) // 2
+    slack = 2 * factor
+    firsts = np.concatenate(([line_starts[0] - margin_frames], bounds - slack))
+    lasts = np.concatenate((bounds + slack, [line_ends[-1] + margin_frames]))
+    windows = [(int(max(first, 0)), int(min(last, num_frames))) for first, last in zip(firsts, lasts)]
+    # 相邻窗口重叠2*slack帧，精细对齐的结果仍以中点为界，保证各行先后不交错
+    limits = list(zip(np.concatenate(([0], bounds)).tolist(), np.concatenate((bounds, [num_frames])).tolist()))
+    return align_in_windows(aligner, emission, tokens, groups, windows, workers,
+                            fallback=(coarse_starts, coarse_ends, coarse[2], coarse[3]), on_result=on_result, limits=limits)
+
+def merge_windows(windows):
+    '合并相互重叠的时间窗口，返回按时间排序的区间列表'
+    merged = []
+    for start, end in sorted(windows):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+def align_audio_with_text(audio_file_path, text_tokens, non_silent_ranges=[], sr=None, speed=1, chunk_seconds=0, as_arrays=False, audio_hash=None, use_cache=True, quantized=False, segment_batch=False, token_lines=None, workers=4, line_windows=None, on_line=None):
+    '''
+    对齐音频与歌词token。
+    as_arrays为真时返回AlignmentArrays，否则返回逐token的字典列表（时间为[mm:ss:cc]字符串）。
+    audio_hash为音频内容的哈希值，用作对数概率缓存键，缺省时根据输入计算。
+    quantized为真时使用int8动态量化模型在CPU上推理。
+    segment_batch为真时不拼接非静音片段，而是将各片段组成批量推理。
+    token_lines为各token所在的行号，指定时先定位各行再逐行并行精细对齐（workers个线程）。
+    line_windows为各行的时间窗口 {行号: (起始秒, 结束秒)}，与token_lines同时指定时每行只在自己的窗口内对齐；
+    整段音频的对数概率已缓存时直接使用，否则只对各窗口内的音频推理。
+    on_line(token序号, 起始时间, 结束时间, 失败掩码)在每行对齐完成后即调用，可用于逐行显示结果；
+    不分行对齐时在全部对齐完成后调用一次。
+    '''
+    start_time = time.time()
+    manager = get_model_manager()
+    
+    try:
+        bundle = manager.bundle
+        segment_batch = segment_batch and bool(non_silent_ranges)
+        frame_duration = 1.0 / bundle.sample_rate * FRAME_HOP * speed
+        
+        # 优先读取磁盘缓存，命中时跳过重采样与推理
+        emission = frame_starts = None
+        cache = get_emission_cache() if use_cache else None
+        if cache is not None:
+            if audio_hash is None:
+                if isinstance(audio_file_path, str):
+                    audio_hash = npycache.hash_file(audio_file_path)
+                else:
+                    audio_hash = npycache.hash_array(audio_file_path)
+            cache_key = emission_cache_key(audio_hash, sr, speed, non_silent_ranges, chunk_seconds, manager.model_id(quantized), segment_batch)
+            emission, frame_starts = _load_cached_emission(cache, cache_key, segment_batch, manager.device_for(quantized))
+        
+        windowed = line_windows is not None and token_lines is not None
+        if windowed and emission is None:
+            # 没有整段音频的缓存时，只对各行窗口内的音频推理
+            non_silent_ranges = merge_windows(line_windows.values())
+            segment_batch = True
+            if cache is not None:
+                cache_key = emission_cache_key(audio_hash, sr, speed, non_silent_ranges, chunk_seconds, manager.model_id(quantized), segment_batch)
+                emission, frame_starts = _load_cached_emission(cache, cache_key, segment_batch, manager.device_for(quantized))
         
-        # 加载模型
-        model = bundle.get_model().to(device)
-        tokenizer = bundle.get_tokenizer()
-        aligner = bundle.get_aligner()
+        if emission is None:
+            if segment_batch:
+                emission, frame_starts = _infer_segment_emissions(manager, audio_file_path, non_silent_ranges, sr, speed, chunk_seconds, quantized)
+            else:
+                waveform = _prepare_waveform(audio_file_path, non_silent_ranges, sr, speed, bundle.sample_rate)
+                emission = _infer_emission(manager, waveform, chunk_seconds, quantized)
+            if cache is not None:
+                cache.put(cache_key, emission[0].cpu().numpy())
+                if segment_batch:
+                    cache.put(cache_key + '-frames', frame_starts, dtype=np.float64)
+        timeline = FrameTimeline(frame_duration, emission.shape[1], non_silent_ranges, frame_starts)
         
         # 处理有效token
         valid_tokens = [token for token in text_tokens if token]
+        tokens = manager.tokenize(valid_tokens)
+        if token_lines is not None:
+            token_lines = [line for token, line in zip(text_tokens, token_lines) if token]
         
-        with torch.inference_mode():
-            emission, _ = model(waveform.to(device))
-            tokens = tokenizer(valid_tokens)
-            token_spans = aligner(emission[0], tokens)
-        
-        del model
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
+        def to_times(start_frames, end_frames, failed):
+            '起止帧映射回原始音频时间，失败处为nan'
+            starts = timeline.to_times(start_frames).astype(np.float64)
+            ends = timeline.to_times(end_frames, end=True).astype(np.float64)
+            starts[failed] = np.nan
+            ends[failed] = np.nan
+            return starts, ends
         
-        # 时间转换参数
-        frame_duration = 1.0 / bundle.sample_rate * 320 * speed
-        results = []
+        report = None
+        if on_line is not None:
+            report = lambda group, start_frames, end_frames, failed: on_line(group, *to_times(start_frames, end_frames, failed), failed)
         
-        # 映射回原始时间
-        def map_to_original_time(adjusted_time):
-            """将处理后的时间映射回原始音频时间"""
-            if not non_silent_ranges:
-                return adjusted_time
-            
-            cumulative_duration = 0.0
-            for start_sec, end_sec in non_silent_ranges:
-                segment_duration = end_sec - start_sec
-                if adjusted_time < cumulative_duration + segment_duration:
-                    return start_sec + (adjusted_time - cumulative_duration)
-                cumulative_duration += segment_duration
-            return non_silent_ranges[-1][1]  # 超出范围返回最后时间
+        if windowed:
+            groups = group_token_lines(token_lines)
+            windows = [tuple(int(f) for f in np.searchsorted(timeline.frame_starts, line_windows[token_lines[group[0]]]))
+                       for group in groups]
+            # 前后行的窗口各自放宽了pad秒，通常相互重叠，结果以重叠区的中点为界
+            start_frames, end_frames, failed, scores = align_in_windows(manager.aligner, emission[0], tokens, groups, windows, workers,
+                                                                        on_result=report, limits=window_limits(windows, emission.shape[1]))
+        elif token_lines is not None and len(set(token_lines)) > 1:
+            start_frames, end_frames, failed, scores = align_hierarchical(manager.aligner, emission[0], tokens, token_lines, workers=workers, on_result=report)
+        else:
+            with torch.inference_mode():
+                token_spans = manager.aligner(emission[0], tokens)
+            start_frames, end_frames, failed, scores = spans_to_frames(token_spans)
+            if report is not None:
+                report(list(range(len(tokens))), start_frames, end_frames, failed)
         
-        # 时间格式化函数
-        def format_time(time_sec):
-            minutes, remainder = divmod(time_sec, 60)
-            seconds, centiseconds = divmod(remainder, 1)
-            return f"[{int(minutes):02d}:{int(seconds):02d}:{math.floor(centiseconds * 100):02d}]"
-
-        # 处理每个token的时间对齐
-        for i, spans in enumerate(token_spans):
-            if not spans:
-                results.append({
-                    'token': valid_tokens[i],
-                    'start': '[error]',
-                    'end': '[error]'
-                })
-                continue
-                
-            # 获取调整后的时间
-            adjusted_start = spans[0].start * frame_duration
-            adjusted_end = spans[-1].end * frame_duration
-            
-            # 映射回原始音频时间
-            original_start = map_to_original_time(adjusted_start)
-            original_end = map_to_original_time(adjusted_end)
-            
-            results.append({
-                'token': valid_tokens[i],
-                'start': format_time(original_start),
-                'end': format_time(original_end),
-                'original_start': original_start,
-                'original_end': original_end
-            })
+        # 处理每个token的时间对齐，并映射回原始音频时间
+        starts, ends = to_times(start_frames, end_frames, failed)
+        alignment = AlignmentArrays(valid_tokens, starts, ends, failed, scores)
         
         end_time = time.time()
         print("Alignment inference executed in", round(end_time - start_time, 3), "seconds")
-        return results
+        return alignment if as_arrays else alignment_to_dicts(alignment)
 
     except Exception as e:
         print(f"Error during alignment: {e}")
-        return []
\ No newline at end of file
+        return empty_alignment() if as_arrays else []
+
+def alignment_settings(audio_hash, sr, speed, non_silent_ranges, chunk_seconds, quantized=False, segment_batch=False):
+    '推理设置的标识，与对数概率缓存键一致；设置相同时增量对齐才能沿用上次的结果'
+    segment_batch = segment_batch and bool(non_silent_ranges)
+    return emission_cache_key(audio_hash, sr, speed, non_silent_ranges, chunk_seconds, get_model_manager().model_id(quantized), segment_batch)
+
+def alignment_state(alignment, token_lines, settings):
+    '''
+    保存对齐结果供下次增量对齐使用：逐行的token与起止时间（失败为None），以及推理设置的标识。
+    token_lines为alignment.tokens中各token所在的行号。
+    '''
+    if len(alignment.tokens) != len(token_lines):
+        return None
+    groups = group_token_lines(token_lines)
+    to_list = lambda times, group: [None if alignment.failed[i] else float(times[i]) for i in group]
+    return {
+        'settings': settings,
+        'lines': [[alignment.tokens[i] for i in group] for group in groups],
+        'starts': [to_list(alignment.starts, group) for group in groups],
+        'ends': [to_list(alignment.ends, group) for group in groups],
+        'scores': [[float(alignment.scores[i]) for i in group] for group in groups] if alignment.scores is not None else None,
+    }
+
+def diff_lines(old_lines, new_lines):
+    '''
+    逐行比较新旧歌词，返回difflib风格的(tag, i1, i2, j1, j2)列表。
+    行数不变时按位置逐行比较，只把内容变化的行标为replace；
+    否则用difflib，副歌等重复行较多时difflib可能把未修改的行错配到别处的相同行上。
+    '''
+    if len(old_lines) != len(new_lines):
+        return difflib.SequenceMatcher(None, old_lines, new_lines, autojunk=False).get_opcodes()
+    opcodes = []
+    for i, (old, new) in enumerate(zip(old_lines, new_lines)):
+        tag = 'equal' if old == new else 'replace'
+        if opcodes and opcodes[-1][0] == tag:
+            opcodes[-1] = (tag, opcodes[-1][1], i + 1, opcodes[-1][3], i + 1)
+        else:
+            opcodes.append((tag, i, i + 1, i, i + 1))
+    return opcodes
+
+def align_incremental(previous, audio_file_path, text_tokens, token_lines, duration, non_silent_ranges=[], sr=None, speed=1, chunk_seconds=0, audio_hash=None, quantized=False, segment_batch=False, workers=4):
+    '''
+    增量对齐。与上次的对齐状态previous逐行比较（见diff_lines），未修改的行沿用上次的时间；
+    修改或新增的连续若干行作为一组，只在前后未修改行的时间之间、用缓存的对数概率重新对齐。
+    previous的推理设置与本次不同、某组的窗口不足以容纳其token或在窗口内对齐失败时返回None，此时应整体对齐。
+    '''
+    if audio_hash is None:
+        audio_hash = npycache.hash_file(audio_file_path) if isinstance(audio_file_path, str) else npycache.hash_array(audio_file_path)
+    if not previous or previous.get('settings') != alignment_settings(audio_hash, sr, speed, non_silent_ranges, chunk_seconds, quantized, segment_batch):
+        return None
+    
+    valid = [(token, line) for token, line in zip(text_tokens, token_lines) if token]
+    tokens = [token for token, _ in valid]
+    groups = group_token_lines([line for _, line in valid])
+    new_lines = [tuple(tokens[i] for i in group) for group in groups]
+    old_lines = [tuple(line) for line in previous['lines']]
+    
+    starts = np.full(len(tokens), np.nan)
+    ends = np.full(len(tokens), np.nan)
+    scores = np.zeros(len(tokens))
+    changed = []
+    changed_lines = 0
+    for tag, i1, i2, j1, j2 in diff_lines(old_lines, new_lines):
+        if tag == 'equal':
+            for old, new in zip(range(i1, i2), range(j1, j2)):
+                starts[groups[new]] = [np.nan if t is None else t for t in previous['starts'][old]]
+                ends[groups[new]] = [np.nan if t is None else t for t in previous['ends'][old]]
+                if previous.get('scores'):
+                    scores[groups[new]] = previous['scores'][old]
+        elif j2 > j1:
+            changed_lines += j2 - j1
+            changed.append([i for line in range(j1, j2) for i in groups[line]])
+    
+    if changed:
+        # 各组的窗口为前一个未修改token的结束时间到后一个未修改token的开始时间
+        manager = get_model_manager()
+        frame_duration = FRAME_HOP / manager.bundle.sample_rate * speed
+        block_of_token = np.full(len(tokens), -1)
+        windows = {}
+        for block, indices in enumerate(changed):
+            before = ends[:indices[0]]
+            after = starts[indices[-1] + 1:]
+            window_start = float(np.nanmax(before)) if np.isfinite(before).any() else 0.0
+            window_end = float(np.nanmin(after)) if np.isfinite(after).any() else duration
+            # 窗口至少要容纳每个字符一帧，相邻的重复字符之间还需一帧空白
+            flat = [i for ids in manager.tokenize([tokens[i] for i in indices]) for i in ids]
+            needed = len(flat) + sum(1 for a, b in zip(flat, flat[1:]) if a == b)
+            if window_end - window_start < needed * frame_duration:
+                print('Edited lines have no room between unchanged neighbours, re-aligning all lines...')
+                return None
+            windows[block] = (window_start, window_end)
+            block_of_token[indices] = block
+        realigned = np.nonzero(block_of_token >= 0)[0]
+        result = align_audio_with_text(audio_file_path, [tokens[i] for i in realigned], non_silent_ranges, sr, speed, chunk_seconds,
+                                       as_arrays=True, audio_hash=audio_hash, quantized=quantized, segment_batch=segment_batch,
+                                       token_lines=block_of_token[realigned].tolist(), workers=workers, line_windows=windows)
+        if len(result.tokens) != len(realigned) or any(result.failed[block_of_token[realigned] == block].all() for block in windows):
+            print('Edited lines could not be aligned within their windows, re-aligning all lines...')
+            return None
+        starts[realigned] = result.starts
+        ends[realigned] = result.ends
+        scores[realigned] = result.scores
+    print(f'Incremental alignment: {len(groups) - changed_lines} line(s) reused, {changed_lines} line(s) re-aligned')
+    return AlignmentArrays(tokens, starts, ends, np.isnan(starts) | np.isnan(ends), scores)
+
+def alignment_score(alignment):
+    '对齐结果的综合得分：各token置信度的平均值，失败的token记0分'
+    if not len(alignment.tokens):
+        return 0.0
+    return float(np.where(alignment.failed, 0.0, alignment.scores).mean())
+
+def _sweep_init(threads, manager_options):
+    '倍速扫描子进程的初始化：限制线程数，沿用主进程的模型设置'
+    torch.set_num_threads(threads)
+    manager = get_model_manager()
+    manager.backend = manager_options['backend']
+    manager.weights_path = manager_options['weights_path']
+    manager.set_align_band(manager_options['align_band'])
+
+def _sweep_worker(audio, sr, speed, text_tokens, non_silent_ranges, chunk_seconds, audio_hash, quantized, segment_batch, stretch_method):
+    audio, sr, audio_hash = audioproc.stretch_audio(audio, sr, speed, stretch_method, audio_hash)
+    return align_audio_with_text(audio, text_tokens, non_silent_ranges, sr, speed, chunk_seconds, as_arrays=True,
+                                 audio_hash=audio_hash, quantized=quantized, segment_batch=segment_batch)
+
+def best_speed(speeds, results):
+    '''
+    按alignment_score为各倍速的对齐结果评分，返回(最佳倍速, {倍速: 得分})；得分相同时取列表中靠前的倍速。
+    '''
+    scores = {speed: alignment_score(results[speed]) for speed in speeds}
+    return max(speeds, key=lambda speed: scores[speed]), scores
+
+def speed_sweep(audio, sr, text_tokens, speeds, non_silent_ranges=[], workers=2, threads=1, chunk_seconds=0, audio_hash=None, quantized=False, segment_batch=False, stretch_method='librosa'):
+    '''
+    倍速扫描。音频只解码一次，按各倍速以stretch_method变速并对齐，以best_speed选出最佳倍速。
+    第一个倍速在本进程中用常驻模型对齐（threads个线程），其余倍速在workers-1个子进程（各threads个线程）中并行对齐；
+    workers不大于1时全部在本进程中依次对齐。子进程以spawn方式启动，会以__mp_main__重新导入主模块，
+    主模块的启动代码须放在if __name__ == '__main__'之下。
+    返回(最佳倍速, 对应的AlignmentArrays, {倍速: 得分})。
+    '''
+    manager = get_model_manager()
+    options = {'backend': manager.backend, 'weights_path': manager.weights_path, 'align_band': manager.align_band}
+    if audio_hash is None:
+        audio_hash = npycache.hash_array(audio)
+    local = speeds if workers <= 1 else speeds[:1]
+    remote = speeds[len(local):]
+    arguments = (text_tokens, non_silent_ranges, chunk_seconds, audio_hash, quantized, segment_batch, stretch_method)
+    results = {}
+    executor = None
+    if remote:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=min(workers - 1, len(remote)),
+                                                          mp_context=multiprocessing.get_context('spawn'),
+                                                          initializer=_sweep_init, initargs=(threads, options))
+    previous_threads = torch.get_num_threads()
+    try:
+        futures = {executor.submit(_sweep_worker, audio, sr, speed, *arguments): speed for speed in remote} if executor else {}
+        runtime.set_torch_threads(threads)
+        for speed in local:
+            results[speed] = _sweep_worker(audio, sr, speed, *arguments)
+        for future in concurrent.futures.as_completed(futures):
+            results[futures[future]] = future.result()
+    finally:
+        runtime.set_torch_threads(previous_threads)
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+    best, scores = best_speed(speeds, results)
+    for speed in speeds:
+        print(f"Speed x{speed}: score {scores[speed]:.4f}, {int(results[speed].failed.sum())} failed token(s)")
+    return best, results[best], scores
+
+def quantization_drift_check(audio_file_path, text_tokens, non_silent_ranges=[], sr=None, speed=1, chunk_seconds=0):
+    '''
+    在参考音频上分别用fp32与int8模型对齐，报告推理耗时与token起止时间的偏差（单位：厘秒）。
+    int8模型只能在CPU上推理，fp32模型也临时改在CPU上推理，偏差只反映量化本身而不含设备差异。
+    '''
+    manager = get_model_manager()
+    device = manager.device
+    manager.set_device('cpu')
+    results = {}
+    try:
+        for quantized in (False, True):
+            manager.warm_up(quantized=quantized)
+            start_time = time.time()
+            alignment = align_audio_with_text(audio_file_path, text_tokens, non_silent_ranges, sr, speed, chunk_seconds,
+                                              as_arrays=True, use_cache=False, quantized=quantized)
+            results[quantized] = (alignment, time.time() - start_time)
+    finally:
+        manager.set_device(device)
+    (reference, fp32_seconds), (quantized_result, int8_seconds) = results[False], results[True]
+    if len(reference.tokens) != len(quantized_result.tokens):
+        print('Quantization check failed: alignment error')
+        return None
+    valid = ~(reference.failed | quantized_result.failed)
+    drift = np.concatenate((
+        np.abs(reference.starts[valid] - quantized_result.starts[valid]),
+        np.abs(reference.ends[valid] - quantized_result.ends[valid]),
+    )) * 100
+    report = {
+        'fp32_seconds': fp32_seconds,
+        'int8_seconds': int8_seconds,
+        'speedup': fp32_seconds / int8_seconds if int8_seconds > 0 else float('inf'),
+        'max_drift_cs': float(drift.max()) if drift.size else 0.0,
+        'mean_drift_cs': float(drift.mean()) if drift.size else 0.0,
+        'p95_drift_cs': float(np.percentile(drift, 95)) if drift.size else 0.0,
+        'over_2cs_ratio': float((drift > 2 + 1e-6).mean()) if drift.size else 0.0,
+        'failed_fp32': int(reference.failed.sum()),
+        'failed_int8': int(quantized_result.failed.sum()),
+    }
+    print(f"fp32: {fp32_seconds:.3f}s, int8: {int8_seconds:.3f}s, speedup: x{report['speedup']:.2f}")
+    print(f"Timing drift (cs): max {report['max_drift_cs']:.1f}, mean {report['mean_drift_cs']:.2f}, p95 {report['p95_drift_cs']:.1f}, "
+          f">2cs {report['over_2cs_ratio']:.1%}")
+    return report
+
+if __name__=='__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='MMS_FA模型工具')
+    parser.add_argument('--export', required=True, help='将模型权重导出到指定路径，供FA_KARA_MODEL_PATH离线加载')
+    args = parser.parse_args()
+    export_weights(args.export)
@@ -0,0 +1,207 @@
+import fractions
+import librosa
+import numpy as np
+import os
+import struct
+import threading
+
+import npycache
+
+MODEL_SAMPLE_RATE = 16000 # MMS_FA模型的输入采样率
+STRETCH_METHODS = ('librosa', 'wsola', 'resample')
+WAV_DTYPES = {(1, 16): np.int16, (1, 32): np.int32, (3, 32): np.float32, (3, 64): np.float64} # (格式, 位深): 样本类型
+WAV_SCALES = {np.int16: 1 / 32768, np.int32: 1 / 2147483648}
+
+def open_wav(path):
+    '''
+    以内存映射方式打开未压缩的WAV文件，返回((帧数, 声道数)的数组, 采样率)。
+    映射为写时复制模式，可直接交给torch.from_numpy；不支持的格式返回None。
+    '''
+    try:
+        with open(path, 'rb') as f:
+            riff, _, wave = struct.unpack('<4sI4s', f.read(12))
+            if riff != b'RIFF' or wave != b'WAVE':
+                return None
+            fmt = None
+            while True:
+                header = f.read(8)
+                if len(header) < 8:
+                    return None
+                chunk_id, size = struct.unpack('<4sI', header)
+                if chunk_id == b'fmt ':
+                    body = f.read(size)
+                    fmt_tag, channels, sample_rate, _, _, bits = struct.unpack('<HHIIHH', body[:16])
+                    if fmt_tag == 0xFFFE and len(body) >= 26: # WAVE_FORMAT_EXTENSIBLE，子格式GUID的前两字节为格式
+                        fmt_tag = struct.unpack('<H', body[24:26])[0]
+                    fmt = (fmt_tag, channels, sample_rate, bits)
+                    if size % 2:
+                        f.seek(1, 1)
+                elif chunk_id == b'data':
+                    offset = f.tell()
+                    break
+                else:
+                    f.seek(size + size % 2, 1)
+        file_size = os.path.getsize(path)
+    except (OSError, struct.error):
+        return None
+    if fmt is None or (fmt[0], fmt[3]) not in WAV_DTYPES or fmt[1] < 1:
+        return None
+    fmt_tag, channels, sample_rate, bits = fmt
+    dtype = np.dtype(WAV_DTYPES[(fmt_tag, bits)]).newbyteorder('<')
+    frames = (min(size, file_size - offset)) // (dtype.itemsize * channels) # 部分软件写入的data长度不准确
+    if frames == 0:
+        return None
+    data = np.memmap(path, dtype=dtype, mode='c', offset=offset, shape=(frames, channels))
+    return data, sample_rate
+
+def _to_float_mono(block):
+    '将(帧数, 声道数)的样本块转为float32单声道'
+    scale = WAV_SCALES.get(block.dtype.type)
+    block = block.astype(np.float32)
+    if scale is not None:
+        block *= scale
+    return block[:, 0] if block.shape[1] == 1 else block.mean(axis=1)
+
+def _decode_blocks(path, wav, block_frames):
+    '''
+    逐块解码为float32单声道，返回(块的迭代器, 原采样率)。
+    wav为open_wav的结果，WAV以内存映射方式读取，其他格式由soundfile逐块解码；都无法读取时返回None。
+    '''
+    if wav is not None:
+        data, native_sr = wav
+        return (_to_float_mono(data[start:start + block_frames]) for start in range(0, len(data), block_frames)), native_sr
+    try:
+        import soundfile
+        f = soundfile.SoundFile(path)
+    except (ImportError, RuntimeError, TypeError, OSError):
+        return None
+    def blocks():
+        with f:
+            for block in f.blocks(blocksize=block_frames, dtype='float32', always_2d=True):
+                yield _to_float_mono(block)
+    return blocks(), f.samplerate
+
+def load_audio(path, sr=MODEL_SAMPLE_RATE, block_frames=1 << 20, on_block=None):
+    '''
+    一次解码为sr采样率（缺省为模型的16kHz）的单声道float32连续数组，返回(音频, 采样率)。
+    逐块解码并流式重采样，WAV以内存映射方式读取，已是16kHz单声道float32的WAV不复制；
+    soundfile无法读取的格式交给librosa解码。
+    on_block(块)在每块解码后调用，可在读取的同时进行静音检测。
+    '''
+    wav = open_wav(path)
+    if wav is not None and wav[1] == sr and wav[0].dtype == np.float32 and wav[0].shape[1] == 1:
+        audio = wav[0][:, 0].view(np.ndarray)
+        if on_block is not None:
+            for start in range(0, len(audio), block_frames):
+                on_block(audio[start:start + block_frames])
+        return audio, sr
+    decoded = _decode_blocks(path, wav, block_frames)
+    if decoded is None:
+        audio, _ = librosa.load(path, sr=sr, mono=True)
+        audio = np.ascontiguousarray(audio, dtype=np.float32)
+        if on_block is not None:
+            on_block(audio)
+        return audio, sr
+    blocks, native_sr = decoded
+    resampler = None
+    if native_sr != sr:
+        import soxr # librosa的依赖
+        resampler = soxr.ResampleStream(native_sr, sr, 1, dtype='float32')
+    chunks = []
+    def emit(chunk):
+        chunks.append(chunk)
+        if on_block is not None and len(chunk):
+            on_block(chunk)
+    for block in blocks:
+        emit(resampler.resample_chunk(block) if resampler else block)
+    if resampler:
+        emit(resampler.resample_chunk(np.zeros(0, dtype=np.float32), last=True))
+    return np.ascontiguousarray(np.concatenate(chunks or [np.zeros(0, dtype=np.float32)]), dtype=np.float32), sr
+
+def wsola(audio, rate, frame_length=512, tolerance=128):
+    '''
+    WSOLA变速（不变调）。合成步长为半帧，分析步长为合成步长乘以rate；
+    每帧在名义位置前后tolerance个样本内，选取与上一帧自然延续波形互相关最大的位置叠加。
+    '''
+    hop = frame_length // 2
+    analysis_hop = hop * rate
+    window = np.hanning(frame_length + 1)[:-1].astype(np.float32) # 周期汉宁窗，半帧重叠时和为1
+    padded = np.concatenate((np.zeros(frame_length + tolerance, dtype=np.float32), audio.astype(np.float32),
+                             np.zeros(2 * frame_length + tolerance, dtype=np.float32)))
+    # 从音频开头之前一帧开始取帧，使开头处的叠加窗口完整
+    base = tolerance
+    num_frames = int((len(audio) + frame_length) / analysis_hop) + 2
+    output = np.zeros(num_frames * hop + frame_length, dtype=np.float32)
+    previous = base # 上一帧实际取用的位置
+    for k in range(num_frames):
+        position = base + int(round(k * analysis_hop))
+        if k > 0:
+            natural = padded[previous + hop:previous + hop + frame_length]
+            region = padded[position - tolerance:position + tolerance + frame_length]
+            correlation = np.correlate(region, natural, mode='valid')
+            position += int(np.argmax(correlation)) - tolerance
+        output[k * hop:k * hop + frame_length] += window * padded[position:position + frame_length]
+        previous = position
+    start = int(round(frame_length / rate)) # 音频开头在输出中的位置
+    return output[start:start + int(round(len(audio) / rate))]
+
+def resample_stretch(audio, rate):
+    '以重采样实现变速，速度最快但音高随之改变'
+    ratio = fractions.Fraction(rate).limit_denominator(1000)
+    return librosa.resample(audio, orig_sr=ratio.numerator, target_sr=ratio.denominator, res_type='soxr_mq')
+
+def stretched_identity(audio_hash, sr, rate, method='librosa'):
+    '变速后音频的(采样率, 标识)，标识由原音频、倍速与算法决定，不变速时即原音频'
+    if rate == 1:
+        return sr, audio_hash
+    return (sr if method == 'librosa' else MODEL_SAMPLE_RATE), npycache.make_key('stretch', audio_hash, float(rate), method)
+
+_stretch_cache = None
+_stretch_cache_lock = threading.Lock()
+
+def get_stretch_cache():
+    '''
+    获取变速音频的磁盘缓存，环境变量FA_KARA_STRETCH_CACHE=0时关闭，容量上限与对数概率缓存共用FA_KARA_CACHE_QUOTA_MB。
+    '''
+    global _stretch_cache
+    if os.environ.get('FA_KARA_STRETCH_CACHE', '1') == '0':
+        return None
+    with _stretch_cache_lock:
+        if _stretch_cache is None:
+            _stretch_cache = npycache.NpyCache(
+                os.path.join(npycache.default_cache_dir(), 'stretched'),
+                quota_mb=float(os.environ.get('FA_KARA_CACHE_QUOTA_MB', 2048)),
+                dtype=np.float32,
+            )
+    return _stretch_cache if _stretch_cache.available else None # 缓存目录不可用时不使用缓存
+
+def stretch_audio(audio, sr, rate, method='librosa', audio_hash=None):
+    '''
+    按倍速rate变速，返回(变速后音频, 采样率, 变速后音频的标识)。
+    librosa为原有的相位声码器，在输入采样率上处理；wsola与resample在模型使用的16kHz单声道上处理（输入不是时先转换），速度快得多。
+    结果按(音频, 倍速, 算法)缓存，相同设置再次运行时直接读取。
+    '''
+    if audio_hash is None:
+        audio_hash = npycache.hash_array(audio)
+    if rate == 1:
+        return audio, sr, audio_hash
+    if method not in STRETCH_METHODS:
+        raise ValueError(f'Unknown time-stretch method: {method}')
+    out_sr, key = stretched_identity(audio_hash, sr, rate, method)
+    cache = get_stretch_cache()
+    if cache is not None:
+        # 写时复制映射，交给torch.from_numpy时不会因只读数组而告警
+        cached = cache.get(key, mmap_mode='c')
+        if cached is not None:
+            print('Stretched audio loaded from cache...')
+            return cached.view(np.ndarray), out_sr, key
+    if method == 'librosa':
+        stretched = librosa.effects.time_stretch(audio, rate=rate)
+    else:
+        audio = librosa.to_mono(audio)
+        if sr != MODEL_SAMPLE_RATE:
+            audio = librosa.resample(audio, orig_sr=sr, target_sr=MODEL_SAMPLE_RATE)
+        stretched = wsola(audio, rate) if method == 'wsola' else resample_stretch(audio, rate)
+    if cache is not None:
+        cache.put(key, stretched)
+    return stretched, out_sr, key
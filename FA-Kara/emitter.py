@@ -0,0 +1,51 @@
+import io
+
+class TokenColumns:
+    '输出时使用的token列，一次性从TokenTable转换为Python列表，逐个读取更快'
+    def __init__(self, table):
+        self.orig = table.orig
+        self.type = table.type.tolist()
+        self.ruby = table.ruby
+        self.start = table.start.tolist()
+        self.end = table.end.tolist()
+
+    def __len__(self):
+        return len(self.orig)
+
+class TokenSink:
+    '''
+    输出格式的基类。emit遍历一次token表，依次调用各输出的begin、token（每个token一次）与finish；
+    token(i)中可通过self.columns读取前后的token，但不再单独遍历。
+    结果以write增量写入out（文件或缓冲区），缺省写入StringIO，可用getvalue取得。
+    '''
+    def __init__(self, out=None):
+        self.out = out if out is not None else io.StringIO()
+        self.columns = None
+
+    def write(self, text):
+        if text:
+            self.out.write(text)
+
+    def begin(self, columns):
+        self.columns = columns
+
+    def token(self, i):
+        pass
+
+    def finish(self):
+        pass
+
+    def getvalue(self):
+        return self.out.getvalue()
+
+def emit(table, sinks):
+    '遍历一次token表，同时生成各输出格式，返回sinks'
+    columns = TokenColumns(table)
+    for sink in sinks:
+        sink.begin(columns)
+    for i in range(len(columns)):
+        for sink in sinks:
+            sink.token(i)
+    for sink in sinks:
+        sink.finish()
+    return sinks
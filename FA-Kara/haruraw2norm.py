@@ -3,12 +3,15 @@ import nltk
 from nltk.corpus import cmudict
 import pykakasi
 import pyphen
+import numpy as np
+import os
 import re
 # import string
 
 kks = pykakasi.kakasi()
 tokenizer = Tokenizer()
 tail_pron = '' # 'h'
+MIN_ERROR_SPLIT_MAX_CELLS = int(os.environ.get('FA_KARA_SPLIT_MAX_CELLS', 1 << 22)) # は/へ修正的规模上限
 
 phoneme_map = {
     'AA': 'a', 'AE': 'a', 'AH': 'a', 'AO': 'o', 'AW': 'au', 'AY': 'ai',
@@ -160,65 +163,97 @@ def get_norm_surface(item):
         return item['orig']
     return ''
 
+def occurrence_ends(s, segment):
+    '子串segment在s中每次出现（可重叠）的终点'
+    ends = []
+    start = s.find(segment)
+    while start != -1:
+        ends.append(start + len(segment))
+        start = s.find(segment, start + 1)
+    return ends
+
+def special_costs(target, s):
+    """
+    与target匹配时错误成本低于1的子串，返回{长度: 成本数组}，数组下标为子串终点j（子串为s[j-长度:j]）。
+    其余子串的成本都为1。
+    """
+    costs = {}
+    def cost_array(length):
+        if length not in costs:
+            costs[length] = np.ones(len(s) + 1)
+        return costs[length]
+    if target == tail_pron:
+        for length in range(1, min(len(s), 9) + 1): # 长度不小于10时成本为1
+            cost_array(length)[length:] = min(length*0.1, 1)
+    elif target == 'ha':
+        # 此处可添加当て字
+        for segment in ('wa', 'e'):
+            cost_array(len(segment))[occurrence_ends(s, segment)] = 0.1
+    cost_array(len(target))[occurrence_ends(s, target)] = 0
+    return costs
+
 def min_error_split(target_list, s):
+    """
+    将字符串s分割为与target_list逐项对应的子串，使错误成本之和最小（0~1 匹配~不匹配），无有效分割时返回None。
+    按目标项逐列计算，dp[i]表示处理到字符串位置i时的最小错误数：
+    成本为1的一般子串取dp的前缀最小值，只有成本低于1的少数短子串（长度不超过目标项或尾音的长度）逐个长度计算，
+    每列为向量化的线性时间。成本相同时取起点最小的分割，结果与逐个尝试所有子串相同。
+    (n+1)*(m+1)超过MIN_ERROR_SPLIT_MAX_CELLS时放弃，返回None。
+    """
     n = len(s)
     m = len(target_list)
-    
-    # 初始化 DP 表
-    # dp[i][k] 表示处理到字符串位置 i 时，已匹配 k 个目标项的最小错误数
-    dp = [[float('inf')] * (m + 1) for _ in range(n + 1)]
-    # 记录回溯路径
-    backtrack = [[None] * (m + 1) for _ in range(n + 1)]
-    
+    if (n + 1) * (m + 1) > MIN_ERROR_SPLIT_MAX_CELLS:
+        print('Line too long, skipped correcting ha and he...')
+        return None
+
+    positions = np.arange(n + 1)
     # 初始状态：空字符串匹配 0 个目标项
-    dp[0][0] = 0
-    
-    # 动态规划填表
-    for i in range(n + 1):
-        for k in range(m + 1):
-            if dp[i][k] == float('inf'):
+    dp = np.full(n + 1, np.inf)
+    dp[0] = 0
+    # 记录回溯路径：各目标项的子串起点
+    backtrack = []
+    costs_cache = {}
+
+    for target in target_list:
+        # 处理空字符串目标项：不消耗任何字符
+        if target == "":
+            backtrack.append(positions)
+            continue
+        # 成本为1的子串：i<j中dp[i]+1的前缀最小值，相同时取最小的i
+        shifted = dp + 1
+        prefix_min = np.minimum.accumulate(shifted)
+        improved = np.concatenate(([True], shifted[1:] < prefix_min[:-1]))
+        prefix_arg = np.maximum.accumulate(np.where(improved, positions, 0))
+        new_dp = np.full(n + 1, np.inf)
+        prev = np.zeros(n + 1, dtype=np.int64)
+        new_dp[1:] = prefix_min[:-1]
+        prev[1:] = prefix_arg[:-1]
+        # 成本低于1的短子串
+        if target not in costs_cache:
+            costs_cache[target] = special_costs(target, s)
+        for length, cost in costs_cache[target].items():
+            if length > n:
                 continue
-                
-            # 尝试匹配下一个目标项
-            if k < m:
-                target = target_list[k]
-                # 处理空字符串目标项
-                if target == "":
-                    # 不消耗任何字符
-                    if dp[i][k] < dp[i][k + 1]:
-                        dp[i][k + 1] = dp[i][k]
-                        backtrack[i][k + 1] = (i, k, "")
-                else:
-                    # 尝试所有可能的子串
-                    for j in range(i + 1, n + 1):
-                        segment = s[i:j]
-                        # 计算错误成本（0~1 匹配~不匹配）
-                        if segment == target:
-                            cost = 0
-                        elif target == tail_pron:
-                            cost = min(len(segment)*0.1, 1)
-                        elif segment=='wa' and target=='ha' or segment=='e' and target=='ha':
-                            # 此处可添加当て字
-                            cost = 0.1
-                        else:
-                            cost = 1
-                        new_cost = dp[i][k] + cost
-                        if new_cost < dp[j][k + 1]:
-                            dp[j][k + 1] = new_cost
-                            backtrack[j][k + 1] = (i, k, segment)
-    
+            new_cost = dp[:n + 1 - length] + cost[length:]
+            starts = positions[:n + 1 - length]
+            better = (new_cost < new_dp[length:]) | ((new_cost == new_dp[length:]) & (starts < prev[length:]))
+            new_dp[length:][better] = new_cost[better]
+            prev[length:][better] = starts[better]
+        dp = new_dp
+        backtrack.append(prev)
+
     # 回溯找到最佳分割
-    if dp[n][m] == float('inf'):
+    if dp[n] == np.inf:
         return None  # 无有效分割
-    
+
     # 从终点回溯
     result = []
-    i, k = n, m
-    while k > 0:
-        prev_i, prev_k, segment = backtrack[i][k]
-        result.append(segment)
-        i, k = prev_i, prev_k
-    
+    j = n
+    for prev in reversed(backtrack):
+        i = int(prev[j])
+        result.append(s[i:j])
+        j = i
+
     # 反转结果（因为是从后往前回溯）
     return result[::-1]
 
@@ -28,4 +28,18 @@ def utat_process(text):
     )
     result = re.split(r'<br\s*/?>\s*', text)
     result = [i+'\n' for i in result]
-    return result
\ No newline at end of file
+    return result
+
+def split_lyrics(text, txt_format=None):
+    '''
+    将WebUI输入的歌词文本切分为各行，供process_haruhi_line逐行处理；跳过空行。
+    与main.py逐行读取文件相同，每行都以换行符结尾，换行符成为行尾的token，各行分别成行。
+    '''
+    lines = utat_process(text) if txt_format == 'uta' else text.strip().split('\n')
+    result = []
+    for line in lines:
+        if txt_format == 'moe':
+            line = moeg_process_line(line)
+        if line.strip():
+            result.append(line.rstrip('\n') + '\n')
+    return result
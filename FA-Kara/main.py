@@ -1,38 +1,24 @@
 import argparse
-import bisect
-import librosa
-import numpy as np
+import json
 import os
 import re
 import time
 
 import align
+import audioproc
+import emitter
 # import ass2lrc
 import haruraw2norm as hn
 import lrcfmt
 import norm2ass
+import npycache
+import priors
+import runtime
+import silence
+import timing
+from tokens import TokenTable
 from norm2lrc import *
 
-def non_silent_recog(audio_file, sr = None, frame_second = 1, threspct = 10, thresrto = .1):
-    '识别非静音片段'
-    frame_length = int(sr * frame_second)
-    hop_length = frame_length // 2  # 50% 重叠
-    energy = librosa.feature.rms(y=audio_file, frame_length=frame_length, hop_length=hop_length)[0]
-    threshold = np.percentile(energy, 100-threspct) * thresrto
-    non_silent_frames = energy > threshold
-    times = librosa.frames_to_time(np.arange(len(energy)), sr=sr, hop_length=hop_length) # 转换为时间点
-    segments = [] # 合并连续片段
-    start = None
-    for i, (t, active) in enumerate(zip(times, non_silent_frames)):
-        if active and start is None:
-            start = max(t-frame_second/4, 0)
-        elif not active and start is not None:
-            segments.append((start, t+frame_second/4))
-            start = None
-    if start is not None:
-        segments.append((start, times[-1]))
-    return segments
-
 def main():
     start_time = time.time()
     script_dir = os.path.dirname(os.path.realpath(__file__))
@@ -40,9 +26,13 @@ def main():
     parser.add_argument('-x', '--sokuon_split', type=int, default=0, help='是否将促音与前一字符拆开')
     parser.add_argument('-n', '--hatsuon_split', type=int, default=1, help='是否将拨音与前一字符拆开')
     parser.add_argument('-v', '--audio_speedx', type=float, default=1, help='推理时使用的音频倍速')
+    parser.add_argument('-sm', '--stretch_method', default='librosa', choices=audioproc.STRETCH_METHODS, help='变速算法。librosa为相位声码器；wsola（不变调）与resample（变调）速度快得多')
+    parser.add_argument('-vs', '--speed_sweep', default='', help='倍速扫描：以逗号分隔的候选倍速，如0.8,0.9,1。指定时并行对齐各倍速并自动选用得分最高者，忽略-v')
     parser.add_argument('-p', '--path_io', default='', help='输入输出文件目录。基于主文件所在目录，支持绝对路径或相对路径')
     parser.add_argument('-ia', '--input_audio', default=None, help='输入音频文件名')
     parser.add_argument('-it', '--input_text', default='i.txt', help='输入歌词文件名')
+    parser.add_argument('-ip', '--input_prior', default=None, help='已有的逐行时间轴文件名（LRC或ASS），指定时每行只在其时间附近对齐')
+    parser.add_argument('-pp', '--prior_pad', type=float, default=1.5, help='已有时间轴各行窗口两端放宽的时长，单位：秒')
     parser.add_argument('-t', '--tail_correct', type=int, default=3, help='尾音拖长选项。建议取默认值3')
     parser.add_argument('-tl', '--tail_limit_window', type=float, default=0.8, help='全曲静音检测窗口时长，单位：秒')
     parser.add_argument('-tp', '--tail_thres_pct', type=float, default=10, help='尾音阈值百分位数，单位：％。以音频能量前“百分位数”的一定比例作为静音检测阈值')
@@ -53,14 +43,27 @@ def main():
     parser.add_argument('--lang', default='jaen', help='歌词语言')
     parser.add_argument('-f', '--txt_format', default='hrh', help='歌词文本格式')
     parser.add_argument('-cl', '--characters_per_line', type=int, default=0, help='输出文件每行最大字数')
+    parser.add_argument('-q', '--quantize', type=int, default=0, help='是否使用int8动态量化模型在CPU上推理，适用于无GPU的环境')
+    parser.add_argument('-qc', '--quant_check', type=int, default=0, help='是否仅在输入音频上对比fp32与int8推理的耗时及时间轴偏差')
+    parser.add_argument('-b', '--backend', default=os.environ.get('FA_KARA_MODEL_BACKEND', 'eager'), choices=['eager', 'script', 'compile'], help='模型执行模式。script/compile会编译模型并缓存编译结果，失败时自动退回eager')
+    parser.add_argument('-mp', '--model_path', default=os.environ.get('FA_KARA_MODEL_PATH'), help='本地模型权重文件路径（由align.py --export导出），指定时离线加载')
+    parser.add_argument('-sb', '--segment_batch', type=int, default=0, help='是否将各非静音片段组成批量推理，而非拼接为一段音频')
+    parser.add_argument('-hi', '--hierarchical', type=int, default=0, help='是否先定位各行歌词再逐行并行精细对齐，可加快长歌曲的对齐')
+    parser.add_argument('-ab', '--align_band', type=int, default=int(os.environ.get('FA_KARA_ALIGN_BAND', 0)), help='带状对齐的带宽（CTC状态数）。0表示完整网格对齐；带宽不足时自动退回完整对齐。结果是近似的，可能与完整对齐不同')
+    parser.add_argument('-inc', '--incremental', type=int, default=0, help='是否增量对齐：与上次运行保存的o_state.json比较，只重新对齐修改过的行')
+    parser.add_argument('-cs', '--chunk_seconds', type=float, default=0, help='分块推理的块长，单位：秒。0表示整段推理；长音频内存不足时可设为30左右以限制峰值内存')
     args = parser.parse_args()
 
     sokuon_split = args.sokuon_split
     hatsuon_split = args.hatsuon_split
     audio_speed = args.audio_speedx
+    speed_sweep = args.speed_sweep
+    stretch_method = args.stretch_method
     user_path = args.path_io
     user_audio_path = args.input_audio
     user_text_path = args.input_text
+    user_prior_path = args.input_prior
+    prior_pad = args.prior_pad
     tail_correct = args.tail_correct
     silent_window_s = args.tail_limit_window
     tail_thres_pct = args.tail_thres_pct
@@ -71,6 +74,15 @@ def main():
     lrc_language = args.lang.lower()
     txt_format = args.txt_format.lower()
     output_characters_per_line = args.characters_per_line
+    chunk_seconds = args.chunk_seconds
+    segment_batch = bool(args.segment_batch)
+    hierarchical = bool(args.hierarchical)
+    incremental = bool(args.incremental)
+    quantize = bool(args.quantize)
+    quant_check = bool(args.quant_check)
+    model_backend = args.backend
+    model_path = args.model_path
+    align_band = args.align_band
     
     real_io_path = os.path.normpath(user_path) if os.path.isabs(user_path) else os.path.normpath(os.path.join(script_dir, user_path))
     if not os.path.exists(real_io_path):
@@ -83,6 +95,14 @@ def main():
     else:
         input_audio_path = os.path.normpath(os.path.join(real_io_path, 'i.mp3'))
 
+    thread_config = runtime.apply_thread_budget(runtime.load_thread_config())
+    align_workers = thread_config['threads_per_job']
+    model_manager = align.get_model_manager()
+    model_manager.backend = model_backend
+    model_manager.weights_path = model_path
+    model_manager.set_align_band(align_band)
+    model_manager.warm_up(background=True, quantized=quantize) # 分析歌词的同时加载模型
+
     print('Loading files...')
     result_list = []
     with open(input_text_path, 'r', encoding='utf-8') as file:
@@ -99,40 +119,20 @@ def main():
     if result_list[-1]['orig']!='\n':
         result_list.append({'orig': '\n', 'type': 0, 'pron': ''})
 
-    if tail_correct == 1:
-        for i in range(len(result_list)):
-            if result_list[i]['type']==0:
-                try:
-                    if result_list[i-1].get('pron') and result_list[i-1]['type']!=0:
-                        pre_vowel = result_list[i-1]['pron'][-1]
-                        post_consonant = ''
-                        if i < len(result_list)-1:
-                            post_i = i + 1
-                            while post_i < len(result_list):
-                                if 'pron' in result_list[post_i] and len(result_list[post_i]['pron'])>=1:
-                                    post_consonant = result_list[post_i]['pron'][0]
-                                    break
-                                else:
-                                    post_i += 1
-                        if pre_vowel!=post_consonant and post_consonant not in ('a', 'e', 'i', 'o', 'u'):
-                            result_list[i]['pron'] = pre_vowel + 'h'
-                except:
-                    continue
-    elif tail_correct == 2:
-        for i in range(len(result_list)):
-            if result_list[i]['type']==0:
-                try: # 合理利用baseline尾音特性
-                    if len(result_list[i-1]['pron'])>=1 and result_list[i-1]['type']!=0:
-                        result_list[i]['pron'] = result_list[i-1]['pron'][-1] + 'h'
-                except:
-                    continue
+    table = TokenTable.from_dicts(result_list) # 之后各步骤都在token表上进行
+    timing.tail_pron_correct(table, tail_correct)
 
     alignment_tokens = []
-    token_to_index_map = {}
-    for i, item in enumerate(result_list):
-        if 'pron' in item and item['pron']:
-            alignment_tokens.append(item['pron'])
-            token_to_index_map[len(alignment_tokens) - 1] = i
+    token_lines = [] # 各token所在的行号，供分行两遍对齐使用
+    token_indices = [] # 各token在token表中的下标
+    line_index = 0
+    for i, (orig, type_, pron) in enumerate(zip(table.orig, table.type.tolist(), table.pron)):
+        if pron:
+            alignment_tokens.append(pron)
+            token_lines.append(line_index)
+            token_indices.append(i)
+        if type_ == 0 and orig == '\n':
+            line_index += 1
 
     for item in alignment_tokens:
         if hn.is_english(item):
@@ -143,84 +143,75 @@ def main():
     end_time = time.time()
     print("Lyrics text analysis executed in", round(end_time - start_time, 3), "seconds")
 
-    audio_file, sr = librosa.load(input_audio_path, sr=None) 
-    non_silent_ranges = non_silent_recog(audio_file, sr, silent_window_s, tail_thres_pct, tail_thres_ratio)
-
-    if audio_speed == 1:
-        print('Adding timelines...')
-        alignment_results = align.align_audio_with_text(audio_file, alignment_tokens, non_silent_ranges, sr)
+    # 一次解码为16kHz单声道，静音检测在解码的同时进行，与对齐共用同一份音频
+    # tail_correct=3时同时得到细分辨率的片段，两种分辨率共用一次能量计算
+    frame_seconds = (silent_window_s, silence.FINE_FRAME_SECOND) if tail_correct == 3 else (silent_window_s,)
+    detector = silence.StreamingSilenceDetector(audioproc.MODEL_SAMPLE_RATE, frame_seconds, tail_thres_pct, tail_thres_ratio)
+    audio_file, sr = audioproc.load_audio(input_audio_path, on_block=detector.feed)
+    non_silent_ranges, *fine_ranges = detector.finalize()
+    audio_hash = npycache.hash_array(audio_file)
+    line_windows = None
+    if user_prior_path:
+        with open(os.path.normpath(os.path.join(real_io_path, user_prior_path)), 'r', encoding='utf-8') as f:
+            timings = priors.parse_timings(f.read())
+        line_windows = priors.line_windows(timings, sorted(set(token_lines)), len(audio_file) / sr, prior_pad)
+
+    if quant_check:
+        print('Checking int8 quantization drift...')
+        align.quantization_drift_check(audio_file, alignment_tokens, non_silent_ranges, sr)
+        return
+
+    state_path = os.path.join(real_io_path, 'o_state.json')
+    if speed_sweep:
+        speeds = [float(speed) for speed in speed_sweep.split(',') if speed.strip()]
+        print('Sweeping audio speeds...')
+        sweep_workers = min(len(speeds), len(runtime.available_cpus()))
+        audio_speed, alignment, _ = align.speed_sweep(audio_file, sr, alignment_tokens, speeds, non_silent_ranges, sweep_workers, max(align_workers // sweep_workers, 1), chunk_seconds, audio_hash, quantize, segment_batch, stretch_method)
+        print(f'Best audio speed: x{audio_speed}')
+        align_sr, align_hash = audioproc.stretched_identity(audio_hash, sr, audio_speed, stretch_method)
     else:
-        print('Changing the audio speed...')
+        if audio_speed != 1:
+            print('Changing the audio speed...')
         start_time = time.time()
-        y_processed = librosa.effects.time_stretch(audio_file, rate=audio_speed)
-        end_time = time.time()
-        print("Audio speed changing executed in", round(end_time - start_time, 3), "seconds")
+        y_processed, align_sr, align_hash = audioproc.stretch_audio(audio_file, sr, audio_speed, stretch_method, audio_hash)
+        if audio_speed != 1:
+            end_time = time.time()
+            print("Audio speed changing executed in", round(end_time - start_time, 3), "seconds")
         print('Adding timelines...')
-        alignment_results = align.align_audio_with_text(y_processed, alignment_tokens, non_silent_ranges, sr, audio_speed)
-
-    for i, result in enumerate(alignment_results):
-        if i in token_to_index_map:
-            original_index = token_to_index_map[i]
-            result_list[original_index]['start'] = result['start']
-            result_list[original_index]['end'] = result['end']
-
-    result_list = non_silent_head_adjust(result_list, non_silent_ranges)
+        alignment = None
+        if incremental and os.path.exists(state_path):
+            with open(state_path, 'r', encoding='utf-8') as f:
+                previous_state = json.load(f)
+            alignment = align.align_incremental(previous_state, y_processed, alignment_tokens, token_lines, len(audio_file) / sr, non_silent_ranges, align_sr, audio_speed, chunk_seconds, audio_hash=align_hash, quantized=quantize, segment_batch=segment_batch, workers=align_workers)
+        if alignment is None:
+            alignment = align.align_audio_with_text(y_processed, alignment_tokens, non_silent_ranges, align_sr, audio_speed, chunk_seconds, as_arrays=True, audio_hash=align_hash, quantized=quantize, segment_batch=segment_batch, token_lines=token_lines if hierarchical or line_windows else None, workers=align_workers, line_windows=line_windows)
+    # 保存对齐结果（尾音等后处理之前），供下次增量对齐使用
+    alignment_state = align.alignment_state(alignment, token_lines, align.alignment_settings(align_hash, align_sr, audio_speed, non_silent_ranges, chunk_seconds, quantize, segment_batch))
+    if alignment_state is not None:
+        with open(state_path, 'w', encoding='utf-8') as f:
+            json.dump(alignment_state, f, ensure_ascii=False)
+
+    table.set_times(token_indices, align.to_centiseconds(alignment.starts, alignment.failed),
+                    align.to_centiseconds(alignment.ends, alignment.failed))
+
+    timing.non_silent_head_adjust(table, non_silent_ranges)
     
     if tail_correct == 3:
-        ns_small = non_silent_recog(audio_file, sr, .02, tail_thres_pct, tail_thres_ratio)
-        ns_ends = [int(np.ceil(ns_end * 100)) for _, ns_end in ns_small]
-        for i in range(len(result_list)-1):
-            if result_list[i]['type'] != 0 and result_list[i+1]['type'] == 0:
-                current_end = parse_time_to_hundredths(result_list[i]['end'])
-                next_ind = i + 2
-                next_start = np.inf
-                while next_ind < len(result_list):
-                    if 'start' in result_list[next_ind]:
-                        next_start = parse_time_to_hundredths(result_list[next_ind]['start'])
-                        break
-                    next_ind += 1
-                left_index = bisect.bisect_left(ns_ends, current_end)
-                right_index = bisect.bisect_left(ns_ends, next_start)
-                if left_index < right_index and left_index < len(ns_ends):
-                    result_list[i]['end'] = format_hundredths_to_time_str(ns_ends[left_index])
-                else:
-                    interval_covered = False # 检查非静音段是否覆盖整个区间
-                    for nss_start, nss_end in ns_small:
-                        if int(nss_start * 100) > current_end:
-                            break
-                        if int(nss_start * 100) <= current_end and int(np.ceil(nss_end * 100)) >= next_start:
-                            interval_covered = True
-                            break
-                    if interval_covered:
-                        result_list[i]['end'] = format_hundredths_to_time_str(max(next_start-2, current_end))
+        timing.tail_end_correct(table, fine_ranges[0])
     
     if output_characters_per_line > 0:
-        split_long_segments(result_list, max_length=output_characters_per_line)
-
-    main_output = process_main(result_list, ruby_tag_offset, bpm, beats_per_bar)
-    ruby_output = process_ruby(result_list)
-    content = f"{main_output}\n{ruby_output}"
-    with open(os.path.join(real_io_path, 'o_ruby.lrc'), 'w', encoding='utf-8') as f:
-        f.write(content)
-    rlf_output = process_rlf(result_list)
-    with open(os.path.join(real_io_path, 'o_rlf.lrc'), 'w', encoding='utf-8') as f:
-        f.write(rlf_output)
-    ass_output = norm2ass.process_norm2assV2(result_list)
-    ass_head = '''[Script Info]
-ScriptType: v4.00+
-YCbCr Matrix: TV.601
-PlayResX: 1920
-PlayResY: 1080
-
-[V4+ Styles]
-Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, BackColour, Bold, Italic, Underline, StrikeOut, ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, Shadow, Alignment, MarginL, MarginR, MarginV, Encoding
-Style: Default,Source Han Serif,71,&H00FFFFFF,&H000000FF,&H00000000,&H00000000,0,0,0,0,100,100,0,0,1,1.99999,1.99999,2,11,11,101,1
-
-[Events]
-Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
-'''
-    with open(os.path.join(real_io_path, 'o.ass'), 'w', encoding='utf-8') as f:
-        f.write(ass_head+ass_output)
+        split_long_segments(table, max_length=output_characters_per_line)
+
+    # 遍历一次token表，同时写出各格式
+    with open(os.path.join(real_io_path, 'o_ruby.lrc'), 'w', encoding='utf-8') as ruby_file, \
+         open(os.path.join(real_io_path, 'o_rlf.lrc'), 'w', encoding='utf-8') as rlf_file, \
+         open(os.path.join(real_io_path, 'o.ass'), 'w', encoding='utf-8') as ass_file:
+        emitter.emit(table, [
+            LrcSink(ruby_file, ruby_tag_offset, bpm, beats_per_bar),
+            RubySink(ruby_file, prefix='\n'),
+            RlfSink(rlf_file),
+            norm2ass.AssSink(ass_file, head=norm2ass.ASS_HEAD),
+        ])
     # hrhlrc_output = ''
     # for i in ass_output.splitlines():
     #     hrhlrc_output += ass2lrc.ass2lrc(i, 0)+'\n'
@@ -1,9 +1,26 @@
 import re
 
+from emitter import TokenSink, emit
+from tokens import NO_TIME, as_table, checked_cs
+
 newnums = ['①', '②', '③', '④', '⑤', '⑥', '⑦', '⑧', '⑨', '⑩',
            '⑪', '⑫', '⑬', '⑭', '⑮', '⑯', '⑰', '⑱', '⑲', '⑳',
            '㉑', '㉒', '㉓', '㉔', '㉕', '㉖', '㉗', '㉘', '㉙', '㉚']
 
+ASS_HEAD = '''[Script Info]
+ScriptType: v4.00+
+YCbCr Matrix: TV.601
+PlayResX: 1920
+PlayResY: 1080
+
+[V4+ Styles]
+Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, BackColour, Bold, Italic, Underline, StrikeOut, ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, Shadow, Alignment, MarginL, MarginR, MarginV, Encoding
+Style: Default,Source Han Serif,71,&H00FFFFFF,&H000000FF,&H00000000,&H00000000,0,0,0,0,100,100,0,0,1,1.99999,1.99999,2,11,11,101,1
+
+[Events]
+Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
+'''
+
 def int2asstime(cs: int) -> str:
     '厘秒整数转换为.ass时轴信息'
     hours = cs // 360000
@@ -51,73 +68,86 @@ def process_norm2assV1(struc, pretime = 20, posttime = 20):
             nowtime = parse_time_to_hundredths(item['end'])
     return result
 
-def process_norm2assV2(struc, pretime = 20, posttime = 20):
-    '仿NicokaraMaker.lrc时值'
-    result = ''
-    starttime = nowtime = None
-    asstxt = ''
-    i = 0
-    while i < len(struc):
-        item = struc[i]
-        if not starttime:
-            try:
-                starttime = parse_time_to_hundredths(item['start']) - pretime
-                nowtime = parse_time_to_hundredths(item['start'])
-            except:
-                asstxt += item['orig']
-                i += 1
-                continue
-        if item['type'] == 0 and item['orig'] == '\n':
-            try:
-                nowtime = parse_time_to_hundredths(item['start'])
-            except:
-                pass
-            finally:
-                endtime = nowtime + posttime
-                if asstxt:
-                    if asstxt[0] not in ['{'] + newnums: 
-                        asstxt = r'{\k0}' + asstxt
-                    if asstxt[0] in newnums and asstxt[1] != '{':
-                        asstxt = asstxt[0] + r'{\k0}' + asstxt[1:]
-                result += 'Dialogue: 0,'+int2asstime(starttime)+','+int2asstime(endtime)+r',Default,,0,0,0,karaoke,' \
-                    +r'{\k'+str(pretime)+'}'+asstxt+r'{\k'+str(posttime)+'}'+'\n'
-                starttime = nowtime = None
-                asstxt = ''
-        elif item['type'] == 0 and 'start' not in item:
-            if struc[i-1].get('type') in (1,3,4) and item.get('orig') not in [' ','　']+newnums:
-                asstxt += item['orig']
-            # elif struc[i-1].get('type') == 2 and item.get('orig') not in [' ','　']+newnums:
-            #     asstxt += r'{\k0}' + item['orig']
+class AssSink(TokenSink):
+    '仿NicokaraMaker.lrc时值的ASS字幕，head为文件头，每行结束时写出一条Dialogue'
+    def __init__(self, out=None, pretime = 20, posttime = 20, head = ''):
+        super().__init__(out)
+        self.pretime = pretime
+        self.posttime = posttime
+        self.head = head
+
+    def begin(self, columns):
+        super().begin(columns)
+        self.write(self.head)
+        self.starttime = self.nowtime = None
+        self.asstxt = [] # 当前行的各部分
+        self.zero_str = None # 正在合并的无时间文字，合并到下一个有时间的token或行尾为止
+
+    def _zero_step(self, i):
+        '无时间文字之后是行尾或有时间的token时结束合并'
+        c = self.columns
+        if c.orig[i+1] == '\n':
+            item_kdur = 0
+        elif c.start[i+1] != NO_TIME:
+            if self.nowtime:
+                item_kdur = checked_cs(c.start[i+1]) - self.nowtime
             else:
-                zero_str = item.get('orig')
-                while True:
-                    if struc[i+1].get('orig') == '\n':
-                        item_kdur = 0
-                        break
-                    if struc[i+1].get('start'):
-                        if nowtime:
-                            item_kdur = parse_time_to_hundredths(struc[i+1]['start']) - nowtime
-                        else:
-                            item_kdur = 0
-                        nowtime = parse_time_to_hundredths(struc[i+1]['start'])
-                        break
-                    zero_str += struc[i+1].get('orig')
-                    i += 1
-                asstxt += r'{\k'+str(item_kdur)+'}' + zero_str
+                item_kdur = 0
+            self.nowtime = checked_cs(c.start[i+1])
         else:
-            if struc[i+1].get('start'):
-                item_kdur = parse_time_to_hundredths(struc[i+1]['start']) - parse_time_to_hundredths(item['start'])
-                nowtime = parse_time_to_hundredths(struc[i+1]['start'])
+            return
+        self.asstxt.append(r'{\k'+str(item_kdur)+'}' + self.zero_str)
+        self.zero_str = None
+
+    def token(self, i):
+        c = self.columns
+        orig, type_ = c.orig[i], c.type[i]
+        if self.zero_str is not None:
+            self.zero_str += orig
+            self._zero_step(i)
+            return
+        if not self.starttime:
+            if c.start[i] < 0: # 没有时间或对齐失败
+                self.asstxt.append(orig)
+                return
+            self.starttime = c.start[i] - self.pretime
+            self.nowtime = c.start[i]
+        if type_ == 0 and orig == '\n':
+            if c.start[i] >= 0:
+                self.nowtime = c.start[i]
+            endtime = self.nowtime + self.posttime
+            asstxt = ''.join(self.asstxt)
+            if asstxt:
+                if asstxt[0] not in ['{'] + newnums: 
+                    asstxt = r'{\k0}' + asstxt
+                if asstxt[0] in newnums and asstxt[1] != '{':
+                    asstxt = asstxt[0] + r'{\k0}' + asstxt[1:]
+            self.write('Dialogue: 0,'+int2asstime(self.starttime)+','+int2asstime(endtime)+r',Default,,0,0,0,karaoke,' \
+                +r'{\k'+str(self.pretime)+'}'+asstxt+r'{\k'+str(self.posttime)+'}'+'\n')
+            self.starttime = self.nowtime = None
+            self.asstxt = []
+        elif type_ == 0 and c.start[i] == NO_TIME:
+            if c.type[i-1] in (1,3,4) and orig not in [' ','　']+newnums:
+                self.asstxt.append(orig)
             else:
-                item_kdur = parse_time_to_hundredths(item['end']) - parse_time_to_hundredths(item['start'])
-                nowtime = parse_time_to_hundredths(item['end'])
-            asstxt += r'{\k'+str(item_kdur)+'}'
-            if item['type'] == 2:
-                asstxt += ('#|' if item['orig']=='' else item['orig'] + '|<') + item['ruby']
+                self.zero_str = orig
+                self._zero_step(i)
+        else:
+            if c.start[i+1] != NO_TIME:
+                item_kdur = checked_cs(c.start[i+1]) - checked_cs(c.start[i])
+                self.nowtime = checked_cs(c.start[i+1])
             else:
-                asstxt += item['orig']
-        i += 1
-    return result
+                item_kdur = checked_cs(c.end[i]) - checked_cs(c.start[i])
+                self.nowtime = checked_cs(c.end[i])
+            self.asstxt.append(r'{\k'+str(item_kdur)+'}')
+            if type_ == 2:
+                self.asstxt.append(('#|' if orig=='' else orig + '|<') + c.ruby[i])
+            else:
+                self.asstxt.append(orig)
+
+def process_norm2assV2(tokens, pretime = 20, posttime = 20):
+    '仿NicokaraMaker.lrc时值，tokens为TokenTable或字典列表'
+    return emit(as_table(tokens), [AssSink(None, pretime, posttime)])[0].getvalue()
 
 
 if __name__=='__main__':
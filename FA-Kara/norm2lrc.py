@@ -1,30 +1,22 @@
-import numpy as np
-import re
+import functools
 import unicodedata
 
-def parse_time_to_hundredths(time_str):
-    match = re.match(r'\[(\d{2}):(\d{2}):(\d{2})\]', time_str)
-    minutes, seconds, hundredths = int(match.group(1)), int(match.group(2)), int(match.group(3))
-    return minutes * 6000 + seconds * 100 + hundredths
+from emitter import TokenSink, emit
+from tokens import (NO_TIME, as_table, checked_cs, format_cs,
+                    format_hundredths_to_time_str, parse_time_to_hundredths)
 
-def format_hundredths_to_time_str(total_hundredths):
-    minutes = total_hundredths // 6000
-    remaining = total_hundredths % 6000
-    seconds = remaining // 100
-    hundredths = remaining % 100
-    return f"[{minutes:02d}:{seconds:02d}:{hundredths:02d}]"
+@functools.lru_cache(maxsize=None)
+def char_width(char):
+    "单个字符的显示宽度，全角为1，半角为0.5；结果缓存，每种字符只查询一次"
+    return 1.0 if unicodedata.east_asian_width(char) in ('F', 'W', 'A') else 0.5
 
 def calculate_length(surface):
     "结合全半角计算字符串的长度"
-    length = 0.0
-    for char in surface:
-        if unicodedata.east_asian_width(char) in ('F', 'W', 'A'):
-            length += 1
-        else:
-            length += 0.5
-    return length
+    return sum(map(char_width, surface), 0.0)
+
+COUNTDOWN_SYMBOL = '●' # 导唱指示灯的符号
 
-def countdown_str_forward(starttime, bpm=60, num=4, symbol='●'):
+def countdown_str_forward(starttime, bpm=60, num=4, symbol=COUNTDOWN_SYMBOL):
     t = 6000 / bpm
     if isinstance(starttime, str):
         starttime = parse_time_to_hundredths(starttime)
@@ -33,227 +25,264 @@ def countdown_str_forward(starttime, bpm=60, num=4, symbol='●'):
         result = format_hundredths_to_time_str(round(max(starttime-i*t,0))) + symbol + result
     return result
 
-def non_silent_head_adjust(result_list, non_silent_ranges):
-    '保证乐句完全位于同一个非静音区间'
-    if not non_silent_ranges:
-        return result_list
-    else:
-        i = si = 0
-        sentences_list = []
-        st = None
-        while i < len(result_list):
-            if result_list[i].get('type') == 0:
-                if st:
-                    sentences_list.append((si, i-1, st, result_list[i-1].get('end')))
-                    st = None
-            elif not st:
-                si = i
-                st = result_list[i].get('start')
-            i += 1
-        for inds, inde, sst, sen in sentences_list:
-            sst = parse_time_to_hundredths(sst)
-            sen = parse_time_to_hundredths(sen)
-            interval_covered = False
-            for ns_start, ns_end in non_silent_ranges:
-                if int(ns_start * 100) > sst:
-                    break
-                # 检查非静音段是否覆盖整个区间
-                if int(ns_start * 100) <= sst and int(np.ceil(ns_end * 100)) >= sen:
-                    interval_covered = True
-                    break
-            if not interval_covered:
-                end_covered = False
-                for i in range(len(non_silent_ranges)):
-                    ns_start = int(non_silent_ranges[i][0] * 100)
-                    ns_end = int(np.ceil(non_silent_ranges[i][1] * 100))
-                    if ns_start > sen:
-                        break
-                    if ns_start <= sen:
-                        if ns_end >= sen:
-                            end_covered = True
-                            adjust_target = ns_start
-                            break
-                    elif ns_start <= parse_time_to_hundredths(result_list[inde].get('start')) <= ns_end:
-                        end_covered = True
-                        adjust_target = ns_start
-                        break
-                if not end_covered:
-                    print('Errors ignored while trying to correct end sounds...')
-                    break
-                else:
-                    adjust_target = min(parse_time_to_hundredths(result_list[inds]['end']), adjust_target)
-                    result_list[inds]['start'] = format_hundredths_to_time_str(adjust_target)
-        return result_list
+NO_LINE_START = frozenset('ぁぃぅぇぉっゃゅょゎァィゥェォッャュョヮヵヶーゝゞヽヾ々') # 不宜出现在行首的字符
+
+def break_kind(surface, type_):
+    '''
+    token作为换行位置的方式：
+    'space': 除换行符外的各种空白（半角、全角空格等），替换为换行符；
+    'punct': 句读、感叹号、右括号等结尾的token（含英文单词后附带的标点），在其后插入换行符；
+    其余返回None。
+    '''
+    if type_ == 0 and surface != '\n' and surface.isspace():
+        return 'space'
+    if type_ in (0, 1) and surface and unicodedata.category(surface[-1]) in ('Po', 'Pe', 'Pf'):
+        return 'punct'
+    return None
+
+def can_cut_before(surface, type_, previous_type):
+    '''
+    没有空白与标点可用时的备选换行位置：两个文字token（英文单词、注音汉字、假名、数字与长音）之间，
+    注音汉字的后续假名（orig为空）与小写假名、长音符等之前除外。
+    '''
+    return (previous_type in (1, 2, 3, 4) and type_ in (1, 2, 3, 4) and surface != ''
+            and surface[0] not in NO_LINE_START)
+
+def break_paragraph(candidates, total, max_length):
+    """
+    为一段文字选择换行位置。candidates为各候选的(下标, 之前的长度, 之后的长度, 罚分)，total为整段长度。
+    以动态规划求最优分行：优先使超长的总量最小，其次使备选换行位置的罚分之和最小，
+    最后使各行空余长度的平方和最小（各行长度尽量均匀）。
+    每行只考虑长度不超过max_length的上一个断点（另加紧邻其前、超长最少的一个），
+    每个候选最多检查约2*max_length个断点，整段为线性时间。
+    返回被选中的候选在candidates中的序号列表。
+    """
+    # 节点0为段首，之后为各候选，最后为段尾
+    befores = [0.0] + [candidate[1] for candidate in candidates] + [total]
+    afters = [0.0] + [candidate[2] for candidate in candidates]
+    penalties = [candidate[3] for candidate in candidates] + [0]
+    costs = [(0.0, 0, 0.0)]
+    prevs = [None]
+    low = 0 # 与当前节点之间长度不超过max_length的最早节点
+    for j in range(1, len(befores)):
+        while low < j and befores[j] - afters[low] > max_length:
+            low += 1
+        best, best_prev = None, None
+        for p in range(max(low - 1, 0), j):
+            width = befores[j] - afters[p]
+            overflow, penalty, slack = costs[p]
+            penalty += penalties[j - 1]
+            if width > max_length:
+                cost = (overflow + width - max_length, penalty, slack)
+            else:
+                cost = (overflow, penalty, slack + (max_length - width) ** 2)
+            if best is None or cost < best:
+                best, best_prev = cost, p
+        costs.append(best)
+        prevs.append(best_prev)
+    breaks = []
+    node = prevs[-1]
+    while node:
+        breaks.append(node - 1)
+        node = prevs[node]
+    return breaks[::-1]
 
 def split_long_segments(elements, max_length=20):
     """
-    处理元素列表，确保每两个换行符之间的长度不超过max_length；
-    如果超过，则寻找最合适的空格替换为换行符。
-    会直接replace!
+    处理TokenTable，确保每两个换行符之间的长度尽量不超过max_length；
+    如果超过，则选择若干空白替换为换行符、或在标点之后插入换行符，使各行长度尽量均匀；
+    一行中没有空白与标点可用时，才在两个文字token之间插入换行符。
+    会直接修改elements!
     """
+    types = elements.type.tolist()
+    origs = elements.orig
     current_length = 0.0
-    space_positions = [] # 记录空格位置、该位置前的长度
-    i = 0
-    while i <= len(elements):
-        if i == len(elements) or elements[i].get('type') == 0 and elements[i].get('orig') == '\n':
-            if current_length > max_length and space_positions:
-                # 寻找最能均匀分割行文本的空格
-                n_cuts = current_length // max_length + 1
-                n_cut_length = current_length / n_cuts
-                sorted_spaces = sorted(space_positions, key=lambda x: (
-                    0 if x[1] <= max_length else 1,
-                    abs(x[1] - n_cut_length) if x[1] <= max_length else -x[1]
-                ))
-                best_position = sorted_spaces[0][0]
-                elements[best_position]['orig'] = '\n'
-
-                i = best_position # 从分割点之后开始
-                current_length = 0.0
-                space_positions = []
-            else:
-                current_length = 0.0
-                space_positions = []
-        
-        elif i < len(elements):
-            elem = elements[i]
-            surface = elem.get('orig')
-            elem_length = calculate_length(surface)
-            if surface in (' ', '　') and elem.get('type') == 0:
-                space_positions.append((i, current_length))
+    candidates = [] # 记录候选位置、该位置前后的长度、罚分，以及是否替换该token
+    replaced, inserted = [], [] # 替换为换行符的下标，在其前插入换行符的下标
+    for i in range(len(origs) + 1):
+        if i == len(origs) or types[i] == 0 and origs[i] == '\n':
+            if current_length > max_length and candidates:
+                for chosen in break_paragraph([candidate[:4] for candidate in candidates], current_length, max_length):
+                    position, _, _, _, replace = candidates[chosen]
+                    (replaced if replace else inserted).append(position)
+            current_length = 0.0
+            candidates = []
+        else:
+            elem_length = calculate_length(origs[i])
+            kind = break_kind(origs[i], types[i])
+            if current_length and can_cut_before(origs[i], types[i], types[i - 1]) \
+                    and break_kind(origs[i - 1], types[i - 1]) is None:
+                candidates.append((i, current_length, current_length, 1, False))
             current_length += elem_length
-        i += 1
+            if kind == 'space':
+                candidates.append((i, current_length - elem_length, current_length, 0, True))
+            elif kind == 'punct' and i + 1 < len(origs) and not (types[i + 1] == 0 and (origs[i + 1] == '\n'
+                    or break_kind(origs[i + 1], types[i + 1]))): # 其后紧跟的空白或标点另有候选
+                candidates.append((i + 1, current_length, current_length, 0, False))
+    for position in replaced:
+        origs[position] = '\n'
+    if inserted:
+        elements.insert_line_breaks(inserted)
+
+class LrcSink(TokenSink):
+    '逐字时间轴的LRC正文，每行结束时写出'
+    def __init__(self, out=None, tag_offset=-150, bpm=60, beats_per_bar=3):
+        super().__init__(out)
+        self.tag_offset = tag_offset
+        self.bpm = bpm
+        self.beats_per_bar = beats_per_bar
 
-def process_main(result_list, tag_offset=-150, bpm=60, beats_per_bar=3):
-    result = []
-    current_line = ""
-    last_end = None
-    last_end_time = None
+    def begin(self, columns):
+        super().begin(columns)
+        self.line = [] # 当前行的各部分
+        self.last_end = None
+        self.last_end_cs = None
+        self.last_end_time = None
 
-    i = 0
-    while i < len(result_list):
-        item = result_list[i]
+    def _append(self, text):
+        if text:
+            self.line.append(text)
 
-        if ('start' in item and current_line == "" and item['type'] in [1, 2, 3, 4]):
-            current_start_time = parse_time_to_hundredths(item['start'])
+    def _write_line(self):
+        self.write("".join(self.line))
+        self.line = []
 
+    def token(self, i):
+        c = self.columns
+        orig, type_, start = c.orig[i], c.type[i], c.start[i]
+        has_start = start != NO_TIME
+
+        if (has_start and not self.line and type_ in [1, 2, 3, 4]):
+            current_start_time = checked_cs(start)
+            bpm, beats_per_bar, last_end_time = self.bpm, self.beats_per_bar, self.last_end_time
             if bpm>0 and ((last_end_time and current_start_time - last_end_time > 6000/bpm*beats_per_bar+400) or
                 (last_end_time is None and current_start_time > 6000/bpm*beats_per_bar+100)):
-                current_line += countdown_str_forward(current_start_time, bpm, beats_per_bar)
+                self._append(countdown_str_forward(current_start_time, bpm, beats_per_bar))
 
-        if item['type'] in [1, 3, 4] or item['type'] == 0 and item['orig']!='\n' and 'start' in item:
-            current_line += f"{item['start']}{item['orig']}"
-            last_end = item['end']
-        elif item['type'] == 2:
-            if item['orig'] != '':
-                current_line += f"{item['start']}{item['orig']}"
-            last_end = item['end']
-        elif item['type'] == 0 and item['orig']!='\n' and 'start' not in item:
-            if last_end and item['orig'] in (' ', '　'):
-                current_line += last_end+item['orig']
-                last_end = None
+        if type_ in [1, 3, 4] or type_ == 0 and orig!='\n' and has_start:
+            self._append(f"{format_cs(start)}{orig}")
+            self.last_end, self.last_end_cs = format_cs(c.end[i]), c.end[i]
+        elif type_ == 2:
+            if orig != '':
+                self._append(f"{format_cs(start)}{orig}")
+            self.last_end, self.last_end_cs = format_cs(c.end[i]), c.end[i]
+        elif type_ == 0 and orig!='\n' and not has_start:
+            if self.last_end and orig in (' ', '　'):
+                self._append(self.last_end+orig)
+                self.last_end = None
             else:
-                current_line += item['orig']
-        elif item['type'] == 0 and item['orig']=='\n' and 'start' not in item:
-            if 'start' in item:
-                current_line += item['start']+item['orig']
-                result.append(current_line)
-                last_end_time = parse_time_to_hundredths(last_end)
-                current_line = ""
-                last_end = None
-            elif last_end:
-                current_line += last_end+item['orig']
-                result.append(current_line)
-                last_end_time = parse_time_to_hundredths(last_end)
-                current_line = ""
-                last_end = None
+                self._append(orig)
+        elif type_ == 0 and orig=='\n' and not has_start:
+            if self.last_end:
+                self._append(self.last_end+orig)
+                self._write_line()
+                self.last_end_time = checked_cs(self.last_end_cs)
+                self.last_end = None
             else:
-                current_line += item['orig']
-            
-        i += 1
-
-    if last_end:
-        current_line += last_end
-    result.append(current_line)
-    if item['orig']!='\n':
-        result.append("\n")
-    result.append("\n@Offset="+str(tag_offset))
-    return "".join(result)
+                self._append(orig)
 
-def process_ruby(result_list):
-    ruby_annotations = []
-    i = 0
+    def finish(self):
+        if self.last_end:
+            self._append(self.last_end)
+        self._write_line()
+        if self.columns.orig[-1]!='\n':
+            self.write("\n")
+        self.write("\n@Offset="+str(self.tag_offset))
 
-    while i < len(result_list):
-        item = result_list[i]
+class RubySink(TokenSink):
+    '''
+    LRC末尾的@Ruby注音定义。汉字及其后的空字注音组成一组，
+    同一汉字再次出现时将上一组的结束时间设为该处的开始时间（以字典记录各汉字最近的一组）。
+    '''
+    def __init__(self, out=None, prefix=''):
+        super().__init__(out)
+        self.prefix = prefix # 写在注音定义之前，与正文写入同一文件时用作分隔
 
-        if item['type'] == 2 and item['orig'] != '':
-            ruby1 = item['orig']
-            ruby2 = item['ruby']
-            ruby3 = item['start']
-            ruby4 = ''
+    def begin(self, columns):
+        super().begin(columns)
+        self.annotations = [] # [ruby1, ruby2各部分, ruby3, ruby4]
+        self.latest = {} # 汉字: 最近一组的下标
+        self.group_start = None # 当前组的开始时间，不在组内时为None
 
-            first_start_time = parse_time_to_hundredths(item['start'])
+    def token(self, i):
+        c = self.columns
+        if c.type[i] == 2 and c.orig[i] != '':
+            ruby3 = format_cs(c.start[i])
+            self.group_start = checked_cs(c.start[i])
+            previous = self.latest.get(c.orig[i])
+            if previous is not None:
+                self.annotations[previous][3] = ruby3
+            self.latest[c.orig[i]] = len(self.annotations)
+            self.annotations.append([c.orig[i], [c.ruby[i]], ruby3, ''])
+        elif self.group_start is not None and c.type[i] == 2 and c.orig[i] == '':
+            time_diff = checked_cs(c.start[i]) - self.group_start
+            self.annotations[-1][1].append(f"{format_hundredths_to_time_str(time_diff)}{c.ruby[i]}")
+        else:
+            self.group_start = None
 
-            j = i + 1
-            while j < len(result_list) and result_list[j]['type'] == 2 and result_list[j]['orig'] == '':
-                current_item = result_list[j]
-                current_start_time = parse_time_to_hundredths(current_item['start'])
-                time_diff = current_start_time - first_start_time
-                time_diff_str = format_hundredths_to_time_str(time_diff)
-                ruby2 += f"{time_diff_str}{current_item['ruby']}"
-                j += 1
+    def finish(self):
+        self.write(self.prefix)
+        self.write("\n".join(f"@Ruby{idx}={ruby1},{''.join(ruby2)},{ruby3},{ruby4}"
+                             for idx, (ruby1, ruby2, ruby3, ruby4) in enumerate(self.annotations, 1)))
 
-            for k in range(len(ruby_annotations) - 1, -1, -1):
-                if ruby_annotations[k]['ruby1'] == ruby1:
-                    ruby_annotations[k]['ruby4'] = item['start']
-                    break
+class RlfSink(TokenSink):
+    'RLF格式，汉字及其后的空字注音合并为一组，组结束时写出'
+    def begin(self, columns):
+        super().begin(columns)
+        self.last_end = None
+        self.written = False
+        self.group = None # 当前组：[汉字, 注音数, 注音结构各部分, 最后一个注音的下标]
 
-            ruby_annotations.append({'ruby1': ruby1, 'ruby2': ruby2, 'ruby3': ruby3, 'ruby4': ruby4})
-            i = j
-        else:
-            i += 1
+    def write(self, text):
+        if text:
+            super().write(text)
+            self.written = True
 
-    result = []
-    for idx, annotation in enumerate(ruby_annotations, 1):
-        result.append(f"@Ruby{idx}={annotation['ruby1']},{annotation['ruby2']},{annotation['ruby3']},{annotation['ruby4']}")
+    def _close_group(self):
+        kanji_surf, kana_cnt, struc_str, last = self.group
+        kana_cnt = 9 if kana_cnt>9 else kana_cnt
+        self.write('{'+kanji_surf+'|['+str(kana_cnt)+'|'+''.join(struc_str)+'}')
+        self.last_end = format_cs(self.columns.end[last])
+        self.group = None
 
-    return "\n".join(result)
+    def token(self, i):
+        c = self.columns
+        orig, type_, has_start = c.orig[i], c.type[i], c.start[i] != NO_TIME
+        if self.group is not None:
+            if type_ == 2 and orig == '':
+                self.group[1] += 1
+                self.group[2].append(f"[{format_cs(c.start[i])[1:-1]}]{c.ruby[i]}")
+                self.group[3] = i
+                return
+            self._close_group()
 
-def process_rlf(result_list):
-    current_line = ""
-    last_end = None
+        if type_ in [1, 3, 4] or type_ == 0 and has_start and orig not in ('\n', '', ' ', '　'):
+            self.write(f"[1|{format_cs(c.start[i])[1:-1]}]{orig}")
+            self.last_end = format_cs(c.end[i])
+        elif type_ == 2: # 不考虑加号
+            assert orig != '', "空字符有注音，rlf生成失败！"
+            self.group = [orig, 1, [f"{format_cs(c.start[i])[1:-1]}]{c.ruby[i]}"], i]
+        elif type_ == 0 and has_start:
+            self.write(f"[10|{format_cs(c.start[i])[1:-1]}]{orig}")
+            self.last_end = None
+        elif type_ == 0 and not has_start:
+            if self.last_end and orig in ('\n', '', ' ', '　'):
+                self.write(f"[10|{self.last_end[1:-1]}]{orig}")
+                self.last_end = None
+            else:
+                self.write(orig)
 
-    i = 0
-    while i < len(result_list):
-        item = result_list[i]
+    def finish(self):
+        if self.group is not None:
+            self._close_group()
+        if self.written and self.last_end:
+            self.write(self.last_end)
 
-        if item['type'] in [1, 3, 4] or item['type'] == 0 and 'start' in item and item['orig'] not in ('\n', '', ' ', '　'):
-            current_line += f"[1|{item['start'][1:-1]}]{item['orig']}"
-            last_end = item['end']
-        elif item['type'] == 2: # 不考虑加号
-            assert item['orig'] != '', "空字符有注音，rlf生成失败！"
-            kana_cnt = 1
-            kanji_surf = item['orig']
-            struc_str = f"{item['start'][1:-1]}]{item['ruby']}"
-            while result_list[i+1]['type'] == 2 and result_list[i+1]['orig'] == '':
-                i += 1
-                kana_cnt += 1
-                struc_str += f"[{result_list[i]['start'][1:-1]}]{result_list[i]['ruby']}"
-            kana_cnt = 9 if kana_cnt>9 else kana_cnt
-            current_line += '{'+kanji_surf+'|['+str(kana_cnt)+'|'+struc_str+'}'
-            last_end = result_list[i]['end']
-        elif item['type'] == 0 and 'start' in item:
-            current_line += f"[10|{item['start'][1:-1]}]{item['orig']}"
-            last_end = None
-        elif item['type'] == 0 and 'start' not in item:
-            if last_end and item['orig'] in ('\n', '', ' ', '　'):
-                current_line += f"[10|{last_end[1:-1]}]{item['orig']}"
-                last_end = None
-            else:
-                current_line += item['orig']
+def process_main(tokens, tag_offset=-150, bpm=60, beats_per_bar=3):
+    return emit(as_table(tokens), [LrcSink(None, tag_offset, bpm, beats_per_bar)])[0].getvalue()
 
-        i += 1
+def process_ruby(tokens):
+    return emit(as_table(tokens), [RubySink()])[0].getvalue()
 
-    if current_line and last_end:
-        current_line += last_end
-    return current_line
\ No newline at end of file
+def process_rlf(tokens):
+    return emit(as_table(tokens), [RlfSink()])[0].getvalue()
@@ -0,0 +1,115 @@
+import hashlib
+import os
+import threading
+import numpy as np
+
+def default_cache_dir():
+    '缓存根目录，可用环境变量FA_KARA_CACHE_DIR指定'
+    return os.environ.get('FA_KARA_CACHE_DIR') or os.path.join(os.path.expanduser('~'), '.cache', 'fa-kara')
+
+def hash_array(array):
+    '计算数组内容的哈希值'
+    array = np.ascontiguousarray(array)
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(str((array.dtype.str, array.shape)).encode())
+    digest.update(memoryview(array).cast('B'))
+    return digest.hexdigest()
+
+def hash_file(path, block_size=1 << 20):
+    '计算文件内容的哈希值'
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def make_key(*parts):
+    '由若干部分生成缓存键'
+    return hashlib.blake2b(repr(parts).encode('utf-8'), digest_size=16).hexdigest()
+
+class NpyCache:
+    '''
+    以.npy文件保存数组的磁盘缓存。
+    读取时以内存映射方式打开，总大小超过配额时按最近使用时间淘汰。
+    缓存目录无法创建或读写时只打印警告，读取视为未命中、写入直接跳过，不影响调用者。
+    '''
+    def __init__(self, directory, quota_mb=2048, dtype=None):
+        self.directory = directory
+        self.quota_bytes = int(quota_mb * 2**20)
+        self.dtype = dtype # 指定时以该类型存储，如np.float16
+        self._lock = threading.Lock()
+        self.available = True
+        try:
+            os.makedirs(directory, exist_ok=True)
+        except OSError as e:
+            print(f'Cache directory unavailable, caching disabled: {e}')
+            self.available = False
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.npy')
+
+    def get(self, key, mmap_mode='r'):
+        '命中时返回内存映射数组（缺省只读，mmap_mode为c时写入不影响缓存文件），否则返回None'
+        if not self.available:
+            return None
+        path = self._path(key)
+        try:
+            array = np.load(path, mmap_mode=mmap_mode)
+        except (OSError, ValueError):
+            return None
+        try:
+            os.utime(path) # 更新最近使用时间
+        except OSError:
+            pass
+        return array
+
+    def put(self, key, array, dtype=None):
+        '写入数组，dtype缺省时使用缓存的默认存储类型'
+        if not self.available:
+            return
+        array = np.asarray(array)
+        dtype = dtype or self.dtype
+        if dtype is not None:
+            array = array.astype(dtype)
+        path = self._path(key)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                np.save(f, array)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f'Failed to write cache: {e}')
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+        self.evict()
+
+    def evict(self):
+        '总大小超过配额时删除最久未使用的文件'
+        if self.quota_bytes <= 0:
+            return
+        with self._lock:
+            entries = []
+            try:
+                names = os.listdir(self.directory)
+            except OSError:
+                return
+            for name in names:
+                if not name.endswith('.npy'):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+            total = sum(size for _, size, _ in entries)
+            for _, size, name in sorted(entries):
+                if total <= self.quota_bytes:
+                    break
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    continue
+                total -= size
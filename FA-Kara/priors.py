@@ -0,0 +1,66 @@
+import re
+
+from ass2lrc import ass_time_to_cs
+from norm2lrc import COUNTDOWN_SYMBOL
+
+LRC_TIME_PATTERN = re.compile(r'\[(\d+):(\d{2})[:.](\d{2})\d?\]')
+
+def parse_lrc_timings(lrc_txt):
+    '''
+    读取LRC中每个含歌词的行的时间范围（厘秒）。
+    兼容[mm:ss.cc]与本项目输出的[mm:ss:cc]格式，分钟数不限位数；以@开头的标签行（@Offset、@Ruby等）跳过。
+    开始时间为第一段歌词文字之前的时间戳（导唱指示灯的时间戳不计），结束时间为其后最晚的时间戳；
+    只有行首时间戳时结束时间记为None。
+    '''
+    timings = []
+    for line in lrc_txt.splitlines():
+        if line.lstrip().startswith('@'):
+            continue
+        matches = list(LRC_TIME_PATTERN.finditer(line))
+        stamps = [int(m) * 6000 + int(s) * 100 + int(cs) for m, s, cs in (match.groups() for match in matches)]
+        first = None
+        for i, match in enumerate(matches):
+            text = line[match.end():matches[i + 1].start() if i + 1 < len(matches) else len(line)]
+            if text.strip().strip(COUNTDOWN_SYMBOL):
+                first = i
+                break
+        if first is None:
+            continue
+        stamps = stamps[first:]
+        timings.append((stamps[0], max(stamps) if len(stamps) > 1 else None))
+    return timings
+
+def parse_ass_timings(ass_txt):
+    '读取ASS中各Dialogue行的时间范围（厘秒）'
+    timings = []
+    for line in ass_txt.splitlines():
+        if not line.startswith('Dialogue:'):
+            continue
+        parts = line.split(',', 9)
+        if len(parts) == 10:
+            timings.append((ass_time_to_cs(parts[1].strip()), ass_time_to_cs(parts[2].strip())))
+    return timings
+
+def parse_timings(timed_txt):
+    '根据内容判断LRC或ASS格式，返回各行的时间范围（厘秒）'
+    if re.search(r'^Dialogue:', timed_txt, re.M):
+        return parse_ass_timings(timed_txt)
+    return parse_lrc_timings(timed_txt)
+
+def line_windows(timings, line_ids, duration, pad=1.5):
+    '''
+    将已有时间轴按顺序对应到歌词各行，得到各行的搜索窗口 {行号: (起始秒, 结束秒)}。
+    line_ids为含对齐token的行号（按顺序），行数与时间轴不一致时返回None。
+    缺少结束时间的行以下一行的开始时间（末行以音频时长）为结束，窗口两端各放宽pad秒。
+    '''
+    if len(timings) != len(line_ids):
+        print(f'Timed file has {len(timings)} lines but the lyrics have {len(line_ids)}, ignored...')
+        return None
+    windows = {}
+    for i, (line_id, (start_cs, end_cs)) in enumerate(zip(line_ids, timings)):
+        if end_cs is None:
+            end_cs = timings[i + 1][0] if i + 1 < len(timings) else duration * 100
+        start = max(start_cs / 100 - pad, 0)
+        end = min(max(end_cs, start_cs) / 100 + pad, duration)
+        windows[line_id] = (start, end)
+    return windows
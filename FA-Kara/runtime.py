@@ -0,0 +1,113 @@
+import os
+
+try:
+    import tomllib
+except ImportError:
+    tomllib = None
+
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+
+def available_cpus():
+    '当前进程可用的CPU列表'
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+def parse_cpu_list(text):
+    '解析形如"0-3,6,8-9"的CPU列表，也接受整数列表'
+    if isinstance(text, (list, tuple)):
+        return [int(cpu) for cpu in text]
+    cpus = []
+    for part in str(text).split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            start, end = part.split('-', 1)
+            cpus.extend(range(int(start), int(end) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+def load_thread_config(path=None, default_job_slots=1):
+    '''
+    读取线程预算配置。先读取配置文件（path或环境变量FA_KARA_CONFIG指定的TOML文件）中的[threads]表，
+    再以环境变量覆盖：
+    FA_KARA_JOB_SLOTS: 同时处理的任务数
+    FA_KARA_THREADS_PER_JOB: 每个任务的torch算子内线程数及BLAS线程数，缺省为可用CPU数除以任务数
+    FA_KARA_INFERENCE_THREADS: 动态批处理中共享的模型推理所用的torch算子内线程数，缺省为全部可用CPU
+    FA_KARA_INTEROP_THREADS: torch算子间线程数
+    FA_KARA_CPU_AFFINITY: 绑定的CPU列表，如"0-7"
+    '''
+    config = {}
+    path = path or os.environ.get('FA_KARA_CONFIG')
+    if path:
+        if tomllib is None:
+            print('Python 3.11+ is required to read the config file, ignored...')
+        else:
+            with open(path, 'rb') as f:
+                config = dict(tomllib.load(f).get('threads', {}))
+    env_map = {
+        'job_slots': 'FA_KARA_JOB_SLOTS',
+        'threads_per_job': 'FA_KARA_THREADS_PER_JOB',
+        'inference_threads': 'FA_KARA_INFERENCE_THREADS',
+        'interop_threads': 'FA_KARA_INTEROP_THREADS',
+        'cpu_affinity': 'FA_KARA_CPU_AFFINITY',
+    }
+    for key, env in env_map.items():
+        if os.environ.get(env):
+            config[key] = os.environ[env]
+
+    cpus = parse_cpu_list(config['cpu_affinity']) if config.get('cpu_affinity') else None
+    job_slots = max(int(config.get('job_slots', default_job_slots)), 1)
+    cpu_count = len(cpus) if cpus else len(available_cpus())
+    threads_per_job = int(config.get('threads_per_job', 0)) or max(cpu_count // job_slots, 1)
+    return {
+        'job_slots': job_slots,
+        'threads_per_job': threads_per_job,
+        'inference_threads': int(config.get('inference_threads', 0)) or cpu_count,
+        'interop_threads': max(int(config.get('interop_threads', 1)), 1),
+        'cpu_affinity': cpus,
+    }
+
+_blas_limiter = None
+
+def set_torch_threads(threads):
+    '''
+    设置当前线程的torch算子内线程数。
+    torch在线程首次计算时才按全局设置初始化线程数，先完成初始化再设置，之后不会被其他线程的设置覆盖。
+    '''
+    import torch
+    torch.get_num_threads()
+    torch.set_num_threads(threads)
+
+def apply_thread_budget(config):
+    '''
+    按配置设置CPU亲和性、torch算子内/算子间线程数与BLAS线程数，
+    使job_slots个任务同时运行时总线程数不超过可用CPU数。
+    动态批处理的推理线程另行使用inference_threads个线程（见align.enable_batching）。
+    '''
+    global _blas_limiter
+    import torch
+
+    if config.get('cpu_affinity') and hasattr(os, 'sched_setaffinity'):
+        try:
+            os.sched_setaffinity(0, config['cpu_affinity'])
+        except OSError as e:
+            print(f'Failed to set CPU affinity: {e}')
+
+    threads = config['threads_per_job']
+    for env in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'NUMBA_NUM_THREADS'):
+        os.environ.setdefault(env, str(threads)) # 供之后启动的子进程使用
+    torch.set_num_threads(threads)
+    try:
+        torch.set_num_interop_threads(config['interop_threads'])
+    except RuntimeError:
+        pass # 算子间线程池已启动后无法再修改
+    if threadpool_limits is not None:
+        _blas_limiter = threadpool_limits(limits=threads)
+    print(f"Thread budget: {config['job_slots']} job slot(s) x {threads} thread(s), {config['inference_threads']} thread(s) for batched inference")
+    return config
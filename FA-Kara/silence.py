@@ -0,0 +1,104 @@
+import math
+import numpy as np
+
+FINE_FRAME_SECOND = .02 # tail_correct=3用于修正尾音的细分辨率
+
+def block_size(sr, frame_seconds):
+    '能整除各分辨率帧长与帧移的最大分块长度（样本数），各分辨率的帧能量都可由分块平方和相加得到'
+    sizes = []
+    for frame_second in frame_seconds:
+        frame_length = int(sr * frame_second)
+        sizes += [frame_length, frame_length // 2]
+    return max(math.gcd(*sizes), 1)
+
+def block_power(audio, block, chunk_blocks=1 << 14):
+    '逐块计算平方和，末尾不足一块的部分补零；按chunk_blocks块分批转换为float64，避免整段复制'
+    audio = np.asarray(audio)
+    num_blocks = -(-len(audio) // block)
+    power = np.empty(num_blocks)
+    step = chunk_blocks * block
+    for start in range(0, len(audio), step):
+        chunk = audio[start:start + step].astype(np.float64)
+        if len(chunk) % block:
+            chunk = np.concatenate((chunk, np.zeros(block - len(chunk) % block)))
+        chunk = chunk.reshape(-1, block)
+        power[start // block:start // block + len(chunk)] = np.einsum('ij,ij->i', chunk, chunk)
+    return power
+
+def energy_from_power(power, num_samples, block, frame_length):
+    '''
+    由分块平方和计算RMS能量，分帧方式与librosa.feature.rms相同（居中补零，帧移为帧长一半）。
+    frame_length与帧移须为block的整数倍。
+    '''
+    hop_length = frame_length // 2
+    cumulative = np.concatenate(([0.], np.cumsum(power)))
+    starts = np.arange(1 + num_samples // hop_length) * hop_length - frame_length // 2
+    limit = len(power) * block # 补零后的长度，之后的累计平方和不再变化
+    def cumulative_at(positions):
+        return cumulative[np.clip(positions, 0, limit) // block]
+    energy = cumulative_at(starts + frame_length) - cumulative_at(starts)
+    return np.sqrt(np.maximum(energy, 0) / frame_length).astype(np.float32)
+
+def energy_to_segments(energy, sr, frame_second=1, threspct=10, thresrto=.1):
+    '''
+    以能量的第100-threspct百分位数乘以thresrto为阈值，将连续的非静音帧合并为(起始秒, 结束秒)片段，
+    片段两端各放宽1/4帧，持续到末尾的片段以最后一帧的时间结束。
+    '''
+    hop_length = int(sr * frame_second) // 2
+    threshold = np.percentile(energy, 100-threspct) * thresrto
+    times = np.arange(len(energy)) * hop_length / sr # 各帧的时间点
+    edges = np.diff((energy > threshold).astype(np.int8), prepend=0, append=0)
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1) # 片段之后第一个静音帧，片段持续到末尾时为帧数
+    segment_starts = np.maximum(times[starts] - frame_second/4, 0)
+    segment_ends = np.where(ends < len(times), times[np.minimum(ends, len(times) - 1)] + frame_second/4, times[-1])
+    return list(zip(segment_starts.tolist(), segment_ends.tolist()))
+
+def non_silent_recog_multi(audio_file, sr, frame_seconds=(1,), threspct=10, thresrto=.1):
+    '一次计算分块能量，得到各分辨率frame_seconds下的非静音片段列表'
+    block = block_size(sr, frame_seconds)
+    power = block_power(audio_file, block)
+    return [energy_to_segments(energy_from_power(power, len(audio_file), block, int(sr * frame_second)),
+                               sr, frame_second, threspct, thresrto)
+            for frame_second in frame_seconds]
+
+def non_silent_recog(audio_file, sr=None, frame_second=1, threspct=10, thresrto=.1):
+    '识别非静音片段'
+    return non_silent_recog_multi(audio_file, sr, (frame_second,), threspct, thresrto)[0]
+
+class StreamingSilenceDetector:
+    '''
+    流式非静音检测，结果与non_silent_recog_multi相同。
+    解码过程中逐块调用feed累计分块平方和（每个分块一个数，规模远小于音频本身），
+    解码结束后调用finalize，由同一份分块能量得到各分辨率的片段，静音检测与读取音频同时进行。
+    '''
+    def __init__(self, sr, frame_seconds=(1,), threspct=10, thresrto=.1):
+        self.sr = sr
+        self.frame_seconds = tuple(frame_seconds)
+        self.threspct = threspct
+        self.thresrto = thresrto
+        self.block = block_size(sr, self.frame_seconds)
+        self._powers = []
+        self._residual = np.zeros(0, dtype=np.float32) # 不足一块、留待下次计算的样本
+        self._seen = 0 # 已读入的样本数
+
+    def feed(self, block):
+        '读入一块单声道音频'
+        block = np.asarray(block)
+        self._seen += len(block)
+        if len(self._residual):
+            block = np.concatenate((self._residual, block))
+        full = len(block) // self.block * self.block
+        if full:
+            self._powers.append(block_power(block[:full], self.block))
+        self._residual = block[full:]
+
+    def finalize(self):
+        '音频读取完毕，返回与frame_seconds对应的非静音片段列表'
+        if len(self._residual):
+            self._powers.append(block_power(self._residual, self.block))
+            self._residual = self._residual[:0]
+        power = np.concatenate(self._powers) if self._powers else np.zeros(0)
+        return [energy_to_segments(energy_from_power(power, self._seen, self.block, int(self.sr * frame_second)),
+                                   self.sr, frame_second, self.threspct, self.thresrto)
+                for frame_second in self.frame_seconds]
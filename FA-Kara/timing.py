@@ -0,0 +1,112 @@
+import bisect
+import itertools
+import numpy as np
+
+from tokens import NO_TIME, checked_cs
+
+class RangeIndex:
+    '''
+    非静音区间的厘秒索引（起点向下取整，终点向上取整）。
+    查询结果与按顺序逐个扫描区间、遇到起点晚于查询时刻即停止的做法相同，每次查询为对数时间。
+    '''
+    def __init__(self, ranges):
+        self.starts = [int(start * 100) for start, _ in ranges]
+        self.ends = [int(np.ceil(end * 100)) for _, end in ranges]
+        self._start_max = list(itertools.accumulate(self.starts, max))
+        self._end_max = list(itertools.accumulate(self.ends, max))
+
+    def _scan_limit(self, point):
+        '逐个扫描时在第几个区间停止，即第一个起点晚于point的区间的下标'
+        return bisect.bisect_right(self._start_max, point)
+
+    def covers(self, start, end):
+        '是否有区间覆盖[start, end]'
+        limit = self._scan_limit(start)
+        return limit > 0 and self._end_max[limit - 1] >= end
+
+    def first_reaching(self, point):
+        '第一个覆盖point的区间的起点，不存在时返回None'
+        index = bisect.bisect_left(self._end_max, point)
+        return self.starts[index] if index < self._scan_limit(point) else None
+
+def next_index_map(flags):
+    '各下标处及之后第一个flag为真的下标，不存在时为len(flags)'
+    next_index = [len(flags)] * (len(flags) + 1)
+    for i in range(len(flags) - 1, -1, -1):
+        next_index[i] = i if flags[i] else next_index[i + 1]
+    return next_index
+
+def tail_pron_correct(table, tail_correct):
+    '''
+    对齐前的尾音处理，为TokenTable中句末的分隔符添加拖长音。
+    1: 上一字的末尾元音与下一个发音的开头不同且下一个发音不以元音开头时添加；2: 总是添加。
+    '''
+    types, prons = table.type.tolist(), table.pron
+    if tail_correct == 1:
+        next_pron = next_index_map([bool(pron) for pron in prons])
+        for i in range(len(prons)):
+            if types[i]==0:
+                if prons[i-1] and types[i-1]!=0:
+                    pre_vowel = prons[i-1][-1]
+                    post_i = next_pron[i + 1] # 之后的元素在处理到它们之前不会被修改
+                    post_consonant = prons[post_i][0] if post_i < len(prons) else ''
+                    if pre_vowel!=post_consonant and post_consonant not in ('a', 'e', 'i', 'o', 'u'):
+                        prons[i] = pre_vowel + 'h'
+    elif tail_correct == 2:
+        for i in range(len(prons)):
+            if types[i]==0:
+                if prons[i-1] and types[i-1]!=0: # 合理利用baseline尾音特性
+                    prons[i] = prons[i-1][-1] + 'h'
+    return table
+
+def non_silent_head_adjust(table, non_silent_ranges):
+    '保证乐句完全位于同一个非静音区间'
+    if not non_silent_ranges:
+        return table
+    types, starts, ends = table.type.tolist(), table.start.tolist(), table.end.tolist()
+    sentences_list = []
+    si = 0
+    st = None
+    for i in range(len(types)):
+        if types[i] == 0:
+            if st is not None:
+                sentences_list.append((si, i-1, st, ends[i-1]))
+                st = None
+        elif st is None and starts[i] != NO_TIME:
+            si = i
+            st = starts[i]
+    ranges = RangeIndex(non_silent_ranges)
+    for inds, inde, sst, sen in sentences_list:
+        sst = checked_cs(sst)
+        sen = checked_cs(sen)
+        if ranges.covers(sst, sen):
+            continue
+        # 乐句跨越了静音，将句首移到句尾所在非静音区间的开头
+        adjust_target = ranges.first_reaching(sen)
+        if adjust_target is None:
+            print('Errors ignored while trying to correct end sounds...')
+            break
+        table.start[inds] = min(checked_cs(ends[inds]), adjust_target)
+    return table
+
+def tail_end_correct(table, fine_ranges):
+    '''
+    对齐后的尾音处理（tail_correct=3），以细分辨率的非静音区间修正TokenTable中句末的结束时间：
+    到下一个字开始之前有非静音区间结束时延长到该处，非静音一直持续到下一个字时延长到下一个字之前。
+    '''
+    ranges = RangeIndex(fine_ranges)
+    ns_ends = ranges.ends
+    types, starts, ends = table.type.tolist(), table.start.tolist(), table.end.tolist()
+    next_start = next_index_map([start != NO_TIME for start in starts])
+    for i in range(len(types)-1):
+        if types[i] != 0 and types[i+1] == 0:
+            current_end = checked_cs(ends[i])
+            next_ind = next_start[i + 2]
+            next_time = checked_cs(starts[next_ind]) if next_ind < len(types) else np.inf
+            left_index = bisect.bisect_left(ns_ends, current_end)
+            right_index = bisect.bisect_left(ns_ends, next_time)
+            if left_index < right_index and left_index < len(ns_ends):
+                table.end[i] = ns_ends[left_index]
+            elif ranges.covers(current_end, next_time):
+                table.end[i] = max(next_time-2, current_end)
+    return table
@@ -0,0 +1,106 @@
+import re
+import numpy as np
+
+NO_TIME = -1 # 没有时间（不参与对齐的token）
+ERROR_TIME = -2 # 对齐失败，输出为[error]
+
+TIME_PATTERN = re.compile(r'\[(\d{2}):(\d{2}):(\d{2})\]')
+
+def parse_time_to_hundredths(time_str):
+    match = TIME_PATTERN.match(time_str)
+    minutes, seconds, hundredths = int(match.group(1)), int(match.group(2)), int(match.group(3))
+    return minutes * 6000 + seconds * 100 + hundredths
+
+def format_hundredths_to_time_str(total_hundredths):
+    minutes = total_hundredths // 6000
+    remaining = total_hundredths % 6000
+    seconds = remaining // 100
+    hundredths = remaining % 100
+    return f"[{minutes:02d}:{seconds:02d}:{hundredths:02d}]"
+
+def format_cs(cs):
+    '厘秒格式化为[mm:ss:cc]，对齐失败时为[error]，没有时间时报错（与取用不存在的键时相同）'
+    if cs == NO_TIME:
+        raise ValueError('Time is missing')
+    return '[error]' if cs == ERROR_TIME else format_hundredths_to_time_str(cs)
+
+def checked_cs(cs):
+    '取用参与计算的时间，对齐失败时报错（与解析[error]字符串时相同）'
+    if cs < 0:
+        raise ValueError('Time is missing or alignment failed')
+    return cs
+
+def _cs_from_str(time_str):
+    if time_str == '[error]':
+        return ERROR_TIME
+    match = TIME_PATTERN.match(time_str)
+    if match is None:
+        raise ValueError(f'Invalid time: {time_str}')
+    return int(match.group(1)) * 6000 + int(match.group(2)) * 100 + int(match.group(3))
+
+class TokenTable:
+    '''
+    列式存储的歌词token表，代替逐token的字典列表。
+    orig/ruby/pron为字符串列表（缺少的键记为None），type为int8数组，
+    start/end为int32厘秒数组，NO_TIME表示没有时间，ERROR_TIME表示对齐失败。
+    '''
+    def __init__(self, orig, types, ruby=None, pron=None, start=None, end=None):
+        self.orig = list(orig)
+        size = len(self.orig)
+        self.type = np.asarray(types, dtype=np.int8)
+        self.ruby = list(ruby) if ruby is not None else [None] * size
+        self.pron = list(pron) if pron is not None else [None] * size
+        self.start = np.asarray(start, dtype=np.int32) if start is not None else np.full(size, NO_TIME, dtype=np.int32)
+        self.end = np.asarray(end, dtype=np.int32) if end is not None else np.full(size, NO_TIME, dtype=np.int32)
+
+    def __len__(self):
+        return len(self.orig)
+
+    @classmethod
+    def from_dicts(cls, items):
+        '由haruraw2norm输出的字典列表构建，[mm:ss:cc]时间解析为厘秒'
+        return cls(
+            [item.get('orig') for item in items],
+            [item.get('type') for item in items],
+            [item.get('ruby') for item in items],
+            [item.get('pron') for item in items],
+            [_cs_from_str(item['start']) if 'start' in item else NO_TIME for item in items],
+            [_cs_from_str(item['end']) if 'end' in item else NO_TIME for item in items],
+        )
+
+    def to_dicts(self):
+        '转换回字典列表，时间格式化为[mm:ss:cc]'
+        items = []
+        for orig, type_, ruby, pron, start, end in zip(self.orig, self.type.tolist(), self.ruby, self.pron,
+                                                       self.start.tolist(), self.end.tolist()):
+            item = {'orig': orig, 'type': type_}
+            if ruby is not None:
+                item['ruby'] = ruby
+            if pron is not None:
+                item['pron'] = pron
+            if start != NO_TIME:
+                item['start'] = format_cs(start)
+            if end != NO_TIME:
+                item['end'] = format_cs(end)
+            items.append(item)
+        return items
+
+    def insert_line_breaks(self, positions):
+        '在各下标之前插入换行符token（没有时间），之后的token下标随之后移'
+        positions = sorted(positions)
+        for offset, position in enumerate(positions):
+            self.orig.insert(position + offset, '\n')
+            self.ruby.insert(position + offset, None)
+            self.pron.insert(position + offset, '')
+        self.type = np.insert(self.type, positions, 0)
+        self.start = np.insert(self.start, positions, NO_TIME)
+        self.end = np.insert(self.end, positions, NO_TIME)
+
+    def set_times(self, indices, starts, ends):
+        '批量写入厘秒时间'
+        self.start[indices] = starts
+        self.end[indices] = ends
+
+def as_table(tokens):
+    '接受TokenTable或字典列表，统一返回TokenTable'
+    return tokens if isinstance(tokens, TokenTable) else TokenTable.from_dicts(tokens)
@@ -8,45 +8,53 @@ import tempfile
 import shutil
 import os
 import sys
-import bisect
+import concurrent.futures
+import queue
 import time
 
 # Add FA-Kara to path
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'FA-Kara'))
 
-import librosa
-import numpy as np
-
 import align
+import audioproc
+import emitter
 import haruraw2norm as hn
 import lrcfmt
 import norm2ass
-from norm2lrc import (
-    process_main, process_ruby, process_rlf,
-    non_silent_head_adjust, split_long_segments,
-    parse_time_to_hundredths, format_hundredths_to_time_str
-)
-
-
-def non_silent_recog(audio_file, sr=None, frame_second=1, threspct=10, thresrto=0.1):
-    """识别非静音片段"""
-    frame_length = int(sr * frame_second)
-    hop_length = frame_length // 2
-    energy = librosa.feature.rms(y=audio_file, frame_length=frame_length, hop_length=hop_length)[0]
-    threshold = np.percentile(energy, 100 - threspct) * thresrto
-    non_silent_frames = energy > threshold
-    times = librosa.frames_to_time(np.arange(len(energy)), sr=sr, hop_length=hop_length)
-    segments = []
-    start = None
-    for i, (t, active) in enumerate(zip(times, non_silent_frames)):
-        if active and start is None:
-            start = max(t - frame_second / 4, 0)
-        elif not active and start is not None:
-            segments.append((start, t + frame_second / 4))
-            start = None
-    if start is not None:
-        segments.append((start, times[-1]))
-    return segments
+import npycache
+import priors
+import runtime
+import silence
+import timing
+from tokens import TokenTable
+from norm2lrc import LrcSink, RubySink, RlfSink, split_long_segments
+
+# 动态批处理：同时提交的请求在等待窗口内合并为一次推理
+BATCH_SIZE = int(os.environ.get('FA_KARA_BATCH_SIZE', 1))
+BATCH_WAIT_MS = float(os.environ.get('FA_KARA_BATCH_WAIT_MS', 50))
+BATCH_MAX_SECONDS = float(os.environ.get('FA_KARA_BATCH_MAX_SECONDS', 240))
+# 线程预算：每个任务槽位分得的torch/BLAS线程数，避免并发任务超额占用CPU；批量推理另用全部CPU
+THREAD_CONFIG = runtime.load_thread_config(default_job_slots=BATCH_SIZE)
+# 无GPU的环境可默认使用int8量化模型
+QUANTIZE_DEFAULT = os.environ.get('FA_KARA_QUANTIZE', '0') == '1'
+
+
+def render_preview(table, index_to_token, token_times):
+    """将已对齐的行渲染为逐字时间轴文本，尚未对齐的行不显示"""
+    lines = []
+    current, done = '', False
+    for i, (orig, type_) in enumerate(zip(table.orig, table.type.tolist())):
+        token = index_to_token.get(i)
+        if token is not None and token in token_times:
+            current += token_times[token]
+            done = True
+        if type_ == 0 and orig == '\n':
+            if done:
+                lines.append(current)
+            current, done = '', False
+        else:
+            current += orig
+    return '\n'.join(lines)
 
 
 def process_lyrics(
@@ -65,9 +73,18 @@ def process_lyrics(
     language: str = "jaen",
     txt_format: str = "hrh",
     chars_per_line: int = 0,
+    chunk_seconds: float = 0,
+    quantize: bool = False,
+    segment_batch: bool = False,
+    hierarchical: bool = False,
+    prior_file=None,
+    incremental: bool = False,
+    previous_state=None,
+    speed_sweep: str = "",
+    stretch_method: str = "librosa",
     progress=gr.Progress()
 ):
-    """处理歌词和音频，生成时间轴文件"""
+    """处理歌词和音频，生成时间轴文件；对齐过程中逐行输出预览，最后附上文件"""
     
     if audio_file is None:
         raise gr.Error("请上传音频文件！")
@@ -79,16 +96,8 @@ def process_lyrics(
     
     # 处理歌词文本
     result_list = []
-    lines = lyrics_text.strip().split('\n')
-    
-    if txt_format == 'uta':
-        lines = lrcfmt.utat_process(lyrics_text)
-    
-    for line in lines:
-        if txt_format == 'moe':
-            line = lrcfmt.moeg_process_line(line)
-        if line.strip():
-            result_list.extend(hn.process_haruhi_line(line, language, int(sokuon_split), int(hatsuon_split)))
+    for line in lrcfmt.split_lyrics(lyrics_text, txt_format):
+        result_list.extend(hn.process_haruhi_line(line, language, int(sokuon_split), int(hatsuon_split)))
     
     if not result_list:
         raise gr.Error("歌词解析失败，请检查格式！")
@@ -96,143 +105,148 @@ def process_lyrics(
     if result_list[-1]['orig'] != '\n':
         result_list.append({'orig': '\n', 'type': 0, 'pron': ''})
     
+    table = TokenTable.from_dicts(result_list) # 之后各步骤都在token表上进行
     # 尾音处理 (tail_correct == 1 or 2)
-    if tail_correct == 1:
-        for i in range(len(result_list)):
-            if result_list[i]['type'] == 0:
-                try:
-                    if result_list[i - 1].get('pron') and result_list[i - 1]['type'] != 0:
-                        pre_vowel = result_list[i - 1]['pron'][-1]
-                        post_consonant = ''
-                        if i < len(result_list) - 1:
-                            post_i = i + 1
-                            while post_i < len(result_list):
-                                if 'pron' in result_list[post_i] and len(result_list[post_i]['pron']) >= 1:
-                                    post_consonant = result_list[post_i]['pron'][0]
-                                    break
-                                else:
-                                    post_i += 1
-                        if pre_vowel != post_consonant and post_consonant not in ('a', 'e', 'i', 'o', 'u'):
-                            result_list[i]['pron'] = pre_vowel + 'h'
-                except:
-                    continue
-    elif tail_correct == 2:
-        for i in range(len(result_list)):
-            if result_list[i]['type'] == 0:
-                try:
-                    if len(result_list[i - 1]['pron']) >= 1 and result_list[i - 1]['type'] != 0:
-                        result_list[i]['pron'] = result_list[i - 1]['pron'][-1] + 'h'
-                except:
-                    continue
+    timing.tail_pron_correct(table, tail_correct)
     
     progress(0.2, desc="正在分析歌词...")
     
     # 构建对齐 tokens
     alignment_tokens = []
-    token_to_index_map = {}
-    for i, item in enumerate(result_list):
-        if 'pron' in item and item['pron']:
-            alignment_tokens.append(item['pron'])
-            token_to_index_map[len(alignment_tokens) - 1] = i
+    token_lines = [] # 各token所在的行号，供分行两遍对齐使用
+    token_indices = [] # 各token在token表中的下标
+    line_index = 0
+    for i, (orig, type_, pron) in enumerate(zip(table.orig, table.type.tolist(), table.pron)):
+        if pron:
+            alignment_tokens.append(pron)
+            token_lines.append(line_index)
+            token_indices.append(i)
+        if type_ == 0 and orig == '\n':
+            line_index += 1
     
     progress(0.3, desc="正在加载音频...")
     
     # 加载音频
-    audio_file_data, sr = librosa.load(audio_file, sr=None)
-    non_silent_ranges = non_silent_recog(audio_file_data, sr, silent_window, tail_thres_pct, tail_thres_ratio)
+    # 一次解码为16kHz单声道，静音检测在解码的同时进行，与对齐共用同一份音频
+    # tail_correct=3时同时得到细分辨率的片段，两种分辨率共用一次能量计算
+    frame_seconds = (silent_window, silence.FINE_FRAME_SECOND) if tail_correct == 3 else (silent_window,)
+    detector = silence.StreamingSilenceDetector(audioproc.MODEL_SAMPLE_RATE, frame_seconds, tail_thres_pct, tail_thres_ratio)
+    audio_file_data, sr = audioproc.load_audio(audio_file, on_block=detector.feed)
+    non_silent_ranges, *fine_ranges = detector.finalize()
+    audio_hash = npycache.hash_array(audio_file_data)
+    
+    # 已有时间轴：每行只在其时间附近对齐
+    line_windows = None
+    if prior_file:
+        with open(prior_file, 'r', encoding='utf-8') as f:
+            timings = priors.parse_timings(f.read())
+        line_windows = priors.line_windows(timings, sorted(set(token_lines)), len(audio_file_data) / sr)
+        if line_windows is None:
+            gr.Warning("已有时间轴的行数与歌词不一致，已忽略")
     
     progress(0.4, desc="正在进行对齐推理...")
     
     # 对齐处理
-    if audio_speed == 1:
-        alignment_results = align.align_audio_with_text(audio_file_data, alignment_tokens, non_silent_ranges, sr)
+    try:
+        speeds = [float(speed) for speed in speed_sweep.replace('，', ',').split(',') if speed.strip()] if speed_sweep else []
+    except ValueError:
+        raise gr.Error("倍速扫描格式有误，请以逗号分隔，如 0.8,0.9,1.0")
+    if speeds:
+        y_processed, align_sr, align_hash = audio_file_data, sr, audio_hash
     else:
-        y_processed = librosa.effects.time_stretch(audio_file_data, rate=audio_speed)
-        alignment_results = align.align_audio_with_text(y_processed, alignment_tokens, non_silent_ranges, sr, audio_speed)
+        y_processed, align_sr, align_hash = audioproc.stretch_audio(audio_file_data, sr, audio_speed, stretch_method, audio_hash)
+    
+    # 对齐在后台线程中进行，每完成一行即经由队列送回预览
+    preview_queue = queue.Queue()
+    
+    def on_line(indices, starts, ends, failed):
+        preview_queue.put((indices, align.format_times(starts, failed)))
+    
+    def run_alignment():
+        # 本任务自身的计算（非批量推理、逐行对齐等）只使用分得的线程数
+        runtime.set_torch_threads(THREAD_CONFIG['threads_per_job'])
+        if speeds:
+            # 倍速扫描：首个倍速用常驻模型对齐，其余倍速在子进程中并行对齐，选用得分最高者
+            threads = THREAD_CONFIG['threads_per_job']
+            workers = min(len(speeds), threads)
+            best_speed, alignment, _ = align.speed_sweep(audio_file_data, sr, alignment_tokens, speeds, non_silent_ranges, workers, max(threads // workers, 1), chunk_seconds, audio_hash, quantize, segment_batch, stretch_method)
+            return alignment, best_speed
+        alignment = None
+        if incremental and previous_state:
+            alignment = align.align_incremental(previous_state, y_processed, alignment_tokens, token_lines, len(audio_file_data) / sr, non_silent_ranges, align_sr, audio_speed, chunk_seconds, audio_hash=align_hash, quantized=quantize, segment_batch=segment_batch, workers=THREAD_CONFIG['threads_per_job'])
+        if alignment is None:
+            alignment = align.align_audio_with_text(y_processed, alignment_tokens, non_silent_ranges, align_sr, audio_speed, chunk_seconds, as_arrays=True, audio_hash=align_hash, quantized=quantize, segment_batch=segment_batch, token_lines=token_lines if hierarchical or line_windows else None, workers=THREAD_CONFIG['threads_per_job'], line_windows=line_windows, on_line=on_line)
+        return alignment, audio_speed
+    
+    index_to_token = {index: token for token, index in enumerate(token_indices)}
+    token_times = {}
+    total_lines = len(set(token_lines))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(run_alignment)
+        if speeds or not (hierarchical or line_windows):
+            # 只有分行两遍对齐或按已有时间轴对齐时逐行完成，其余情况整体对齐完成后才有预览
+            yield (gr.update(), gr.update(), gr.update(), "⏳ 正在整体对齐，完成后显示预览...",
+                   previous_state, "")
+        while True:
+            try:
+                indices, times = preview_queue.get(timeout=0.2)
+            except queue.Empty:
+                if future.done() and preview_queue.empty():
+                    break
+                continue
+            token_times.update(zip(indices, times))
+            while not preview_queue.empty():
+                indices, times = preview_queue.get()
+                token_times.update(zip(indices, times))
+            done_lines = len({token_lines[i] for i in token_times})
+            progress(0.4 + 0.3 * done_lines / max(total_lines, 1), desc=f"正在对齐 {done_lines}/{total_lines} 行...")
+            yield (gr.update(), gr.update(), gr.update(), f"⏳ 已对齐 {done_lines}/{total_lines} 行",
+                   previous_state, render_preview(table, index_to_token, token_times))
+        alignment, audio_speed = future.result()
+    align_sr, align_hash = audioproc.stretched_identity(audio_hash, sr, audio_speed, stretch_method)
+    token_times = dict(enumerate(align.format_times(alignment.starts, alignment.failed)))
+    preview = render_preview(table, index_to_token, token_times)
+    # 保存对齐结果（尾音等后处理之前），供下次增量对齐使用
+    alignment_state = align.alignment_state(alignment, token_lines, align.alignment_settings(align_hash, align_sr, audio_speed, non_silent_ranges, chunk_seconds, quantize, segment_batch))
     
     progress(0.7, desc="正在生成时间轴...")
     
     # 映射结果
-    for i, result in enumerate(alignment_results):
-        if i in token_to_index_map:
-            original_index = token_to_index_map[i]
-            result_list[original_index]['start'] = result['start']
-            result_list[original_index]['end'] = result['end']
+    table.set_times(token_indices, align.to_centiseconds(alignment.starts, alignment.failed),
+                    align.to_centiseconds(alignment.ends, alignment.failed))
     
-    result_list = non_silent_head_adjust(result_list, non_silent_ranges)
+    timing.non_silent_head_adjust(table, non_silent_ranges)
     
     # tail_correct == 3 处理
     if tail_correct == 3:
-        ns_small = non_silent_recog(audio_file_data, sr, 0.02, tail_thres_pct, tail_thres_ratio)
-        ns_ends = [int(np.ceil(ns_end * 100)) for _, ns_end in ns_small]
-        for i in range(len(result_list) - 1):
-            if result_list[i]['type'] != 0 and result_list[i + 1]['type'] == 0:
-                current_end = parse_time_to_hundredths(result_list[i]['end'])
-                next_ind = i + 2
-                next_start = np.inf
-                while next_ind < len(result_list):
-                    if 'start' in result_list[next_ind]:
-                        next_start = parse_time_to_hundredths(result_list[next_ind]['start'])
-                        break
-                    next_ind += 1
-                left_index = bisect.bisect_left(ns_ends, current_end)
-                right_index = bisect.bisect_left(ns_ends, next_start)
-                if left_index < right_index and left_index < len(ns_ends):
-                    result_list[i]['end'] = format_hundredths_to_time_str(ns_ends[left_index])
-                else:
-                    interval_covered = False
-                    for nss_start, nss_end in ns_small:
-                        if int(nss_start * 100) > current_end:
-                            break
-                        if int(nss_start * 100) <= current_end and int(np.ceil(nss_end * 100)) >= next_start:
-                            interval_covered = True
-                            break
-                    if interval_covered:
-                        result_list[i]['end'] = format_hundredths_to_time_str(max(next_start - 2, current_end))
+        timing.tail_end_correct(table, fine_ranges[0])
     
     if chars_per_line > 0:
-        split_long_segments(result_list, max_length=chars_per_line)
+        split_long_segments(table, max_length=chars_per_line)
     
     progress(0.9, desc="正在保存文件...")
     
     # 生成输出文件
     output_dir = tempfile.mkdtemp()
     
-    # Ruby LRC
-    main_output = process_main(result_list, ruby_offset, bpm, beats_per_bar)
-    ruby_output = process_ruby(result_list)
     ruby_lrc_path = os.path.join(output_dir, 'output_ruby.lrc')
-    with open(ruby_lrc_path, 'w', encoding='utf-8') as f:
-        f.write(f"{main_output}\n{ruby_output}")
-    
-    # RLF LRC
-    rlf_output = process_rlf(result_list)
     rlf_lrc_path = os.path.join(output_dir, 'output_rlf.lrc')
-    with open(rlf_lrc_path, 'w', encoding='utf-8') as f:
-        f.write(rlf_output)
-    
-    # ASS
-    ass_output = norm2ass.process_norm2assV2(result_list)
-    ass_head = '''[Script Info]
-ScriptType: v4.00+
-YCbCr Matrix: TV.601
-PlayResX: 1920
-PlayResY: 1080
-
-[V4+ Styles]
-Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, BackColour, Bold, Italic, Underline, StrikeOut, ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, Shadow, Alignment, MarginL, MarginR, MarginV, Encoding
-Style: Default,Source Han Serif,71,&H00FFFFFF,&H000000FF,&H00000000,&H00000000,0,0,0,0,100,100,0,0,1,1.99999,1.99999,2,11,11,101,1
-
-[Events]
-Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
-'''
     ass_path = os.path.join(output_dir, 'output.ass')
-    with open(ass_path, 'w', encoding='utf-8') as f:
-        f.write(ass_head + ass_output)
+    # 遍历一次token表，同时写出 Ruby LRC、RLF LRC 与 ASS
+    with open(ruby_lrc_path, 'w', encoding='utf-8') as ruby_file, \
+         open(rlf_lrc_path, 'w', encoding='utf-8') as rlf_file, \
+         open(ass_path, 'w', encoding='utf-8') as ass_file:
+        emitter.emit(table, [
+            LrcSink(ruby_file, ruby_offset, bpm, beats_per_bar),
+            RubySink(ruby_file, prefix='\n'),
+            RlfSink(rlf_file),
+            norm2ass.AssSink(ass_file, head=norm2ass.ASS_HEAD),
+        ])
     
     progress(1.0, desc="处理完成！")
     
-    return ruby_lrc_path, rlf_lrc_path, ass_path, "✅ 处理完成！"
+    status = f"✅ 处理完成！最佳倍速：x{audio_speed}" if speeds else "✅ 处理完成！"
+    yield ruby_lrc_path, rlf_lrc_path, ass_path, status, alignment_state, preview
 
 
 # 自定义 CSS - 赛博朋克 x 日式卡拉OK 风格
@@ -621,211 +635,282 @@ div[role="dialog"], .modal, .settings-modal {
 }
 """
 
-# 创建 Gradio 界面 - 强制暗色主题
-dark_theme = gr.themes.Default(
-    primary_hue=gr.themes.colors.fuchsia,
-    secondary_hue=gr.themes.colors.cyan,
-    neutral_hue=gr.themes.colors.slate,
-)
-
-with gr.Blocks(
-    title="FA-Kara WebUI",
-    css=custom_css,
-    theme=dark_theme,
-) as demo:
-    
-    # 强制暗色模式 + 霓虹标题
-    gr.HTML("""
-        <script>
-        (function() {
-            // 强制暗色模式
-            document.documentElement.classList.add('dark');
-            document.documentElement.classList.remove('light');
-            document.documentElement.setAttribute('data-theme', 'dark');
-            document.body.classList.add('dark');
-            document.body.classList.remove('light');
-            localStorage.setItem('theme', 'dark');
-            
-            // 监听并阻止主题切换
-            const observer = new MutationObserver(function(mutations) {
-                mutations.forEach(function(mutation) {
-                    if (mutation.attributeName === 'class' || mutation.attributeName === 'data-theme') {
-                        const el = mutation.target;
-                        if (el.classList.contains('light')) {
-                            el.classList.remove('light');
-                            el.classList.add('dark');
-                        }
-                        if (el.getAttribute('data-theme') === 'light') {
-                            el.setAttribute('data-theme', 'dark');
+def build_ui():
+    """构建 Gradio 界面。只在启动服务时调用，倍速扫描的 spawn 子进程重新导入本模块时不会构建界面"""
+    # 创建 Gradio 界面 - 强制暗色主题
+    dark_theme = gr.themes.Default(
+        primary_hue=gr.themes.colors.fuchsia,
+        secondary_hue=gr.themes.colors.cyan,
+        neutral_hue=gr.themes.colors.slate,
+    )
+
+    with gr.Blocks(
+        title="FA-Kara WebUI",
+        css=custom_css,
+        theme=dark_theme,
+    ) as demo:
+        
+        # 强制暗色模式 + 霓虹标题
+        gr.HTML("""
+            <script>
+            (function() {
+                // 强制暗色模式
+                document.documentElement.classList.add('dark');
+                document.documentElement.classList.remove('light');
+                document.documentElement.setAttribute('data-theme', 'dark');
+                document.body.classList.add('dark');
+                document.body.classList.remove('light');
+                localStorage.setItem('theme', 'dark');
+                
+                // 监听并阻止主题切换
+                const observer = new MutationObserver(function(mutations) {
+                    mutations.forEach(function(mutation) {
+                        if (mutation.attributeName === 'class' || mutation.attributeName === 'data-theme') {
+                            const el = mutation.target;
+                            if (el.classList.contains('light')) {
+                                el.classList.remove('light');
+                                el.classList.add('dark');
+                            }
+                            if (el.getAttribute('data-theme') === 'light') {
+                                el.setAttribute('data-theme', 'dark');
+                            }
                         }
-                    }
+                    });
                 });
-            });
-            observer.observe(document.documentElement, { attributes: true });
-            observer.observe(document.body, { attributes: true });
-        })();
-        </script>
-        <div class="neon-header">
-            <h1 class="neon-title">FA-KARA</h1>
-            <p class="neon-subtitle">カラオケ・リリック・シンク</p>
-        </div>
-    """)
-    
-    with gr.Row(equal_height=True):
-        # 左侧 - 输入区域
-        with gr.Column(scale=1):
-            gr.HTML('<div class="card-container">')
-            gr.HTML('<div class="section-title">🎵 音频输入</div>')
-            
-            audio_input = gr.Audio(
-                label="上传人声音频",
-                type="filepath",
-                sources=["upload"],
-                show_label=True,
-            )
-            
-            gr.HTML('<div class="divider"></div>')
-            gr.HTML('<div class="section-title">📝 歌词文本</div>')
-            
-            lyrics_input = gr.Textbox(
-                label="",
-                placeholder="在此粘贴歌词（支持振假名格式）\n\n示例：\n{阻|はば}むものは{無|な}い\n{身|み}{勝|かっ}{手|て}に More love!",
-                lines=10,
-                max_lines=15,
-                show_label=False,
-            )
-            
-            with gr.Row():
-                language = gr.Dropdown(
-                    label="语言",
-                    choices=[("日语+英语", "jaen"), ("仅日语", "ja")],
-                    value="jaen",
-                    scale=1,
-                )
-                txt_format = gr.Dropdown(
-                    label="格式",
-                    choices=[
-                        ("春日向け", "hrh"),
-                        ("utaten", "uta"),
-                        ("萌娘百科", "moe"),
-                    ],
-                    value="hrh",
-                    scale=1,
-                )
-            gr.HTML('</div>')
+                observer.observe(document.documentElement, { attributes: true });
+                observer.observe(document.body, { attributes: true });
+            })();
+            </script>
+            <div class="neon-header">
+                <h1 class="neon-title">FA-KARA</h1>
+                <p class="neon-subtitle">カラオケ・リリック・シンク</p>
+            </div>
+        """)
         
-        # 右侧 - 设置与输出
-        with gr.Column(scale=1):
-            gr.HTML('<div class="card-container">')
-            gr.HTML('<div class="section-title">⚡ 快速设置</div>')
-            
-            audio_speed = gr.Slider(
-                label="音频倍速",
-                minimum=0.25,
-                maximum=2.0,
-                value=1.0,
-                step=0.05,
-                info="语速快可降低此值",
-            )
-            
-            with gr.Row():
-                bpm = gr.Number(label="BPM", value=60, minimum=0, maximum=300, scale=1)
-                tail_correct = gr.Dropdown(
-                    label="尾音模式",
-                    choices=[("推荐", 3), ("模式2", 2), ("模式1", 1), ("禁用", 0)],
-                    value=3,
-                    scale=1,
+        with gr.Row(equal_height=True):
+            # 左侧 - 输入区域
+            with gr.Column(scale=1):
+                gr.HTML('<div class="card-container">')
+                gr.HTML('<div class="section-title">🎵 音频输入</div>')
+                
+                audio_input = gr.Audio(
+                    label="上传人声音频",
+                    type="filepath",
+                    sources=["upload"],
+                    show_label=True,
                 )
-            
-            # 高级设置折叠
-            with gr.Accordion("🔧 高级设置", open=False):
+                
+                gr.HTML('<div class="divider"></div>')
+                gr.HTML('<div class="section-title">📝 歌词文本</div>')
+                
+                lyrics_input = gr.Textbox(
+                    label="",
+                    placeholder="在此粘贴歌词（支持振假名格式）\n\n示例：\n{阻|はば}むものは{無|な}い\n{身|み}{勝|かっ}{手|て}に More love!",
+                    lines=10,
+                    max_lines=15,
+                    show_label=False,
+                )
+                
                 with gr.Row():
-                    silent_window = gr.Slider(
-                        label="静音窗口(秒)", minimum=0.1, maximum=2.0, value=0.8, step=0.1
+                    language = gr.Dropdown(
+                        label="语言",
+                        choices=[("日语+英语", "jaen"), ("仅日语", "ja")],
+                        value="jaen",
+                        scale=1,
                     )
-                    tail_thres_pct = gr.Slider(
-                        label="阈值百分位(%)", minimum=1, maximum=50, value=10, step=1
+                    txt_format = gr.Dropdown(
+                        label="格式",
+                        choices=[
+                            ("春日向け", "hrh"),
+                            ("utaten", "uta"),
+                            ("萌娘百科", "moe"),
+                        ],
+                        value="hrh",
+                        scale=1,
                     )
+                gr.HTML('</div>')
+            
+            # 右侧 - 设置与输出
+            with gr.Column(scale=1):
+                gr.HTML('<div class="card-container">')
+                gr.HTML('<div class="section-title">⚡ 快速设置</div>')
+                
+                audio_speed = gr.Slider(
+                    label="音频倍速",
+                    minimum=0.25,
+                    maximum=2.0,
+                    value=1.0,
+                    step=0.05,
+                    info="语速快可降低此值",
+                )
                 
                 with gr.Row():
-                    tail_thres_ratio = gr.Slider(
-                        label="阈值比例", minimum=0.01, maximum=0.5, value=0.1, step=0.01
+                    bpm = gr.Number(label="BPM", value=60, minimum=0, maximum=300, scale=1)
+                    tail_correct = gr.Dropdown(
+                        label="尾音模式",
+                        choices=[("推荐", 3), ("模式2", 2), ("模式1", 1), ("禁用", 0)],
+                        value=3,
+                        scale=1,
                     )
-                    chars_per_line = gr.Slider(
-                        label="每行字数限制", minimum=0, maximum=50, value=0, step=1,
-                        info="0=不限"
+                
+                # 高级设置折叠
+                with gr.Accordion("🔧 高级设置", open=False):
+                    with gr.Row():
+                        silent_window = gr.Slider(
+                            label="静音窗口(秒)", minimum=0.1, maximum=2.0, value=0.8, step=0.1
+                        )
+                        tail_thres_pct = gr.Slider(
+                            label="阈值百分位(%)", minimum=1, maximum=50, value=10, step=1
+                        )
+                    
+                    with gr.Row():
+                        tail_thres_ratio = gr.Slider(
+                            label="阈值比例", minimum=0.01, maximum=0.5, value=0.1, step=0.01
+                        )
+                        chars_per_line = gr.Slider(
+                            label="每行字数限制", minimum=0, maximum=50, value=0, step=1,
+                            info="0=不限"
+                        )
+                    
+                    with gr.Row():
+                        sokuon_split = gr.Checkbox(label="促音拆分", value=False)
+                        hatsuon_split = gr.Checkbox(label="拨音拆分", value=True)
+                    
+                    with gr.Row():
+                        ruby_offset = gr.Number(label="偏移量(ms)", value=-150)
+                        beats_per_bar = gr.Number(label="每小节拍数", value=3, minimum=1, maximum=8)
+                    
+                    with gr.Row():
+                        chunk_seconds = gr.Slider(
+                            label="分块推理(秒)", minimum=0, maximum=120, value=0, step=5,
+                            info="0=整段推理，长音频内存不足时调小"
+                        )
+                        quantize = gr.Checkbox(
+                            label="INT8量化推理(CPU)", value=QUANTIZE_DEFAULT,
+                            info="无GPU时可加速推理"
+                        )
+                        segment_batch = gr.Checkbox(
+                            label="分段批量推理", value=False,
+                            info="各非静音片段独立推理，不做拼接；对齐仍整体进行，未勾选分行对齐时完成后才显示预览"
+                        )
+                        hierarchical = gr.Checkbox(
+                            label="分行两遍对齐", value=False,
+                            info="先定位各行再逐行并行对齐，长歌曲更快，并逐行显示预览"
+                        )
+                    
+                    with gr.Row():
+                        incremental = gr.Checkbox(
+                            label="增量对齐", value=False,
+                            info="同一音频再次提交时，只重新对齐修改过的行"
+                        )
+                        speed_sweep = gr.Textbox(
+                            label="倍速扫描", value="",
+                            placeholder="如 0.8,0.9,1.0",
+                            info="填写候选倍速时并行对齐并自动选用最佳倍速，忽略上方倍速设置"
+                        )
+                        stretch_method = gr.Dropdown(
+                            label="变速算法",
+                            choices=[("librosa(相位声码器)", "librosa"), ("WSOLA(快速，不变调)", "wsola"), ("重采样(最快，变调)", "resample")],
+                            value="librosa",
+                        )
+                    
+                    prior_file = gr.File(
+                        label="已有时间轴(LRC/ASS，可选)",
+                        file_types=[".lrc", ".ass"],
+                        type="filepath",
                     )
                 
-                with gr.Row():
-                    sokuon_split = gr.Checkbox(label="促音拆分", value=False)
-                    hatsuon_split = gr.Checkbox(label="拨音拆分", value=True)
+                gr.HTML('<div class="divider"></div>')
+                gr.HTML('<div class="section-title">📤 输出文件</div>')
+                
+                status_output = gr.Textbox(
+                    label="状态",
+                    interactive=False,
+                    elem_classes=["status-box"],
+                )
+                
+                preview_output = gr.Textbox(
+                    label="对齐预览",
+                    info="分行两遍对齐或提供已有时间轴时每对齐一行即显示，否则整体对齐完成后显示",
+                    lines=8,
+                    max_lines=15,
+                    interactive=False,
+                )
                 
                 with gr.Row():
-                    ruby_offset = gr.Number(label="偏移量(ms)", value=-150)
-                    beats_per_bar = gr.Number(label="每小节拍数", value=3, minimum=1, maximum=8)
-            
-            gr.HTML('<div class="divider"></div>')
-            gr.HTML('<div class="section-title">📤 输出文件</div>')
-            
-            status_output = gr.Textbox(
-                label="状态",
-                interactive=False,
-                elem_classes=["status-box"],
-            )
-            
-            with gr.Row():
-                ruby_lrc_output = gr.File(label="Ruby LRC", scale=1)
-                rlf_lrc_output = gr.File(label="RLF LRC", scale=1)
-                ass_output = gr.File(label="ASS", scale=1)
-            
-            gr.HTML('</div>')
-    
-    # 处理按钮
-    gr.HTML('<div style="display: flex; justify-content: center; margin: 1.5rem 0;">')
-    process_btn = gr.Button(
-        "⚡ 开始同步",
-        variant="primary",
-        size="lg",
-        elem_classes=["primary-btn"],
-    )
-    gr.HTML('</div>')
-    
-    # 页脚
-    gr.HTML("""
-        <div class="footer-section">
-            <p>Powered by <a href="https://github.com/moriwx/FA-Kara" target="_blank">FA-Kara</a> | MMS-FA + librosa + PyTorch</p>
-        </div>
-    """)
-    
-    process_btn.click(
-        fn=process_lyrics,
-        inputs=[
-            audio_input,
-            lyrics_input,
-            audio_speed,
-            sokuon_split,
-            hatsuon_split,
-            tail_correct,
-            silent_window,
-            tail_thres_pct,
-            tail_thres_ratio,
-            ruby_offset,
-            bpm,
-            beats_per_bar,
-            language,
-            txt_format,
-            chars_per_line,
-        ],
-        outputs=[
-            ruby_lrc_output,
-            rlf_lrc_output,
-            ass_output,
-            status_output,
-        ],
-    )
+                    ruby_lrc_output = gr.File(label="Ruby LRC", scale=1)
+                    rlf_lrc_output = gr.File(label="RLF LRC", scale=1)
+                    ass_output = gr.File(label="ASS", scale=1)
+                
+                gr.HTML('</div>')
+        
+        # 上次的对齐结果，供增量对齐使用
+        alignment_state = gr.State(None)
+        
+        # 处理按钮
+        gr.HTML('<div style="display: flex; justify-content: center; margin: 1.5rem 0;">')
+        process_btn = gr.Button(
+            "⚡ 开始同步",
+            variant="primary",
+            size="lg",
+            elem_classes=["primary-btn"],
+        )
+        gr.HTML('</div>')
+        
+        # 页脚
+        gr.HTML("""
+            <div class="footer-section">
+                <p>Powered by <a href="https://github.com/moriwx/FA-Kara" target="_blank">FA-Kara</a> | MMS-FA + librosa + PyTorch</p>
+            </div>
+        """)
+        
+        process_btn.click(
+            fn=process_lyrics,
+            inputs=[
+                audio_input,
+                lyrics_input,
+                audio_speed,
+                sokuon_split,
+                hatsuon_split,
+                tail_correct,
+                silent_window,
+                tail_thres_pct,
+                tail_thres_ratio,
+                ruby_offset,
+                bpm,
+                beats_per_bar,
+                language,
+                txt_format,
+                chars_per_line,
+                chunk_seconds,
+                quantize,
+                segment_batch,
+                hierarchical,
+                prior_file,
+                incremental,
+                alignment_state,
+                speed_sweep,
+                stretch_method,
+            ],
+            outputs=[
+                ruby_lrc_output,
+                rlf_lrc_output,
+                ass_output,
+                status_output,
+                alignment_state,
+                preview_output,
+            ],
+            concurrency_limit=THREAD_CONFIG['job_slots'],
+        )
+    return demo
 
 
 if __name__ == "__main__":
+    runtime.apply_thread_budget(THREAD_CONFIG)
+    # 启动时预加载模型，之后所有请求共享常驻模型
+    align.get_model_manager().warm_up(quantized=QUANTIZE_DEFAULT)
+    align.enable_batching(BATCH_SIZE, BATCH_WAIT_MS / 1000, THREAD_CONFIG['inference_threads'], BATCH_MAX_SECONDS)
+    demo = build_ui()
     demo.launch(
         server_name="0.0.0.0",
         server_port=7860,
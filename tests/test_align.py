@@ -0,0 +1,231 @@
+import concurrent.futures
+import os
+import sys
+import types
+
+import numpy as np
+import pytest
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'FA-Kara'))
+torchaudio = pytest.importorskip('torchaudio')
+import align
+
+
+def random_emission(num_frames, num_classes=29, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    logits = torch.randn((num_frames, num_classes), generator=generator) * 3
+    return torch.log_softmax(logits, dim=-1)
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_hierarchical_lines_are_monotonic(seed):
+    rng = np.random.default_rng(seed)
+    num_lines = int(rng.integers(2, 6))
+    tokens, token_lines = [], []
+    for line in range(num_lines):
+        for _ in range(int(rng.integers(1, 6))):
+            tokens.append(rng.integers(1, 28, size=int(rng.integers(1, 4))).tolist())
+            token_lines.append(line)
+    emission = random_emission(int(rng.integers(200, 600)), seed=seed)
+    aligner = torchaudio.pipelines.MMS_FA.get_aligner()
+    starts, ends, failed, _ = align.align_hierarchical(aligner, emission, tokens, token_lines, workers=2)
+    groups = align.group_token_lines(token_lines)
+    for previous, current in zip(groups, groups[1:]):
+        assert starts[current].min() >= ends[previous].max()
+    assert np.all(np.diff(starts) >= 0)
+
+
+def test_plan_padded_batches_caps_padded_samples():
+    lengths = [100, 900, 120, 500, 110, 2000]
+    batches = align.plan_padded_batches(lengths, 1000)
+    assert sorted(i for batch in batches for i in batch) == list(range(len(lengths)))
+    for batch in batches:
+        assert len(batch) == 1 or len(batch) * max(lengths[i] for i in batch) <= 1000
+    assert [0, 2, 4] in [sorted(batch) for batch in batches]
+
+
+class _FakeManager:
+    '每帧输出该帧的均值，记录每次前向补零后的形状'
+    class bundle:
+        sample_rate = 16000
+
+    def __init__(self):
+        self.shapes = []
+
+    def device_for(self, quantized=False):
+        return torch.device('cpu')
+
+    def acquire(self, quantized=False):
+        def model(waveforms, lengths=None):
+            self.shapes.append(tuple(waveforms.shape))
+            frames = waveforms.reshape(waveforms.shape[0], -1, align.FRAME_HOP).mean(-1, keepdim=True)
+            output_lengths = None if lengths is None else lengths // align.FRAME_HOP
+            return frames, output_lengths
+        return model
+
+    def release(self):
+        pass
+
+
+def test_batcher_splits_by_padded_length():
+    manager = _FakeManager()
+    batcher = align.EmissionBatcher(manager, max_batch_size=4, max_wait=0.5, max_batch_seconds=0.5)
+    lengths = [align.FRAME_HOP * n for n in (5, 6, 20, 4)]
+    waveforms = [torch.full((1, length), float(i)) for i, length in enumerate(lengths)]
+    with concurrent.futures.ThreadPoolExecutor(len(waveforms)) as executor:
+        results = list(executor.map(batcher.submit, waveforms))
+    for i, (length, emission) in enumerate(zip(lengths, results)):
+        assert emission.shape[1] == length // align.FRAME_HOP
+        assert torch.all(emission == i)
+    assert all(rows == 1 or rows * samples <= 0.5 * 16000 for rows, samples in manager.shapes)
+
+
+def test_load_local_model_falls_back_without_internals(monkeypatch):
+    class Bundle:
+        def get_model(self):
+            return torch.nn.Identity()
+
+    monkeypatch.setattr(torchaudio.pipelines, 'MMS_FA', Bundle())
+    model = align.load_local_model('/nonexistent/mms_fa.pt')
+    assert isinstance(model, torch.nn.Identity)
+    assert not model.training
+
+
+def full_path_score(emission, targets):
+    _, scores = torchaudio.functional.forced_align(emission[None], torch.tensor([targets], dtype=torch.int32), blank=0)
+    return float(scores.sum())
+
+
+@pytest.fixture(params=['numba', 'numpy'])
+def viterbi_kernel(request, monkeypatch):
+    if request.param == 'numpy':
+        monkeypatch.setattr(align, '_viterbi_jit', None)
+    elif align._viterbi_jit is None:
+        pytest.skip('numba is not installed')
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_banded_align_matches_full_trellis_at_full_width(seed, viterbi_kernel):
+    rng = np.random.default_rng(seed)
+    targets = rng.integers(1, 28, size=int(rng.integers(5, 30))).tolist()
+    emission = random_emission(int(rng.integers(len(targets) * 2, 200)), seed=seed)
+    _, scores = align.banded_forced_align(emission.numpy(), targets, band=2 * len(targets) + 1)
+    assert float(scores.sum()) == pytest.approx(full_path_score(emission, targets), abs=1e-3)
+
+
+def test_banded_align_never_beats_full_trellis(viterbi_kernel):
+    aligned = 0
+    for seed in range(20):
+        rng = np.random.default_rng(seed)
+        targets = rng.integers(1, 28, size=int(rng.integers(5, 30))).tolist()
+        emission = random_emission(int(rng.integers(len(targets) * 2, 200)), seed=seed)
+        result = align.banded_forced_align(emission.numpy(), targets, band=max(2, len(targets) // 4 * 2))
+        if result is not None:
+            aligned += 1
+            assert float(result[1].sum()) <= full_path_score(emission, targets) + 1e-3
+    assert aligned > 0
+
+
+def windowed_lrc_alignment(seed, use_limits=True):
+    import priors
+    rng = np.random.default_rng(seed)
+    num_lines = int(rng.integers(3, 7))
+    lrc = ''.join(f'[00:{2 * line + 1:02d}.00]line {line}[00:{2 * line + 3:02d}.00]\n' for line in range(num_lines))
+    tokens, token_lines = [], []
+    for line in range(num_lines):
+        for _ in range(int(rng.integers(1, 6))):
+            tokens.append(rng.integers(1, 28, size=int(rng.integers(1, 4))).tolist())
+            token_lines.append(line)
+    duration = 2 * num_lines + 4
+    emission = random_emission(int(duration / 0.02), seed=seed)
+    line_windows = priors.line_windows(priors.parse_lrc_timings(lrc), list(range(num_lines)), duration)
+    timeline = align.FrameTimeline(0.02, emission.shape[0])
+    groups = align.group_token_lines(token_lines)
+    windows = [tuple(int(f) for f in np.searchsorted(timeline.frame_starts, line_windows[line])) for line in range(num_lines)]
+    limits = align.window_limits(windows, emission.shape[0]) if use_limits else None
+    aligner = torchaudio.pipelines.MMS_FA.get_aligner()
+    starts, ends, _, _ = align.align_in_windows(aligner, emission, tokens, groups, windows, workers=2, limits=limits)
+    return starts, ends, groups
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_windowed_lines_with_lrc_priors_are_monotonic(seed):
+    starts, ends, groups = windowed_lrc_alignment(seed)
+    for previous, current in zip(groups, groups[1:]):
+        assert starts[current].min() >= ends[previous].max()
+    assert np.all(np.diff(starts) >= 0)
+
+
+class _TokenizingManager:
+    class bundle:
+        sample_rate = 16000
+
+    def tokenize(self, text_tokens):
+        return [[1] * len(token) for token in text_tokens]
+
+
+def test_incremental_realigns_only_the_edited_repeated_line(monkeypatch):
+    # 副歌重复：第二行改动一个token后与第一行完全相同
+    old = [['la', 'la'], ['la', 'li'], ['la', 'la'], ['la', 'li']]
+    new = [['la', 'la'], ['la', 'la'], ['la', 'la'], ['la', 'li']]
+    previous = {
+        'settings': 'settings',
+        'lines': old,
+        'starts': [[4.0 * line, 4.0 * line + 1] for line in range(4)],
+        'ends': [[4.0 * line + 1, 4.0 * line + 2] for line in range(4)],
+        'scores': [[0.9, 0.9] for _ in range(4)],
+    }
+    calls = []
+
+    def fake_align(audio, tokens, *args, token_lines=None, line_windows=None, **kwargs):
+        calls.append((tokens, line_windows))
+        starts = np.array([line_windows[0][0] + 0.5, line_windows[0][0] + 1.5])
+        return align.AlignmentArrays(tokens, starts, starts + 1, np.zeros(2, dtype=bool), np.full(2, 0.5))
+
+    monkeypatch.setattr(align, 'get_model_manager', _TokenizingManager)
+    monkeypatch.setattr(align, 'alignment_settings', lambda *args: 'settings')
+    monkeypatch.setattr(align, 'align_audio_with_text', fake_align)
+    text_tokens = [token for line in new for token in line]
+    token_lines = [line for line, tokens in enumerate(new) for _ in tokens]
+    result = align.align_incremental(previous, np.zeros(16000), text_tokens, token_lines, 20.0, audio_hash='hash')
+    assert calls == [(['la', 'la'], {0: (2.0, 8.0)})]
+    assert result.starts.tolist() == [0.0, 1.0, 2.5, 3.5, 8.0, 9.0, 12.0, 13.0]
+    assert not result.failed.any()
+
+
+def arrays(scores, failed=None):
+    scores = np.asarray(scores, dtype=np.float64)
+    failed = np.zeros(len(scores), dtype=bool) if failed is None else np.asarray(failed)
+    return align.AlignmentArrays(['a'] * len(scores), scores, scores, failed, scores)
+
+
+def test_alignment_score_counts_failed_tokens_as_zero():
+    assert align.alignment_score(arrays([0.8, 0.6, 1.0], [False, False, True])) == pytest.approx(0.7 * 2 / 3)
+    assert align.alignment_score(align.empty_alignment()) == 0.0
+
+
+def test_best_speed_prefers_earlier_speed_on_ties():
+    results = {0.8: arrays([0.5, 0.7]), 0.9: arrays([0.9, 0.5]), 1.0: arrays([0.7, 0.7], [False, False])}
+    best, scores = align.best_speed([0.8, 1.0, 0.9], results)
+    assert best == 1.0
+    assert scores == pytest.approx({0.8: 0.6, 0.9: 0.7, 1.0: 0.7})
+    results[0.8] = arrays([0.9, 0.9], [True, False])
+    assert align.best_speed([0.9, 0.8], results)[0] == 0.9
+
+
+def test_speed_sweep_single_worker_runs_in_process(monkeypatch):
+    calls = []
+
+    def fake_worker(audio, sr, speed, *args):
+        calls.append(speed)
+        return arrays([1 - abs(speed - 0.9)])
+
+    monkeypatch.setattr(align, '_sweep_worker', fake_worker)
+    manager = types.SimpleNamespace(backend='eager', weights_path=None, align_band=0)
+    monkeypatch.setattr(align, 'get_model_manager', lambda: manager)
+    threads = torch.get_num_threads()
+    best, alignment, scores = align.speed_sweep(np.zeros(16000), 16000, ['a'], [0.8, 0.9, 1.0], workers=1, audio_hash='hash')
+    assert calls == [0.8, 0.9, 1.0]
+    assert best == 0.9 and alignment.scores[0] == pytest.approx(1.0)
+    assert torch.get_num_threads() == threads
@@ -0,0 +1,96 @@
+import io
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'FA-Kara'))
+import emitter
+import norm2ass
+from norm2lrc import LrcSink, RlfSink, RubySink
+from tokens import TokenTable
+
+ITEMS = [
+    {'orig': '君', 'type': 2, 'ruby': 'きみ', 'pron': 'kimi', 'start': '[00:05:00]', 'end': '[00:05:60]'},
+    {'orig': 'が', 'type': 3, 'pron': 'ga', 'start': '[00:05:60]', 'end': '[00:06:20]'},
+    {'orig': ' ', 'type': 0, 'pron': ''},
+    {'orig': 'love', 'type': 1, 'pron': 'la', 'start': '[00:06:50]', 'end': '[00:07:10]'},
+    {'orig': '\n', 'type': 0, 'pron': ''},
+    {'orig': '君', 'type': 2, 'ruby': 'きみ', 'pron': 'kimi', 'start': '[00:12:00]', 'end': '[00:12:40]'},
+    {'orig': '空', 'type': 2, 'ruby': 'そ', 'pron': 'so', 'start': '[00:12:40]', 'end': '[00:12:90]'},
+    {'orig': '', 'type': 2, 'ruby': 'ら', 'pron': 'ra', 'start': '[00:12:90]', 'end': '[00:13:30]'},
+    {'orig': 'を', 'type': 3, 'pron': 'wo', 'start': '[00:13:30]', 'end': '[00:14:00]'},
+    {'orig': '\n', 'type': 0, 'pron': ''},
+]
+
+# 重构前的process_main(ITEMS, -150, 60, 3)、process_ruby、process_rlf与process_norm2assV2的输出
+GOLDEN_LRC = ('[00:02:00]●[00:03:00]●[00:04:00]●[00:05:00][00:05:00]君[00:05:60]が[00:06:20] [00:06:50]love[00:07:10]\n'
+              '[00:12:00]君[00:12:40]空[00:13:30]を[00:14:00]\n'
+              '\n'
+              '@Offset=-150')
+GOLDEN_RUBY = ('@Ruby1=君,きみ,[00:05:00],[00:12:00]\n'
+               '@Ruby2=君,きみ,[00:12:00],\n'
+               '@Ruby3=空,そ[00:00:50]ら,[00:12:40],')
+GOLDEN_RLF = ('{君|[1|00:05:00]きみ}[1|00:05:60]が[10|00:06:20] [1|00:06:50]love[10|00:07:10]\n'
+              '{君|[1|00:12:00]きみ}{空|[2|00:12:40]そ[00:12:90]ら}[1|00:13:30]を[10|00:14:00]\n')
+GOLDEN_ASS = ('Dialogue: 0,0:00:04.80,0:00:07.30,Default,,0,0,0,karaoke,{\\k20}{\\k60}君|<きみ{\\k60}が{\\k30} {\\k60}love{\\k20}\n'
+              'Dialogue: 0,0:00:11.80,0:00:14.20,Default,,0,0,0,karaoke,{\\k20}{\\k40}君|<きみ{\\k50}空|<そ{\\k40}#|ら{\\k70}を{\\k20}\n')
+
+KEYS = ('orig', 'type', 'ruby', 'pron', 'start', 'end')
+with open(os.path.join(os.path.dirname(__file__), 'data', 'emit_golden.json'), encoding='utf-8') as f:
+    GOLDEN = json.load(f)
+
+
+def emit_all(table, offset=-150, bpm=60, beats_per_bar=3, ruby_file=None, rlf_file=None, ass_file=None):
+    '与main.py相同：一次遍历同时写出o_ruby.lrc、o_rlf.lrc与o.ass'
+    ruby_file = ruby_file if ruby_file is not None else io.StringIO()
+    rlf_file = rlf_file if rlf_file is not None else io.StringIO()
+    ass_file = ass_file if ass_file is not None else io.StringIO()
+    emitter.emit(table, [
+        LrcSink(ruby_file, offset, bpm, beats_per_bar),
+        RubySink(ruby_file, prefix='\n'),
+        RlfSink(rlf_file),
+        norm2ass.AssSink(ass_file, head=norm2ass.ASS_HEAD),
+    ])
+    return ruby_file, rlf_file, ass_file
+
+
+def test_fixed_tokens_match_golden_output():
+    ruby_file, rlf_file, ass_file = emit_all(TokenTable.from_dicts(ITEMS))
+    assert ruby_file.getvalue() == GOLDEN_LRC + '\n' + GOLDEN_RUBY
+    assert rlf_file.getvalue() == GOLDEN_RLF
+    assert ass_file.getvalue() == norm2ass.ASS_HEAD + GOLDEN_ASS
+
+
+def test_sinks_stream_into_files(tmp_path):
+    paths = [tmp_path / name for name in ('o_ruby.lrc', 'o_rlf.lrc', 'o.ass')]
+    files = [open(path, 'w', encoding='utf-8') for path in paths]
+    with files[0], files[1], files[2]:
+        emit_all(TokenTable.from_dicts(ITEMS), ruby_file=files[0], rlf_file=files[1], ass_file=files[2])
+    contents = [path.read_text(encoding='utf-8') for path in paths]
+    assert contents == [GOLDEN_LRC + '\n' + GOLDEN_RUBY, GOLDEN_RLF, norm2ass.ASS_HEAD + GOLDEN_ASS]
+
+
+def test_each_token_is_visited_once():
+    class CountingSink(emitter.TokenSink):
+        def begin(self, columns):
+            super().begin(columns)
+            self.visits = []
+
+        def token(self, i):
+            self.visits.append(i)
+
+    sink, = emitter.emit(TokenTable.from_dicts(ITEMS), [CountingSink()])
+    assert sink.visits == list(range(len(ITEMS)))
+
+
+@pytest.mark.parametrize('case', [case for case in GOLDEN if None not in case['expected'].values()],
+                         ids=lambda case: f"offset{case['offset']}-bpm{case['bpm']}")
+def test_single_pass_matches_baseline(case):
+    table = TokenTable.from_dicts([{key: value for key, value in zip(KEYS, row) if value is not None} for row in case['items']])
+    ruby_file, rlf_file, ass_file = emit_all(table, case['offset'], case['bpm'], case['beats_per_bar'])
+    expected = case['expected']
+    assert ruby_file.getvalue() == expected['lrc'] + '\n' + expected['ruby']
+    assert rlf_file.getvalue() == expected['rlf']
+    assert ass_file.getvalue() == norm2ass.ASS_HEAD + expected['ass']
@@ -0,0 +1,20 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'FA-Kara'))
+import lrcfmt
+
+
+def test_plain_lines_keep_their_line_breaks():
+    assert lrcfmt.split_lyrics('\n{君|きみ}が\n\n空を\n') == ['{君|きみ}が\n', '空を\n']
+
+
+def test_moe_lines_keep_their_line_breaks():
+    text = '|style="x"\n{{Photrans|君|きみ}}が#NoHover\n空を<--note-->'
+    assert lrcfmt.split_lyrics(text, 'moe') == ['{君|きみ}が\n', '空を\n']
+
+
+def test_uta_lines_keep_their_line_breaks():
+    text = ('<div class="hiragana"><span class="ruby"><span class="rb">君</span><span class="rt">きみ</span></span>が'
+            '<br>空を</div>')
+    assert lrcfmt.split_lyrics(text, 'uta') == ['{君|きみ}が\n', '空を\n']
@@ -0,0 +1,108 @@
+import os
+import random
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'FA-Kara'))
+import norm2lrc
+from tokens import NO_TIME, TokenTable
+
+
+def kana_table(text):
+    '逐字的假名token，空白与标点为0类'
+    types = [0 if char.isspace() or char in '、。！？,.!?」' else 3 for char in text]
+    return TokenTable(list(text), types)
+
+
+def split_lines(table, max_length):
+    norm2lrc.split_long_segments(table, max_length)
+    return ''.join(table.orig).split('\n')
+
+
+def test_spaces_are_replaced():
+    assert split_lines(kana_table('あいうえお かきくけこ さしすせそ'), 10) == ['あいうえお', 'かきくけこ', 'さしすせそ']
+
+
+def test_breaks_follow_punctuation():
+    lines = split_lines(kana_table('あいうえおかきくけこ、さしすせそたちつてと。なにぬねの'), 12)
+    assert lines == ['あいうえおかきくけこ、', 'さしすせそたちつてと。', 'なにぬねの']
+
+
+def test_punctuation_before_space_breaks_at_the_space():
+    assert split_lines(kana_table('あいうえお、 かきくけこさ'), 8) == ['あいうえお、', 'かきくけこさ']
+
+
+def test_closing_punctuation_stays_together():
+    assert split_lines(kana_table('あいうえお。」かきくけこ'), 8) == ['あいうえお。」', 'かきくけこ']
+
+
+def test_english_word_with_trailing_comma():
+    table = TokenTable(['love,', 'you', 'forever'], [1, 1, 1])
+    assert split_lines(table, 5) == ['love,', 'youforever']
+
+
+def test_fallback_cut_between_words_without_separators():
+    lines = split_lines(kana_table('きゃっとあいうえおかきくけこさしすせ'), 5)
+    assert all(norm2lrc.calculate_length(line) <= 5 for line in lines)
+    assert lines[0] == 'きゃっと' # 不在小写假名之前断开
+
+
+def test_fallback_keeps_ruby_groups_together():
+    table = TokenTable(['青', '', '空', '', 'を', '見', '', 'る'], [2, 2, 2, 2, 3, 2, 2, 3])
+    lines = split_lines(table, 2)
+    assert all(norm2lrc.calculate_length(line) <= 2 for line in lines)
+    breaks = [i for i, orig in enumerate(table.orig) if orig == '\n']
+    assert breaks and all(table.orig[i + 1] != '' for i in breaks)
+
+
+def test_separators_preferred_over_fallback():
+    lines = split_lines(kana_table('あいうえおかきく けこさしすせそ'), 9)
+    assert lines == ['あいうえおかきく', 'けこさしすせそ']
+
+
+def test_short_lines_are_untouched():
+    table = kana_table('あいうえお、かきくけこ')
+    assert split_lines(table, 20) == ['あいうえお、かきくけこ']
+    assert len(table) == 11
+
+
+def test_inserted_breaks_keep_times_aligned():
+    text = 'あいうえおかきくけこ、さしすせそ'
+    table = kana_table(text)
+    timed = [i for i, char in enumerate(text) if char != '、']
+    table.set_times(timed, [100 * i for i in timed], [100 * i + 50 for i in timed])
+    norm2lrc.split_long_segments(table, 11)
+    assert ''.join(table.orig) == 'あいうえおかきくけこ、\nさしすせそ'
+    for orig, start in zip(table.orig, table.start.tolist()):
+        if orig in ('、', '\n'):
+            assert start == NO_TIME
+        else:
+            assert start == 100 * text.index(orig)
+    lrc = norm2lrc.process_main(table, bpm=0).split('\n')
+    assert lrc[0].endswith('[00:09:00]こ、[00:09:50]')
+    assert lrc[1] == '[00:11:00]さ[00:12:00]し[00:13:00]す[00:14:00]せ[00:15:00]そ[00:15:50]'
+
+
+@pytest.mark.parametrize('max_length', [3, 4, 6, 8, 15])
+def test_random_lyrics_fit_when_cuts_exist(max_length):
+    rng = random.Random(max_length)
+    for _ in range(200):
+        origs, types = [], []
+        for _ in range(rng.randint(1, 40)):
+            kind = rng.random()
+            if kind < .5:
+                origs.append(rng.choice('あいうえおかきくけこ')); types.append(3)
+            elif kind < .7:
+                origs.append(rng.choice(['歌', '空'])); types.append(2)
+                origs.append(''); types.append(2)
+            elif kind < .8:
+                origs.append(rng.choice(['love', 'you,'])); types.append(1)
+            elif not origs or norm2lrc.break_kind(origs[-1], types[-1]) is None: # 不连续放置分隔符
+                origs.append(rng.choice([' ', '　', '、', '。'])); types.append(0)
+        table = TokenTable(origs, types)
+        words = [orig for orig in origs if orig]
+        lines = split_lines(table, max_length)
+        assert all(norm2lrc.calculate_length(line) <= max_length for line in lines)
+        assert [orig for orig in table.orig if orig and orig != '\n' and not orig.isspace()] == \
+            [orig for orig in words if not orig.isspace()]
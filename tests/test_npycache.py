@@ -0,0 +1,40 @@
+import os
+import stat
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'FA-Kara'))
+import npycache
+
+
+def test_round_trip(tmp_path):
+    cache = npycache.NpyCache(str(tmp_path / 'cache'), dtype=np.float16)
+    cache.put('key', np.arange(4, dtype=np.float32))
+    assert cache.get('key').dtype == np.float16
+    assert np.array_equal(cache.get('key'), np.arange(4))
+    assert cache.get('missing') is None
+
+
+@pytest.mark.skipif(hasattr(os, 'geteuid') and os.geteuid() == 0, reason='root ignores directory permissions')
+def test_unwritable_directory_disables_cache(tmp_path):
+    parent = tmp_path / 'readonly'
+    parent.mkdir()
+    parent.chmod(stat.S_IRUSR | stat.S_IXUSR)
+    try:
+        cache = npycache.NpyCache(str(parent / 'cache'))
+        assert not cache.available
+        cache.put('key', np.zeros(3))
+        assert cache.get('key') is None
+    finally:
+        parent.chmod(stat.S_IRWXU)
+
+
+def test_directory_blocked_by_file(tmp_path):
+    blocker = tmp_path / 'cache'
+    blocker.write_text('not a directory')
+    cache = npycache.NpyCache(str(blocker / 'emissions'))
+    assert not cache.available
+    cache.put('key', np.zeros(3))
+    assert cache.get('key') is None
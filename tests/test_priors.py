@@ -0,0 +1,44 @@
+import io
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'FA-Kara'))
+import emitter
+import priors
+from norm2lrc import LrcSink, RubySink
+from tokens import NO_TIME, TokenTable
+
+
+def ruby_lrc_output():
+    '与main.py写出的o_ruby.lrc相同：逐字时间轴（首行带导唱指示灯）后接@Offset与@Ruby标签'
+    table = TokenTable(
+        ['君', 'が', '\n', '空', 'を', '\n'],
+        [2, 3, 0, 2, 3, 0],
+        ['きみ', None, None, 'そら', None, None],
+        ['kimi', 'ga', '', 'sora', 'wo', ''],
+        [500, 560, NO_TIME, 1200, 1290, NO_TIME],
+        [560, 620, NO_TIME, 1290, 1350, NO_TIME],
+    )
+    out = io.StringIO()
+    emitter.emit(table, [LrcSink(out, -150, 60, 3), RubySink(out, prefix='\n')])
+    return out.getvalue()
+
+
+def test_own_ruby_lrc_round_trip():
+    lrc = ruby_lrc_output()
+    assert '●' in lrc and '@Ruby1=' in lrc
+    timings = priors.parse_timings(lrc)
+    assert timings == [(500, 620), (1200, 1350)]
+    windows = priors.line_windows(timings, [0, 1], duration=20, pad=1)
+    assert windows == {0: (4.0, 7.2), 1: (11.0, 14.5)}
+
+
+def test_line_start_stamps():
+    timings = priors.parse_lrc_timings('[ti:title]\n[00:01.50]first line\n\n[00:04.00]second line\n')
+    assert timings == [(150, None), (400, None)]
+    assert priors.line_windows(timings, [3, 7], duration=10, pad=0) == {3: (1.5, 4.0), 7: (4.0, 10)}
+
+
+def test_long_minutes_and_millisecond_stamps():
+    timings = priors.parse_lrc_timings('[123:04.56]long mix[123:05:678]\n[7:08.09]short minutes\n')
+    assert timings == [(123 * 6000 + 456, 123 * 6000 + 567), (7 * 6000 + 809, None)]
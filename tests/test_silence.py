@@ -0,0 +1,116 @@
+import os
+import sys
+
+import librosa
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'FA-Kara'))
+import silence
+
+
+def synthetic_vocals(seed, sr, seconds=40):
+    '静音、低噪声与不同响度的乐句交替出现，末尾可能仍在发声'
+    rng = np.random.default_rng(seed)
+    audio = rng.standard_normal(sr * seconds).astype(np.float32) * 1e-3
+    t = 0.0
+    while t < seconds:
+        length = rng.uniform(0.3, 6)
+        start, end = int(t * sr), int(min(t + length, seconds) * sr)
+        phase = np.arange(end - start) / sr
+        audio[start:end] += (rng.uniform(0.05, 0.8) * np.sin(2 * np.pi * rng.uniform(150, 900) * phase)).astype(np.float32)
+        t += length + rng.uniform(0, 4)
+    return audio
+
+
+def baseline_non_silent_recog(audio_file, sr=None, frame_second=1, threspct=10, thresrto=0.1):
+    '重构前app.py与main.py中的实现，原样保留作为对照'
+    frame_length = int(sr * frame_second)
+    hop_length = frame_length // 2
+    energy = librosa.feature.rms(y=audio_file, frame_length=frame_length, hop_length=hop_length)[0]
+    threshold = np.percentile(energy, 100 - threspct) * thresrto
+    non_silent_frames = energy > threshold
+    times = librosa.frames_to_time(np.arange(len(energy)), sr=sr, hop_length=hop_length)
+    segments = []
+    start = None
+    for i, (t, active) in enumerate(zip(times, non_silent_frames)):
+        if active and start is None:
+            start = max(t - frame_second / 4, 0)
+        elif not active and start is not None:
+            segments.append((start, t + frame_second / 4))
+            start = None
+    if start is not None:
+        segments.append((start, times[-1]))
+    return segments
+
+
+def assert_same_ranges(actual, expected, atol=1e-6):
+    assert len(actual) == len(expected)
+    np.testing.assert_allclose(np.reshape(actual, (-1, 2)), np.reshape(expected, (-1, 2)), atol=atol)
+
+
+def stream(audio, sr, frame_seconds, seed):
+    '按随机大小分块送入流式检测器，模拟解码过程'
+    detector = silence.StreamingSilenceDetector(sr, frame_seconds)
+    rng = np.random.default_rng(seed)
+    position = 0
+    while position < len(audio):
+        size = int(rng.integers(1, 20000))
+        detector.feed(audio[position:position + size])
+        position += size
+    return detector.finalize()
+
+
+FRAME_SECONDS = (1, 0.8, silence.FINE_FRAME_SECOND)
+
+
+@pytest.mark.parametrize('seed', range(6))
+@pytest.mark.parametrize('sr', [16000, 44100])
+def test_streaming_detector_matches_batch(seed, sr):
+    audio = synthetic_vocals(seed, sr)
+    streamed = stream(audio, sr, FRAME_SECONDS, seed)
+    batch = silence.non_silent_recog_multi(audio, sr, FRAME_SECONDS)
+    for streamed_ranges, batch_ranges in zip(streamed, batch):
+        assert_same_ranges(streamed_ranges, batch_ranges, atol=1e-9)
+
+
+@pytest.mark.parametrize('seed', range(6))
+@pytest.mark.parametrize('sr', [16000, 44100])
+def test_streaming_detector_matches_baseline(seed, sr):
+    audio = synthetic_vocals(seed, sr)
+    for frame_second, streamed_ranges in zip(FRAME_SECONDS, stream(audio, sr, FRAME_SECONDS, seed)):
+        assert_same_ranges(streamed_ranges, baseline_non_silent_recog(audio, sr, frame_second))
+
+
+@pytest.mark.parametrize('suffix', ['.wav', '.flac'])
+def test_detection_while_decoding_matches_decoded_audio(tmp_path, suffix):
+    import audioproc
+    import soundfile
+    stereo = np.stack((synthetic_vocals(0, 44100, 20), synthetic_vocals(1, 44100, 20)), axis=1)
+    path = str(tmp_path / f'vocals{suffix}')
+    soundfile.write(path, stereo, 44100, subtype='PCM_16')
+    detector = silence.StreamingSilenceDetector(16000, FRAME_SECONDS)
+    audio, sr = audioproc.load_audio(path, block_frames=10000, on_block=detector.feed)
+    for streamed_ranges, batch_ranges in zip(detector.finalize(), silence.non_silent_recog_multi(audio, sr, FRAME_SECONDS)):
+        assert_same_ranges(streamed_ranges, batch_ranges, atol=1e-9)
+
+
+@pytest.mark.parametrize('seed', range(4))
+@pytest.mark.parametrize('sr', [16000, 22050, 44100, 48000])
+@pytest.mark.parametrize('threspct, thresrto', [(10, .1), (30, .05), (5, .3)])
+def test_multi_resolution_matches_baseline(seed, sr, threspct, thresrto):
+    audio = synthetic_vocals(seed, sr, seconds=25)
+    frame_seconds = (1, 0.8, 0.3, silence.FINE_FRAME_SECOND)
+    for frame_second, ranges in zip(frame_seconds, silence.non_silent_recog_multi(audio, sr, frame_seconds, threspct, thresrto)):
+        assert_same_ranges(ranges, baseline_non_silent_recog(audio, sr, frame_second, threspct, thresrto))
+        assert_same_ranges(silence.non_silent_recog(audio, sr, frame_second, threspct, thresrto), ranges, atol=0)
+
+
+@pytest.mark.parametrize('audio', [
+    np.zeros(16000 * 3, dtype=np.float32), # 全部静音
+    np.full(16000 * 3, 0.5, dtype=np.float32), # 全部发声，片段持续到末尾
+    np.full(5000, 0.5, dtype=np.float32), # 短于一帧
+], ids=['silent', 'loud', 'short'])
+def test_edge_cases_match_baseline(audio):
+    for frame_second, ranges in zip(FRAME_SECONDS, silence.non_silent_recog_multi(audio, 16000, FRAME_SECONDS)):
+        assert_same_ranges(ranges, baseline_non_silent_recog(audio, 16000, frame_second))
@@ -0,0 +1,40 @@
+import json
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'FA-Kara'))
+import timing
+from tokens import TokenTable
+
+# 重构前的实现（main.py/app.py中的尾音修正与norm2lrc.non_silent_head_adjust）在随机歌词与时间上的输出；
+# 各行为[orig, type, ruby, pron]，时间为厘秒，-1为没有时间，-2为对齐失败；expected为None表示重构前的实现报错
+with open(os.path.join(os.path.dirname(__file__), 'data', 'timing_golden.json'), encoding='utf-8') as f:
+    GOLDEN = json.load(f)
+
+
+def run_timing(case):
+    table = TokenTable(*zip(*case['items']))
+    timing.tail_pron_correct(table, case['mode'])
+    indices = [i for i, pron in enumerate(table.pron) if pron]
+    assert len(indices) == len(case['starts'])
+    table.set_times(indices, case['starts'], case['ends'])
+    timing.non_silent_head_adjust(table, case['non_silent_ranges'])
+    if case['mode'] == 3:
+        timing.tail_end_correct(table, case['fine_ranges'])
+    return table
+
+
+@pytest.mark.parametrize('case', GOLDEN, ids=[f"case{i}-mode{case['mode']}" for i, case in enumerate(GOLDEN)])
+def test_timing_matches_baseline(case):
+    expected = case['expected']
+    if expected is None:
+        with pytest.raises(ValueError):
+            run_timing(case)
+        return
+    table = run_timing(case)
+    assert table.pron == expected['pron']
+    np.testing.assert_array_equal(table.start, expected['start'])
+    np.testing.assert_array_equal(table.end, expected['end'])
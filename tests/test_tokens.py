@@ -0,0 +1,68 @@
+import json
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'FA-Kara'))
+import norm2ass
+import norm2lrc
+from tokens import ERROR_TIME, NO_TIME, TokenTable, as_table, format_hundredths_to_time_str, parse_time_to_hundredths
+
+KEYS = ('orig', 'type', 'ruby', 'pron', 'start', 'end')
+
+# 重构前逐格式遍历字典列表的process_main/process_ruby/process_rlf/process_norm2assV2在随机歌词上的输出；
+# 各行为[orig, type, ruby, pron, start, end]，缺少的键为null；输出为null表示重构前的实现报错
+with open(os.path.join(os.path.dirname(__file__), 'data', 'emit_golden.json'), encoding='utf-8') as f:
+    GOLDEN = json.load(f)
+
+
+def golden_dicts(case):
+    return [{key: value for key, value in zip(KEYS, row) if value is not None} for row in case['items']]
+
+
+def test_time_strings_round_trip():
+    for cs in [0, 1, 99, 100, 5999, 6000, 359999, 599999]:
+        assert parse_time_to_hundredths(format_hundredths_to_time_str(cs)) == cs
+
+
+def test_dicts_round_trip():
+    items = [
+        {'orig': '歌', 'type': 2, 'ruby': 'う', 'pron': 'u', 'start': '[00:01:38]', 'end': '[00:01:40]'},
+        {'orig': '', 'type': 2, 'ruby': 'た', 'pron': 'ta', 'start': '[error]', 'end': '[error]'},
+        {'orig': ' ', 'type': 0, 'pron': ''},
+        {'orig': '!', 'type': 0},
+        {'orig': '\n', 'type': 0, 'pron': ''},
+    ]
+    table = TokenTable.from_dicts(items)
+    assert table.type.dtype == np.int8 and table.start.dtype == np.int32
+    assert table.start.tolist() == [138, ERROR_TIME, NO_TIME, NO_TIME, NO_TIME]
+    assert table.ruby == ['う', 'た', None, None, None]
+    assert table.to_dicts() == items
+    assert as_table(table) is table
+
+
+def test_invalid_time_is_rejected():
+    with pytest.raises(ValueError):
+        TokenTable.from_dicts([{'orig': 'a', 'type': 1, 'start': '1.5', 'end': '[00:02:00]'}])
+
+
+def legacy_outputs(tokens, case):
+    outputs = {}
+    for name, run in [('lrc', lambda: norm2lrc.process_main(tokens, case['offset'], case['bpm'], case['beats_per_bar'])),
+                      ('ruby', lambda: norm2lrc.process_ruby(tokens)),
+                      ('rlf', lambda: norm2lrc.process_rlf(tokens)),
+                      ('ass', lambda: norm2ass.process_norm2assV2(tokens))]:
+        try:
+            outputs[name] = run()
+        except ValueError:
+            outputs[name] = None
+    return outputs
+
+
+@pytest.mark.parametrize('case', GOLDEN, ids=[f'case{i}' for i in range(len(GOLDEN))])
+def test_dict_and_table_inputs_match_baseline(case):
+    items = golden_dicts(case)
+    assert legacy_outputs(items, case) == case['expected']
+    assert legacy_outputs(TokenTable.from_dicts(items), case) == case['expected']